@@ -65,7 +65,7 @@ bpUInt64 PerformanceCounter()
 #else
   struct timespec vTimeSpec;
   clock_gettime(CLOCK_MONOTONIC, &vTimeSpec);
-  return vTimeSpec.tv_sec + vTimeSpec.tv_nsec / 1000000000.0;
+  return static_cast<bpUInt64>(vTimeSpec.tv_sec) * 1000000000 + static_cast<bpUInt64>(vTimeSpec.tv_nsec);
 #endif
 }
 
@@ -76,7 +76,7 @@ bpUInt64 PerformanceFrequency()
   QueryPerformanceFrequency(&vFrequency);
   return static_cast<bpUInt64>(vFrequency.QuadPart);
 #else
-  return 1;
+  return 1000000000;
 #endif
 }
 
@@ -0,0 +1,283 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+Lazily loaded bpImarisWriter96 library with argtypes and restype bound for the bpImageConverterC API
+
+The library is loaded once, on first use (not on import). Set IMARISWRITER_LIBRARY to the
+path of the library to override the platform default name. The functions are available
+as module attributes, e.g. ImarisWriterCtypesLibrary.bpImageConverterC_CopyBlockUInt8.
+
+ErrorChecker polls bpImageConverterC_GetLastException after every block (strict, for debugging)
+or only every N blocks / seconds, which halves the foreign calls per block.
+
+get_c_time_infos and get_c_color_infos fill the Finish structs from NumPy arrays in bulk (also used
+by PyImarisWriterBlocks.ImageConverter.Finish), CParameters keeps the encoded parameter sections
+until a value in them changes.
+"""
+
+import ctypes
+import os
+import platform
+import threading
+import time
+
+import numpy as np
+
+from PyImarisWriter import ImarisWriterCtypes as IW
+from PyImarisWriter import PyImarisWriter as PW
+
+
+library_environment_variable = 'IMARISWRITER_LIBRARY'
+
+bpConverterTypesC_ProgressCallback = IW.CFUNCTYPE(IW.c_void_p, IW.c_float, IW.c_ulonglong, IW.c_void_p)
+
+_signatures = {
+    'bpImageConverterC_Create': (IW.bpImageConverterCPtr,
+                                 [IW.c_int, IW.bpConverterTypesC_Size5DPtr, IW.bpConverterTypesC_Size5DPtr,
+                                  IW.bpConverterTypesC_DimensionSequence5DPtr, IW.bpConverterTypesC_Size5DPtr,
+                                  IW.c_char_p, IW.bpConverterTypesC_OptionsPtr, IW.c_char_p, IW.c_char_p,
+                                  bpConverterTypesC_ProgressCallback, IW.c_void_p]),
+    'bpImageConverterC_Destroy': (None, [IW.bpImageConverterCPtr]),
+    'bpImageConverterC_GetLastException': (IW.c_char_p, [IW.bpImageConverterCPtr]),
+    'bpImageConverterC_NeedCopyBlock': (IW.c_bool, [IW.bpImageConverterCPtr, IW.bpConverterTypesC_Index5DPtr]),
+    'bpImageConverterC_CopyBlockUInt8': (None, [IW.bpImageConverterCPtr, IW.POINTER(IW.c_ubyte),
+                                                IW.bpConverterTypesC_Index5DPtr]),
+    'bpImageConverterC_CopyBlockUInt16': (None, [IW.bpImageConverterCPtr, IW.POINTER(IW.c_ushort),
+                                                 IW.bpConverterTypesC_Index5DPtr]),
+    'bpImageConverterC_CopyBlockUInt32': (None, [IW.bpImageConverterCPtr, IW.POINTER(IW.c_uint),
+                                                 IW.bpConverterTypesC_Index5DPtr]),
+    'bpImageConverterC_CopyBlockFloat': (None, [IW.bpImageConverterCPtr, IW.POINTER(IW.c_float),
+                                                IW.bpConverterTypesC_Index5DPtr]),
+    'bpImageConverterC_Finish': (None, [IW.bpImageConverterCPtr, IW.bpConverterTypesC_ImageExtentPtr,
+                                        IW.bpConverterTypesC_ParametersPtr, IW.bpConverterTypesC_TimeInfosPtr,
+                                        IW.bpConverterTypesC_ColorInfosPtr, IW.c_bool]),
+}
+
+_library = None
+_library_lock = threading.Lock()
+
+
+def get_library_filename():
+    filename = os.environ.get(library_environment_variable)
+    if filename:
+        return filename
+    if platform.system() == 'Windows':
+        return 'bpImarisWriter96.dll'
+    elif platform.system() == 'Darwin':
+        return 'libbpImarisWriter96.dylib'
+    elif platform.system() == 'Linux':
+        return 'libbpImarisWriter96.so'
+    else:
+        print('Platform not supported: "{}"'.format(platform.system()))
+        return None
+
+
+def get_library():
+    global _library
+    if _library is None:
+        with _library_lock:
+            if _library is None:
+                cdll = IW.CDLL(get_library_filename())
+                for name, (restype, argtypes) in _signatures.items():
+                    function = getattr(cdll, name)
+                    function.restype = restype
+                    function.argtypes = argtypes
+                _library = cdll
+    return _library
+
+
+def __getattr__(name):
+    if name in _signatures:
+        return getattr(get_library(), name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+class ErrorChecker:
+    """
+    Checks the last exception of a converter every check_every blocks (1 is strict checking,
+    None only checks on the interval or explicit check() calls) or every check_interval seconds.
+    A failure raises PyImarisWriterException with mBlockIndex, mNumBlocks, mBytesSubmitted and
+    mBytesWritten set. In deferred mode the failing block is one of the blocks submitted since
+    the last check, mFirstUncheckedBlock is the number of blocks that passed before it.
+    """
+
+    def __init__(self, imageconverter_ptr, check_every=1, check_interval=None):
+        self.mConverter = imageconverter_ptr
+        self.mCheckEvery = check_every
+        self.mCheckInterval = check_interval
+        self.mGetLastException = get_library().bpImageConverterC_GetLastException
+        self.mNumBlocks = 0
+        self.mNumCheckedBlocks = 0
+        self.mBytesSubmitted = 0
+        self.mBytesWritten = 0
+        self.mBlockIndex = None
+        self.mLastCheckTime = time.monotonic()
+
+    def record_bytes_written(self, total_bytes_written):
+        self.mBytesWritten = total_bytes_written
+
+    def record_block(self, block_index, num_bytes):
+        """Call after each CopyBlock, block_index is e.g. a (x, y, z, c, t) tuple"""
+        self.mNumBlocks += 1
+        self.mBytesSubmitted += num_bytes
+        self.mBlockIndex = block_index
+        if self.mCheckEvery is not None and self.mNumBlocks - self.mNumCheckedBlocks >= self.mCheckEvery:
+            self.check()
+        elif self.mCheckInterval is not None and time.monotonic() - self.mLastCheckTime >= self.mCheckInterval:
+            self.check()
+
+    def check(self, function_name='CopyBlock'):
+        self.mLastCheckTime = time.monotonic()
+        last_exception = self.mGetLastException(self.mConverter)
+        if last_exception:
+            raise self._get_exception(function_name, last_exception.decode())
+        self.mNumCheckedBlocks = self.mNumBlocks
+
+    def _get_exception(self, function_name, message):
+        if self.mBlockIndex is None:
+            location = 'no block'
+        elif self.mNumBlocks == self.mNumCheckedBlocks:
+            location = 'block {}'.format(self.mBlockIndex)
+        else:
+            location = 'one of blocks {} to {} (last index {})'.format(
+                self.mNumCheckedBlocks + 1, self.mNumBlocks, self.mBlockIndex)
+        exception = PW.PyImarisWriterException('{} failed at {}, {} bytes submitted, {} bytes written: {}'.format(
+            function_name, location, self.mBytesSubmitted, self.mBytesWritten, message))
+        exception.mBlockIndex = self.mBlockIndex
+        exception.mNumBlocks = self.mNumBlocks
+        exception.mFirstUncheckedBlock = self.mNumCheckedBlocks
+        exception.mBytesSubmitted = self.mBytesSubmitted
+        exception.mBytesWritten = self.mBytesWritten
+        return exception
+
+
+def get_numpy_dtype(structure_type):
+    """Structured dtype with the layout of a ctypes structure, pointers become uintp"""
+    names = []
+    formats = []
+    offsets = []
+    for field in structure_type._fields_:
+        name, field_type = field[0], field[1]
+        if issubclass(field_type, ctypes.Structure):
+            field_format = get_numpy_dtype(field_type)
+        elif issubclass(field_type, (ctypes._Pointer, ctypes.c_void_p, ctypes.c_char_p)):
+            field_format = np.uintp
+        else:
+            field_format = np.dtype(field_type)
+        names.append(name)
+        formats.append(field_format)
+        offsets.append(getattr(structure_type, name).offset)
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                     'itemsize': ctypes.sizeof(structure_type)})
+
+
+def get_c_array(structure_type, np_data):
+    """ctypes array sharing the memory of np_data (which it keeps alive)"""
+    return (structure_type * len(np_data)).from_buffer(np_data)
+
+
+# julian day of 1970-01-01
+_julian_day_epoch = 2440588
+
+
+def get_c_time_infos(times):
+    """times: datetime64 array (or anything np.asarray converts to datetime64, e.g. a list of datetimes)"""
+    times = np.asarray(times, dtype='datetime64[ns]')
+    days = times.astype('datetime64[D]')
+    data = np.zeros(len(times), dtype=get_numpy_dtype(IW.bpConverterTypesC_TimeInfo))
+    data['mJulianDay'] = days.astype(np.int64) + _julian_day_epoch
+    data['mNanosecondsOfDay'] = (times - days).astype(np.int64)
+    time_infos = get_c_array(IW.bpConverterTypesC_TimeInfo, data)
+    return IW.bpConverterTypesC_TimeInfosPtr(IW.bpConverterTypesC_TimeInfos(time_infos, len(data)))
+
+
+def get_c_color_infos(ranges, colors=None, opacity=0, gamma=1):
+    """
+    ranges: structured array with fields 'min' and 'max' (or an array of shape (channels, 2)),
+    colors: base colors as array of shape (channels, 4) with rgba in [0, 1], default red, green, blue, ...
+    opacity, gamma: scalars or one value per channel
+    """
+    ranges = np.asarray(ranges)
+    if ranges.dtype.names is None:
+        range_min, range_max = ranges[:, 0], ranges[:, 1]
+    else:
+        range_min, range_max = ranges['min'], ranges['max']
+    num_channels = len(range_min)
+    if colors is None:
+        colors = np.zeros((num_channels, 4), dtype=np.float32)
+        colors[np.arange(num_channels), np.arange(num_channels) % 3] = 1
+        colors[:, 3] = 1
+    colors = np.asarray(colors, dtype=np.float32)
+
+    data = np.zeros(num_channels, dtype=get_numpy_dtype(IW.bpConverterTypesC_ColorInfo))
+    data['mIsBaseColorMode'] = True
+    for index, name in enumerate(('mRed', 'mGreen', 'mBlue', 'mAlpha')):
+        data['mBaseColor'][name] = colors[:, index]
+    data['mOpacity'] = opacity
+    data['mRangeMin'] = range_min
+    data['mRangeMax'] = range_max
+    data['mGammaCorrection'] = gamma
+    color_infos = get_c_array(IW.bpConverterTypesC_ColorInfo, data)
+    return IW.bpConverterTypesC_ColorInfosPtr(IW.bpConverterTypesC_ColorInfos(color_infos, num_channels))
+
+
+class CParameters:
+    """Parameter sections for Finish, a section is only encoded again after one of its values changed"""
+
+    def __init__(self, parameters=None):
+        self.mSections = {}
+        self.mEncodedSections = {}
+        self.mCParameters = None
+        if parameters is not None:
+            self.update(parameters)
+
+    def set_value(self, section_name, parameter_name, value):
+        section = self.mSections.setdefault(section_name, {})
+        value = str(value)
+        if section.get(parameter_name) != value:
+            section[parameter_name] = value
+            self.mEncodedSections.pop(section_name, None)
+            self.mCParameters = None
+
+    def update(self, parameters):
+        """Sets all values of a PW.Parameters"""
+        for section_name, section in parameters.mSections.items():
+            for parameter_name, value in section.items():
+                self.set_value(section_name, parameter_name, value)
+
+    def _encode_section(self, section_name, section):
+        values = (IW.bpConverterTypesC_Parameter * len(section))()
+        for index, (name, value) in enumerate(section.items()):
+            values[index] = IW.bpConverterTypesC_Parameter(name.encode(), value.encode())
+        encoded = IW.bpConverterTypesC_ParameterSection()
+        encoded.mName = section_name.encode()
+        encoded.mValues = values
+        encoded.mValuesCount = len(section)
+        return encoded
+
+    def get_c_parameters(self):
+        if self.mCParameters is None:
+            sections = (IW.bpConverterTypesC_ParameterSection * len(self.mSections))()
+            for index, (section_name, section) in enumerate(self.mSections.items()):
+                encoded = self.mEncodedSections.get(section_name)
+                if encoded is None:
+                    encoded = self._encode_section(section_name, section)
+                    self.mEncodedSections[section_name] = encoded
+                sections[index] = encoded
+            self.mCParameters = IW.bpConverterTypesC_ParametersPtr(
+                IW.bpConverterTypesC_Parameters(sections, len(self.mSections)))
+        return self.mCParameters
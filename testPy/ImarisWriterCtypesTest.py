@@ -18,17 +18,16 @@
 Python Version of bpImarisWriter96TestProgram.c that uses ImarisWriterCtypes
 """
 
-import platform
 import sys
 
+import numpy as np
+
 from PyImarisWriter import ImarisWriterCtypes as IW
+from PyImarisWriter import PyImarisWriter as PW
+import ImarisWriterCtypesLibrary as IWL
 
-def check_errors(cdll, imageconverter_ptr):
-    cdll.bpImageConverterC_GetLastException.restype = IW.c_char_p
-    last_exception = cdll.bpImageConverterC_GetLastException(imageconverter_ptr)
-    if last_exception:
-        print('Error occured, exiting application.\nError: "{}"'.format(last_exception.decode()))
-        sys.exit(1)
+# check for errors every that many blocks, 1 checks after every block (for debugging)
+check_every_blocks = 64
 
           
 # class PySize5D
@@ -67,7 +66,7 @@ def num_blocks_1D(size, block_size):
     return int((size + block_size - 1) / block_size)
     
 import random
-def copy_blocks(cdll, imageconverter_ptr, image_size, block_size):
+def copy_blocks(cdll, error_checker, imageconverter_ptr, image_size, block_size):
     num_voxels_per_block = block_size.mValueX * block_size.mValueY * block_size.mValueZ * block_size.mValueC * block_size.mValueT
     voxel_data = (IW.c_ubyte * num_voxels_per_block)()
     for i in range(num_voxels_per_block):
@@ -80,6 +79,7 @@ def copy_blocks(cdll, imageconverter_ptr, image_size, block_size):
     num_blocks_c = num_blocks_1D(image_size.mValueC, block_size.mValueC)
     num_blocks_t = num_blocks_1D(image_size.mValueT, block_size.mValueT)
     
+    copy_block = cdll.bpImageConverterC_CopyBlockUInt8
     block_index = IW.bpConverterTypesC_Index5D(0, 0, 0, 0, 0)
     for c in range(num_blocks_c):
         block_index.mValueC = c
@@ -92,8 +92,9 @@ def copy_blocks(cdll, imageconverter_ptr, image_size, block_size):
                     for x in range(num_blocks_x):
                         block_index.mValueX = x
                         block_index_ptr = IW.bpConverterTypesC_Index5DPtr(block_index)
-                        cdll.bpImageConverterC_CopyBlockUInt8(imageconverter_ptr, voxel_data, block_index_ptr)
-                        check_errors(cdll, imageconverter_ptr)
+                        copy_block(imageconverter_ptr, voxel_data, block_index_ptr)
+                        error_checker.record_block((x, y, z, c, t), num_voxels_per_block)
+    error_checker.check()
         
 def get_channel_name(channel_index):
     if channel_index == 0:
@@ -105,82 +106,49 @@ def get_channel_name(channel_index):
     else:
         return 'Other channel'
 
-def create_parameter(name, value):
-    return IW.bpConverterTypesC_Parameter(name.encode(), value.encode())
-    
 def get_parameters(num_channels):
-    number_of_other_sections = 1 # Image
-    number_of_sections = number_of_other_sections + num_channels
-    parameter_section_data = (IW.bpConverterTypesC_ParameterSection * number_of_sections)()
-    unit_parameter = IW.bpConverterTypesC_ParameterPtr(IW.bpConverterTypesC_Parameter(b'Unit', b'um'))
-    image_parameter_section = IW.bpConverterTypesC_ParameterSection()
-    image_parameter_section.mName = b'Image'
-    image_parameter_section.mValues = unit_parameter
-    image_parameter_section.mValuesCount = 1
-    parameter_section_data[0] = image_parameter_section
-    
-    num_parameters_per_channel = 3
+    parameters = IWL.CParameters()
+    parameters.set_value('Image', 'Unit', 'um')
     for c in range(num_channels):
-        section_index = number_of_other_sections + c
-        
-        channel_parameter_section = IW.bpConverterTypesC_ParameterSection()
-        name_parameter = create_parameter('Name', get_channel_name(c))
-        emission_parameter = create_parameter('LSMEmissionWavelength', str(700))
-        other_parameter = create_parameter('OtherChannelParameter', 'OtherChannelValue')
-        
-        channel_parameter_data = (IW.bpConverterTypesC_Parameter * num_parameters_per_channel)()
-        channel_parameter_data[0] = name_parameter
-        channel_parameter_data[1] = emission_parameter
-        channel_parameter_data[2] = other_parameter
-        channel_parameter_section.mName = 'Channel {}'.format(c).encode()
-        channel_parameter_section.mValues = channel_parameter_data
-        channel_parameter_section.mValuesCount = num_parameters_per_channel
-        parameter_section_data[section_index] = channel_parameter_section
-        
-    parameters = IW.bpConverterTypesC_ParametersPtr(IW.bpConverterTypesC_Parameters(parameter_section_data, number_of_sections))
-    return parameters
+        section_name = 'Channel {}'.format(c)
+        parameters.set_value(section_name, 'Name', get_channel_name(c))
+        parameters.set_value(section_name, 'LSMEmissionWavelength', 700)
+        parameters.set_value(section_name, 'OtherChannelParameter', 'OtherChannelValue')
+    return parameters.get_c_parameters()
 
 def get_time_infos(num_time_infos):
-    time_info_data = (IW.bpConverterTypesC_TimeInfo * num_time_infos)()
-    
-    julian_day = 2458885 # 5 feb 2020
-    t = 0
-    seconds = t + 4 + 60 * (27 + 60 * 15) # 3:27.04 PM + 1 sec per time point
-    for t in range(num_time_infos):
-        nanoseconds = (seconds + t) * int(1e9)
-        time_info = IW.bpConverterTypesC_TimeInfo(julian_day, nanoseconds)
-        time_info_data[t] = time_info
-    return IW.bpConverterTypesC_TimeInfosPtr(IW.bpConverterTypesC_TimeInfos(time_info_data, num_time_infos))
+    # 5 feb 2020 3:27.04 PM + 1 sec per time point
+    start = np.datetime64('2020-02-05T15:27:04')
+    return IWL.get_c_time_infos(start + np.arange(num_time_infos) * np.timedelta64(1, 's'))
 
 def get_color_infos(num_color_infos):
-    color_info_data = (IW.bpConverterTypesC_ColorInfo * num_color_infos)()
-    for c in range(num_color_infos):
-        color = IW.bpConverterTypesC_Color()
-        color.mRed = 1 if (c % 3 == 0) else 0
-        color.mGreen = 1 if (c % 3 == 1) else 0
-        color.mBlue = 1 if (c % 3 == 2) else 0
-        color.mAlpha = 1
-        color_info = IW.bpConverterTypesC_ColorInfo()
-        color_info.mIsBaseColorMode = True
-        color_info.mBaseColor = color
-        color_info.mColorTableSize = 0
-        color_info.mOpacity = 0
-        color_info.mRangeMin = 0
-        color_info.mRangeMax = 255
-        color_info.mGammaCorrection = 1
-        color_info_data[c] = color_info
-        
-    return IW.bpConverterTypesC_ColorInfosPtr(IW.bpConverterTypesC_ColorInfos(color_info_data, num_color_infos))
+    ranges = np.zeros(num_color_infos, dtype=[('min', np.float32), ('max', np.float32)])
+    ranges['max'] = 255
+    return IWL.get_c_color_infos(ranges)
+
+# address of the user data of a live converter -> its bpCallbackData, removed after Destroy
+callback_data = {}
+
+error_checkers = {}
+
+def get_callback_data(user_data):
+    # registered converters need no cast per progress update
+    data = callback_data.get(user_data)
+    if data is None:
+        data = IW.cast(user_data, IW.bpCallbackDataPtr).contents
+    return data
 
 def ProgressCallback(progress, total_bytes_written, user_data):
-    data = IW.cast(user_data, IW.bpCallbackDataPtr)
+    data = get_callback_data(user_data)
+    
+    image_index = data.mImageIndex
+    if image_index in error_checkers:
+        error_checkers[image_index].record_bytes_written(total_bytes_written)
     
     progress_percentage = int(progress * 100)
-    if progress_percentage - data.contents.mProgress < 5:
+    if progress_percentage - data.mProgress < 5:
         return
     
-    image_index = data.contents.mImageIndex
-    
     if total_bytes_written < 10 * 1024 * 1024:
         data_written = total_bytes_written / 1024
         unit = 'KB'
@@ -189,11 +157,9 @@ def ProgressCallback(progress, total_bytes_written, user_data):
         unit = 'MB'
     print('Progress image {}: {}% [{:.0f} {}]'.format(image_index, progress_percentage, data_written, unit))
     
-    data.contents.mProgress = progress_percentage
-
-bpConverterTypesC_ProgressCallback = IW.CFUNCTYPE(IW.c_void_p, IW.c_float, IW.c_ulonglong, IW.c_void_p)
+    data.mProgress = progress_percentage
 
-callback_function = bpConverterTypesC_ProgressCallback(ProgressCallback)
+callback_function = IWL.bpConverterTypesC_ProgressCallback(ProgressCallback)
 
 def print_user_data(title, user_data):
     print('{} userdata progress: {}, image index: {}'.format(
@@ -201,21 +167,9 @@ def print_user_data(title, user_data):
     user_data.mProgress,
     user_data.mImageIndex))
 
-def get_dll_filename():
-    if platform.system() == 'Windows':
-        return 'bpImarisWriter96.dll'
-    elif platform.system() == 'Darwin':
-        return 'libbpImarisWriter96.dylib'
-    elif platform.system() == 'Linux':
-        return 'libbpImarisWriter96.so'
-    else:
-        print('Platform not supported: "{}"'.format(platform.system()))
-        return None
-    
-def test_convert(test_index):
-    dll_filename = get_dll_filename()
-    print('Loading dll: {}'.format(dll_filename))
-    cdll = IW.CDLL(dll_filename)
+def test_convert(test_index, check_every=check_every_blocks):
+    # loaded once, with argtypes and restype already bound
+    cdll = IWL.get_library()
     
     callback_userdata = IW.bpCallbackData()
     callback_userdata.mImageIndex = test_index
@@ -235,25 +189,31 @@ def test_convert(test_index):
     application_version = IW.c_char_p(b'0.1')
     progress_callback = callback_function
     
-    cdll.bpImageConverterC_Create.restype = IW.bpImageConverterCPtr
     imageconverter_ptr = cdll.bpImageConverterC_Create(datatype, image_size, sample, dimension_sequence, block_size, output_file, options,
                                       application_name, application_version, progress_callback, IW.byref(callback_userdata))
-    check_errors(cdll, imageconverter_ptr)
-    
-    # bpImageConverterC_CopyBlockUInt8
-    copy_blocks(cdll, imageconverter_ptr, image_size.contents, block_size.contents)
-    
-    parameters = get_parameters(image_size.contents.mValueC)
-    time_infos = get_time_infos(image_size.contents.mValueT)
-    color_infos = get_color_infos(image_size.contents.mValueC)
-    adjust_color_range = True
-    
-    # bpImageConverterC_Finish
-    cdll.bpImageConverterC_Finish(imageconverter_ptr, image_extents, parameters, time_infos, color_infos, adjust_color_range)
-    check_errors(cdll, imageconverter_ptr)
-    
-    # bpImageConverterC_Destroy
-    cdll.bpImageConverterC_Destroy(imageconverter_ptr)
+    callback_data[IW.addressof(callback_userdata)] = callback_userdata
+    error_checker = IWL.ErrorChecker(imageconverter_ptr, check_every)
+    error_checkers[test_index] = error_checker
+    try:
+        error_checker.check('Create')
+        
+        # bpImageConverterC_CopyBlockUInt8
+        copy_blocks(cdll, error_checker, imageconverter_ptr, image_size.contents, block_size.contents)
+        
+        parameters = get_parameters(image_size.contents.mValueC)
+        time_infos = get_time_infos(image_size.contents.mValueT)
+        color_infos = get_color_infos(image_size.contents.mValueC)
+        adjust_color_range = True
+        
+        # bpImageConverterC_Finish
+        cdll.bpImageConverterC_Finish(imageconverter_ptr, image_extents, parameters, time_infos, color_infos, adjust_color_range)
+        error_checker.check('Finish')
+    finally:
+        # bpImageConverterC_Destroy
+        cdll.bpImageConverterC_Destroy(imageconverter_ptr)
+        del error_checkers[test_index]
+        # the address may be reused by the user data of a later converter
+        del callback_data[IW.addressof(callback_userdata)]
     
 
 from datetime import datetime
@@ -261,10 +221,15 @@ def print_time(title, time):
     print('{} {}'.format(title, time.strftime("%H:%M:%S")))
     
 def main():
+    print('Loading dll: {}'.format(IWL.get_library_filename()))
     for i in range(1):
         start = datetime.now()
         print_time('start', start)
-        test_convert(i)
+        try:
+            test_convert(i)
+        except PW.PyImarisWriterException as exception:
+            print('Error occured, exiting application.\nError: "{}"'.format(exception))
+            sys.exit(1)
         end = datetime.now()
         print_time('end', end)
         print('Duration {}'.format((end - start).seconds))
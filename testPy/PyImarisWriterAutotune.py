@@ -0,0 +1,212 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+Chooses block size, number of threads and compression for an image by timing short trial writes
+
+Trials write a sub volume of the image (synthetic noise or a sample of the real data) into a
+temporary folder. Results are cached per machine in ~/.cache/PyImarisWriter/autotune.json,
+keyed by the image, the trial parameters and the data type and statistics of the trial data
+(range, mean and standard deviation to two significant digits), so data of a different kind
+runs the trials again.
+"""
+
+import itertools
+import json
+import os
+import platform
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+from PyImarisWriter import PyImarisWriter as PW
+import PyImarisWriterBenchmark as PWBenchmark
+import PyImarisWriterBlocks as PWB
+
+
+default_block_sizes = [(256, 256, 8), (512, 512, 1), (256, 64, 32), (128, 128, 16)]
+
+default_compressions = [PW.eCompressionAlgorithmNone, PW.eCompressionAlgorithmGzipLevel1,
+                        PW.eCompressionAlgorithmGzipLevel2, PW.eCompressionAlgorithmShuffleGzipLevel1,
+                        PW.eCompressionAlgorithmShuffleGzipLevel2, PW.eCompressionAlgorithmLZ4,
+                        PW.eCompressionAlgorithmShuffleLZ4]
+
+default_cache_filename = os.path.join(os.path.expanduser('~'), '.cache', 'PyImarisWriter', 'autotune.json')
+
+
+class TuneResult:
+
+    def __init__(self, block_size, num_threads, compression, mb_per_second, size_ratio):
+        self.mBlockSize = tuple(block_size)
+        self.mNumberOfThreads = num_threads
+        self.mCompressionAlgorithmType = compression
+        self.mMBPerSecond = mb_per_second
+        self.mSizeRatio = size_ratio
+
+    def get_block_size(self):
+        x, y, z = self.mBlockSize
+        return PW.ImageSize(x=x, y=y, z=z, c=1, t=1)
+
+    def apply(self, options):
+        options.mNumberOfThreads = self.mNumberOfThreads
+        options.mCompressionAlgorithmType = self.mCompressionAlgorithmType
+        return options
+
+    def get_dict(self):
+        return {'block_size': list(self.mBlockSize), 'num_threads': self.mNumberOfThreads,
+                'compression': self.mCompressionAlgorithmType, 'mb_per_second': self.mMBPerSecond,
+                'size_ratio': self.mSizeRatio}
+
+
+def get_trial_shape(image_size, max_trial_bytes, itemsize):
+    """(z, y, x) of the trial volume: full xy planes (up to 1024 x 1024) and as many z as fit"""
+    size_x = min(image_size.x, 1024)
+    size_y = min(image_size.y, 1024)
+    size_z = max(1, min(image_size.z, max_trial_bytes // (size_x * size_y * itemsize)))
+    return size_z, size_y, size_x
+
+
+_noise_data_types = {'uint8': '8bit', 'uint16': '16bit', 'uint32': '32bit', 'float32': '16bit'}
+
+
+def get_synthetic_sample(imaris_type, shape, seed=0):
+    np_type = PWB.get_np_type(imaris_type)
+    noise = PWBenchmark.get_noise_block(_noise_data_types[imaris_type], (int(np.prod(shape)) + 1) // 2,
+                                        np.random.default_rng(seed))
+    noise = noise[:int(np.prod(shape))].reshape(shape)
+    if np.issubdtype(np_type, np.integer):
+        # never wrap around when casting to a smaller type
+        noise = np.clip(noise, 0, np.iinfo(np_type).max)
+    return noise.astype(np_type)
+
+
+def get_sample_statistics(sample):
+    """Data type and value statistics of the trial data, part of the cache key"""
+    return '{}/{:.2g}/{:.2g}/{:.2g}/{:.2g}'.format(sample.dtype.str, float(sample.min()), float(sample.max()),
+                                                   float(sample.mean()), float(sample.std()))
+
+
+def run_trial(sample, imaris_type, block_size, num_threads, compression, output_filename):
+    size_z, size_y, size_x = sample.shape
+    image_size = PW.ImageSize(x=size_x, y=size_y, z=size_z, c=1, t=1)
+    block_size = PW.ImageSize(x=min(block_size[0], size_x), y=min(block_size[1], size_y), z=min(block_size[2], size_z), c=1, t=1)
+    dimension_sequence = PW.DimensionSequence('x', 'y', 'z', 'c', 't')
+    sample_size = PW.ImageSize(x=1, y=1, z=1, c=1, t=1)
+
+    options = PW.Options()
+    options.mNumberOfThreads = num_threads
+    options.mCompressionAlgorithmType = compression
+
+    start = time.perf_counter()
+    converter = PWB.ImageConverter(imaris_type, image_size, sample_size, dimension_sequence, block_size,
+                                   output_filename, options, 'PyImarisWriterAutotune', '1.0',
+                                   PWBenchmark.BenchmarkCallbackClass())
+    converter.write_array(sample)
+    converter.Finish(PW.ImageExtents(0, 0, 0, size_x, size_y, size_z), PW.Parameters(), [datetime.today()],
+                     [PW.ColorInfo()], False)
+    converter.Destroy()
+    seconds = time.perf_counter() - start
+
+    num_bytes = sample.size * PWB.get_np_type(imaris_type).itemsize
+    file_size = os.path.getsize(output_filename)
+    os.remove(output_filename)
+    return num_bytes / (1024 * 1024) / seconds, file_size / num_bytes
+
+
+def select(results, min_mb_per_second=None, max_size_ratio=None):
+    """
+    With min_mb_per_second: the smallest file among the results reaching that speed.
+    Otherwise: the fastest result with a size ratio (file size / data size) below max_size_ratio.
+    Falls back to the fastest result if nothing meets the constraint.
+    """
+    if min_mb_per_second is not None:
+        candidates = [result for result in results if result.mMBPerSecond >= min_mb_per_second]
+        if candidates:
+            return min(candidates, key=lambda result: result.mSizeRatio)
+    elif max_size_ratio is not None:
+        candidates = [result for result in results if result.mSizeRatio <= max_size_ratio]
+        if candidates:
+            return max(candidates, key=lambda result: result.mMBPerSecond)
+    return max(results, key=lambda result: result.mMBPerSecond)
+
+
+def _get_cache_key(image_size, imaris_type, min_mb_per_second, max_size_ratio, block_sizes, threads, compressions,
+                   sample, synthetic):
+    machine = '{}/{}/{}'.format(platform.node(), platform.machine(), os.cpu_count())
+    image = '{}x{}x{}x{}x{}'.format(image_size.x, image_size.y, image_size.z, image_size.c, image_size.t)
+    trials = json.dumps([block_sizes, threads, compressions])
+    data = '{}:{}'.format('synthetic' if synthetic else 'sample', get_sample_statistics(sample))
+    return '|'.join([machine, image, imaris_type, str(min_mb_per_second), str(max_size_ratio), trials, data])
+
+
+def _load_cache(cache_filename):
+    try:
+        with open(cache_filename) as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(cache_filename, cache):
+    os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+    with open(cache_filename, 'w') as cache_file:
+        json.dump(cache, cache_file, indent=2)
+
+
+def autotune(image_size, imaris_type, options, sample=None, min_mb_per_second=None, max_size_ratio=None,
+             block_sizes=None, threads=None, compressions=None, max_trial_bytes=64 * 1024 * 1024,
+             cache_filename=default_cache_filename):
+    """
+    Returns the TuneResult of the best trial. sample is an optional numpy array (z, y, x) of
+    real data, threads defaults to options.mNumberOfThreads and the number of cores.
+    Pass cache_filename=None to always run the trials.
+    """
+    block_sizes = [tuple(block_size) for block_size in (block_sizes or default_block_sizes)]
+    threads = list(threads or sorted({options.mNumberOfThreads, os.cpu_count() or 1}))
+    compressions = list(compressions or default_compressions)
+
+    itemsize = PWB.get_np_type(imaris_type).itemsize
+    trial_shape = get_trial_shape(image_size, max_trial_bytes, itemsize)
+    synthetic = sample is None
+    if synthetic:
+        sample = get_synthetic_sample(imaris_type, trial_shape)
+    else:
+        sample = sample[tuple(slice(0, n) for n in trial_shape)]
+
+    cache = {}
+    if cache_filename is not None:
+        cache = _load_cache(cache_filename)
+        key = _get_cache_key(image_size, imaris_type, min_mb_per_second, max_size_ratio,
+                             block_sizes, threads, compressions, sample, synthetic)
+        if key in cache:
+            cached = cache[key]
+            return TuneResult(cached['block_size'], cached['num_threads'], cached['compression'],
+                              cached['mb_per_second'], cached['size_ratio'])
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        output_filename = os.path.join(directory, 'autotune.ims')
+        for block_size, num_threads, compression in itertools.product(block_sizes, threads, compressions):
+            mb_per_second, size_ratio = run_trial(sample, imaris_type, block_size, num_threads, compression, output_filename)
+            results.append(TuneResult(block_size, num_threads, compression, mb_per_second, size_ratio))
+
+    best = select(results, min_mb_per_second, max_size_ratio)
+    if cache_filename is not None:
+        cache[key] = best.get_dict()
+        _save_cache(cache_filename, cache)
+    return best
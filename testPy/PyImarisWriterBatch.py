@@ -0,0 +1,131 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+Runs many conversions side by side in a process pool
+
+The cores of the machine are split between the running conversions, each job is
+called with the number of threads to put into Options.mNumberOfThreads.
+"""
+
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+
+class ConversionJob:
+    """
+    function(*args, num_threads=...) performs one conversion in a worker process. It must be
+    picklable, i.e. a module level function. num_bytes is the size of the image data (used for
+    MB/s), memory_bytes the memory the conversion is expected to buffer.
+    """
+
+    def __init__(self, name, function, args, num_bytes, memory_bytes=0):
+        self.mName = name
+        self.mFunction = function
+        self.mArgs = args
+        self.mNumBytes = num_bytes
+        self.mMemoryBytes = memory_bytes
+
+
+class JobResult:
+
+    def __init__(self, name, num_bytes, seconds, error=None):
+        self.mName = name
+        self.mNumBytes = num_bytes
+        self.mSeconds = seconds
+        self.mError = error
+
+    def get_mb_per_second(self):
+        return self.mNumBytes / (1024 * 1024) / self.mSeconds if self.mSeconds > 0 else 0.0
+
+
+class BatchResult:
+
+    def __init__(self, job_results, seconds):
+        self.mJobResults = job_results
+        self.mSeconds = seconds
+
+    def get_num_bytes(self):
+        return sum(result.mNumBytes for result in self.mJobResults if result.mError is None)
+
+    def get_mb_per_second(self):
+        return self.get_num_bytes() / (1024 * 1024) / self.mSeconds if self.mSeconds > 0 else 0.0
+
+    def get_failed(self):
+        return [result for result in self.mJobResults if result.mError is not None]
+
+    def print_report(self):
+        for result in self.mJobResults:
+            if result.mError is None:
+                print('{}: {:.1f} MB/s ({:.2f} s)'.format(result.mName, result.get_mb_per_second(), result.mSeconds))
+            else:
+                print('{}: failed: {}'.format(result.mName, result.mError))
+        print('Total: {} jobs, {:.1f} MB/s ({:.2f} s)'.format(len(self.mJobResults), self.get_mb_per_second(), self.mSeconds))
+
+
+def _run_job(function, args, num_threads):
+    start = time.perf_counter()
+    function(*args, num_threads=num_threads)
+    return time.perf_counter() - start
+
+
+class BatchConverter:
+    """
+    Runs up to max_parallel_jobs conversions at once, giving each total_threads / max_parallel_jobs
+    threads. A job is only started while the memory_bytes of the running jobs stay below
+    max_memory_bytes (a single job larger than the cap runs alone).
+    """
+
+    def __init__(self, total_threads=None, max_parallel_jobs=None, max_memory_bytes=None):
+        self.mTotalThreads = total_threads or os.cpu_count() or 1
+        self.mMaxParallelJobs = max_parallel_jobs or max(1, self.mTotalThreads // 4)
+        self.mThreadsPerJob = max(1, self.mTotalThreads // self.mMaxParallelJobs)
+        self.mMaxMemoryBytes = max_memory_bytes
+
+    def _fits(self, job, running_memory, num_running):
+        if num_running == 0:
+            return True
+        if num_running >= self.mMaxParallelJobs:
+            return False
+        return self.mMaxMemoryBytes is None or running_memory + job.mMemoryBytes <= self.mMaxMemoryBytes
+
+    def run(self, jobs):
+        start = time.perf_counter()
+        jobs = list(jobs)
+        queued = list(jobs)
+        running = {}
+        results = {}
+        running_memory = 0
+        with ProcessPoolExecutor(max_workers=self.mMaxParallelJobs) as executor:
+            while queued or running:
+                # jobs are started in order, so that a large job is not starved by smaller ones
+                while queued and self._fits(queued[0], running_memory, len(running)):
+                    job = queued.pop(0)
+                    future = executor.submit(_run_job, job.mFunction, job.mArgs, self.mThreadsPerJob)
+                    running[future] = job
+                    running_memory += job.mMemoryBytes
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    running_memory -= job.mMemoryBytes
+                    try:
+                        results[job] = JobResult(job.mName, job.mNumBytes, future.result())
+                    except Exception as e:
+                        results[job] = JobResult(job.mName, job.mNumBytes, 0.0, e)
+
+        return BatchResult([results[job] for job in jobs], time.perf_counter() - start)
@@ -0,0 +1,224 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+Write throughput benchmark for PyImarisWriter, Python version of ImarisWriterTest.cxx
+
+Accepts the same arguments as the C++ program. -threads, -compression, -blocksize and -type
+take comma separated lists, all combinations are run, e.g.
+
+    python PyImarisWriterBenchmark.py -sizex 400 -sizey 400 -sizez 100 -threads 4,8 -compression 2,31
+        -blocksize 256x256x8,512x512x1 -type 8bit,16bit -randseed 33 -json results.json img.ims
+
+-producers (also a list) sets the number of Python threads calling CopyBlock concurrently,
+e.g. -threads 8 -producers 1,2,4,8. The producers prepare blocks in parallel, the native copies
+are serialized, so this only gains where casting or gathering the blocks is the bottleneck.
+-memory caps the data buffered by the writer (ImageConverter.set_memory_budget), the results
+report the peak buffered data and the peak resident memory of the process, e.g.
+
+    python PyImarisWriterBenchmark.py -sizex 2048 -sizey 2048 -sizez 500 -memory 512 img.ims
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from PyImarisWriter import PyImarisWriter as PW
+import PyImarisWriterBlocks as PWB
+
+
+_data_types = {
+    '8bit': ('uint8', 100.0, 40.0),
+    '16bit': ('uint16', 100.0, 40.0),
+    '32bit': ('uint32', 3000.0, 400.0),
+}
+
+
+class BenchmarkCallbackClass(PW.CallbackClass):
+
+    def RecordProgress(self, progress, total_bytes_written):
+        pass
+
+
+def get_noise_block(data_type, num_voxels, rng):
+    """
+    Noise of ImarisWriterTest.cxx: 2 * num_voxels samples of 0.3 * N(mean, sigma) + 0.7 * previous,
+    where previous is the first sample drawn (as in the C++ program), clipped to [0, 4096].
+    """
+    imaris_type, mean, sigma = _data_types[data_type]
+    correlation_coefficient = 0.7
+    previous = rng.normal(mean, sigma)
+    noise = (1 - correlation_coefficient) * rng.normal(mean, sigma, 2 * num_voxels) + correlation_coefficient * previous
+    np_type = PWB.get_np_type(imaris_type)
+    return np.clip(noise, 0, min(1 << 12, np.iinfo(np_type).max)).astype(np_type)
+
+
+def parse_block_size(text):
+    x, y, z = (int(value) for value in text.lower().split('x'))
+    return PW.ImageSize(x=x, y=y, z=z, c=1, t=1)
+
+
+def get_compression_algorithm(compression):
+    # same fallback as ImarisWriterTest.cxx: unknown values disable compression
+    valid = set(range(1, 10)) | set(range(11, 20)) | {21, 31}
+    return compression if compression in valid else PW.eCompressionAlgorithmNone
+
+
+def get_peak_rss_mb():
+    if resource is None:
+        return None
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_benchmark(image_size, block_size, data_type, num_threads, compression, output_filename, rng, z1=False,
+                  num_producers=1, memory_mb=None):
+    imaris_type = _data_types[data_type][0]
+    dimension_sequence = PW.DimensionSequence('x', 'y', 'z', 'c', 't')
+    sample_size = PW.ImageSize(x=1, y=1, z=1, c=1, t=1)
+
+    options = PW.Options()
+    options.mNumberOfThreads = num_threads
+    options.mCompressionAlgorithmType = get_compression_algorithm(compression)
+    # passed as mForceFileBlockSizeZ1 by PWB.ImageConverter._store_options
+    options.mForceFileBlockSizeZ = z1
+
+    grid = PWB.BlockGrid(image_size, block_size, dimension_sequence)
+    file_block = get_noise_block(data_type, grid.mBlockNumVoxels, rng)
+    offsets = rng.integers(0, grid.mBlockNumVoxels, grid.get_num_blocks(), endpoint=True)
+    num_bytes = math.prod(grid.mImageShape) * file_block.itemsize
+
+    start = time.perf_counter_ns()
+    converter = PWB.ImageConverter(imaris_type, image_size, sample_size, dimension_sequence, block_size,
+                                   output_filename, options, 'PyImarisWriterBenchmark', '1.0', BenchmarkCallbackClass())
+    if memory_mb:
+        converter.set_memory_budget(memory_mb)
+
+    def copy_block(block, offset):
+        converter.CopyBlock(file_block[offset:offset + grid.mBlockNumVoxels], grid.get_block_index(block))
+
+    if num_producers <= 1:
+        for block, offset in zip(grid.iter_blocks(), offsets):
+            copy_block(block, offset)
+    else:
+        with ThreadPoolExecutor(max_workers=num_producers) as executor:
+            list(executor.map(copy_block, grid.iter_blocks(), offsets))
+
+    parameters = PW.Parameters()
+    parameters.set_value('Image', 'ImageSizeInMB', num_bytes // (1024 * 1024))
+    image_extents = PW.ImageExtents(0, 0, 0, 10, 10, 10)
+    time_infos = [datetime.today()] * image_size.t
+    color_infos = [PW.ColorInfo() for _ in range(image_size.c)]
+    converter.Finish(image_extents, parameters, time_infos, color_infos, False)
+    memory_report = converter.get_memory_report()
+    converter.Destroy()
+    seconds = (time.perf_counter_ns() - start) / 1e9
+
+    file_size = os.path.getsize(output_filename)
+    return {
+        'sizex': image_size.x, 'sizey': image_size.y, 'sizez': image_size.z, 'sizec': image_size.c, 'sizet': image_size.t,
+        'type': data_type,
+        'threads': num_threads,
+        'producers': num_producers,
+        'compression': options.mCompressionAlgorithmType,
+        'blocksize': '{}x{}x{}'.format(block_size.x, block_size.y, block_size.z),
+        'MB': num_bytes / (1024 * 1024),
+        'seconds': seconds,
+        'MBps': num_bytes / (1024 * 1024) / seconds,
+        'file_size': file_size,
+        'compression_ratio': num_bytes / file_size if file_size > 0 else 0.0,
+        'memory_budget_MB': memory_mb,
+        'peak_buffered_MB': (memory_report['peak_buffered_bytes'] or 0) / (1024 * 1024),
+        'peak_rss_MB': get_peak_rss_mb(),
+    }
+
+
+def write_results(results, json_filename, csv_filename):
+    if json_filename:
+        with open(json_filename, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    if csv_filename and results:
+        with open(csv_filename, 'w', newline='') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            writer.writerows(results)
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-sizex', type=int, default=1024, help='Image Size X (default 1024)')
+    parser.add_argument('-sizey', type=int, default=1024, help='Image Size Y (default 1024)')
+    parser.add_argument('-sizez', type=int, default=1, help='Image Size Z (default 1)')
+    parser.add_argument('-sizet', type=int, default=1, help='Image Size T (default 1)')
+    parser.add_argument('-sizec', type=int, default=1, help='Image Size C (default 1)')
+    parser.add_argument('-threads', default='8', help='Number of Threads (default 8)')
+    parser.add_argument('-compression', default='2', help='Compression type and level (default 2)')
+    parser.add_argument('-blocksize', default='256x256x8', help='Block size XxYxZ (default 256x256x8)')
+    parser.add_argument('-type', default='16bit', help='DataType 8bit, 16bit or 32bit (default 16bit)')
+    parser.add_argument('-producers', default='1', help='Number of threads calling CopyBlock (default 1)')
+    parser.add_argument('-memory', type=int, default=None, help='Memory budget of the writer in MB')
+    parser.add_argument('-outputpath', default='.', help='Set the output folder')
+    parser.add_argument('-randseed', type=int, default=None, help='Fix seed for random number to reproduce results')
+    parser.add_argument('-z1', action='store_true', help='Force block size Z = 1')
+    parser.add_argument('-json', default=None, help='Write results as JSON')
+    parser.add_argument('-csv', default=None, help='Write results as CSV')
+    parser.add_argument('-keep', action='store_true', help='Keep the written files')
+    parser.add_argument('outfile', nargs='?', default='PyImarisWriterBenchmark.ims')
+    return parser
+
+
+def main():
+    args = get_argument_parser().parse_args()
+    image_size = PW.ImageSize(x=args.sizex, y=args.sizey, z=args.sizez, c=args.sizec, t=args.sizet)
+    rng = np.random.default_rng(args.randseed)
+
+    stem, extension = os.path.splitext(args.outfile)
+    sweep = itertools.product(args.threads.split(','), args.compression.split(','),
+                              args.blocksize.split(','), args.type.split(','), args.producers.split(','))
+    results = []
+    for run_index, (threads, compression, block_size, data_type, producers) in enumerate(sweep):
+        if data_type not in _data_types:
+            raise PW.PyImarisWriterException('Unsupported type "{}"'.format(data_type))
+        output_filename = os.path.join(args.outputpath, '{}_{}{}'.format(stem, run_index, extension))
+        result = run_benchmark(image_size, parse_block_size(block_size), data_type, int(threads), int(compression),
+                               output_filename, rng, args.z1, int(producers), args.memory)
+        print('Writer: threads {threads} producers {producers} compression {compression} block {blocksize} {type}  MB: {MB:.0f}'
+              '     Time[ms]: {ms:.1f}  MB/s: {MBps:.1f}  ratio: {compression_ratio:.2f}'.format(ms=result['seconds'] * 1000, **result))
+        if args.memory:
+            print('        budget MB: {memory_budget_MB}  peak buffered MB: {peak_buffered_MB:.0f}  peak RSS MB: {peak_rss_MB}'
+                  .format(**result))
+        results.append(result)
+        if not args.keep:
+            os.remove(output_filename)
+
+    write_results(results, args.json, args.csv)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,661 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+NumPy block helpers for PyImarisWriter.ImageConverter
+
+Numpy arrays are indexed slowest dimension first, i.e. an image written with
+DimensionSequence('x', 'y', 'z', 'c', 't') is a C-ordered array of shape (t, c, z, y, x).
+
+ImageConverter.CopyBlock can be called from several producer threads for different block
+indices. Casting/gathering into the staging buffer runs in parallel (NumPy releases the GIL
+while copying), only the native copy is serialized. ctypes releases the GIL during that call.
+
+PW.ImageConverter checks the last native exception after every call, ImageConverter.set_error_check
+defers that check for CopyBlock to every N blocks.
+"""
+
+import copy
+import itertools
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from PyImarisWriter import ImarisWriterCtypes as IW
+from PyImarisWriter import PyImarisWriter as PW
+
+import ImarisWriterCtypesLibrary as IWL
+from PyImarisWriterChannelStats import ChannelStatistics
+from PyImarisWriterJournal import ConversionJournal
+from PyImarisWriterPipeline import BlockPipeline, WriterBacklog
+from PyImarisWriterProgress import ProgressPoller, ProgressRecorder
+import PyImarisWriterStats as PWStats
+from PyImarisWriterTransform import IntensityTransform
+from PyImarisWriterVerify import BlockChecksums
+
+
+_np_types = {
+    'uint8': np.uint8,
+    'uint16': np.uint16,
+    'uint32': np.uint32,
+    'float32': np.float32,
+}
+
+
+# how CopyBlock handed the block data to the native writer
+COPY_MODE_ZERO_COPY = 'zero-copy'
+COPY_MODE_CAST = 'cast'
+COPY_MODE_GATHER = 'gather'
+COPY_MODE_CONSTANT_BUFFER = 'constant-buffer'
+
+
+def get_np_type(imaris_type):
+    if imaris_type not in _np_types:
+        raise PW.PyImarisWriterException('Unsupported image type: "{}"'.format(imaris_type))
+    return np.dtype(_np_types[imaris_type])
+
+
+def copy_block_index(block_index):
+    return PW.ImageSize(x=block_index.x, y=block_index.y, z=block_index.z, c=block_index.c, t=block_index.t)
+
+
+def _get_labels(np_data, axes):
+    labels = [axis.lower() for axis in axes]
+    if len(labels) != np_data.ndim or len(set(labels)) != len(labels) or not set(labels) <= set('xyzct'):
+        raise PW.PyImarisWriterException('Axes "{}" do not label the {} dimensions of the array'.format(
+            axes, np_data.ndim))
+    return labels
+
+
+def get_axes_sequence(axes):
+    """DimensionSequence describing the numpy axes of an array labelled e.g. 'zyx' (slowest first)"""
+    sequence = [axis.lower() for axis in axes[::-1]]
+    return PW.DimensionSequence(*(sequence + [axis for axis in 'xyzct' if axis not in sequence]))
+
+
+def get_memory_sequence(np_data, axes):
+    """
+    DimensionSequence of the memory order of np_data, fastest first, derived from its strides.
+    axes labels the numpy dimensions (e.g. 'zyx'), missing dimensions and dimensions of size 1
+    are put last.
+    """
+    labels = _get_labels(np_data, axes)
+    order = sorted(range(np_data.ndim), key=lambda i: (np_data.shape[i] == 1, abs(np_data.strides[i]), -i))
+    sequence = [labels[i] for i in order]
+    return PW.DimensionSequence(*(sequence + [axis for axis in 'xyzct' if axis not in sequence]))
+
+
+def get_block_size(image_size, dimension_sequence, max_block_voxels=256 * 256 * 8):
+    """Block size extending along the fastest dimensions first (c and t blocks are 1)"""
+    extents = {'c': 1, 't': 1}
+    remaining = max_block_voxels
+    for axis in dimension_sequence.get_sequence():
+        if axis in 'xyz':
+            extents[axis] = max(1, min(getattr(image_size, axis), remaining))
+            remaining = max(1, remaining // extents[axis])
+    return PW.ImageSize(**extents)
+
+
+def get_array_layout(np_data, axes, max_block_voxels=256 * 256 * 8):
+    """
+    Returns (image_size, dimension_sequence, block_size, axes_sequence) to write np_data, labelled
+    by axes (e.g. 'zyx' for a (z, y, x) array), in its memory order. Pass dimension_sequence and
+    block_size to the ImageConverter and axes_sequence to write_array: the array is then only
+    viewed, never transposed into a copy, also for Fortran ordered or axis permuted arrays.
+    """
+    labels = _get_labels(np_data, axes)
+    extents = {axis: 1 for axis in 'xyzct'}
+    extents.update(zip(labels, np_data.shape))
+    image_size = PW.ImageSize(**extents)
+    dimension_sequence = get_memory_sequence(np_data, axes)
+    block_size = get_block_size(image_size, dimension_sequence, max_block_voxels)
+    return image_size, dimension_sequence, block_size, get_axes_sequence(axes)
+
+
+class BlockGrid:
+    """Block layout of an image, expressed in numpy axis order"""
+
+    def __init__(self, image_size, block_size, dimension_sequence):
+        self.mSequence = dimension_sequence.get_sequence()
+        self.mAxes = self.mSequence[::-1]
+        self.mImageShape = tuple(getattr(image_size, axis) for axis in self.mAxes)
+        self.mBlockShape = tuple(getattr(block_size, axis) for axis in self.mAxes)
+        self.mNumBlocks = tuple((size + block - 1) // block for size, block in zip(self.mImageShape, self.mBlockShape))
+        self.mBlockNumVoxels = math.prod(self.mBlockShape)
+
+        # one list of slices per axis, so that a block lookup is just tuple indexing
+        self.mAxisSlices = [[slice(i * block, min((i + 1) * block, size)) for i in range(num)]
+                            for size, block, num in zip(self.mImageShape, self.mBlockShape, self.mNumBlocks)]
+
+    def get_num_blocks(self):
+        return math.prod(self.mNumBlocks)
+
+    def iter_blocks(self):
+        # last axis varies fastest, which follows the memory order of the image array
+        return itertools.product(*(range(num) for num in self.mNumBlocks))
+
+    def get_block_slices(self, block):
+        return tuple(slices[i] for slices, i in zip(self.mAxisSlices, block))
+
+    def get_block_index(self, block):
+        return PW.ImageSize(**dict(zip(self.mAxes, block)))
+
+    def get_block(self, block_index):
+        return tuple(getattr(block_index, axis) for axis in self.mAxes)
+
+    def iter_blocks_in_order(self, mask, order=None):
+        """
+        Yields the blocks set in the boolean mask (shaped like mNumBlocks). order lists the
+        dimensions fastest first, e.g. 'zyxct' or a DimensionSequence, and defaults to the
+        dimension sequence of the grid.
+        """
+        if order is None:
+            order_axes = self.mAxes
+        else:
+            sequence = order.get_sequence() if hasattr(order, 'get_sequence') else [axis.lower() for axis in order]
+            order_axes = sequence[::-1]
+        permutation = [self.mAxes.index(axis) for axis in order_axes]
+        positions = np.flatnonzero(mask.transpose(permutation))
+        ordered_blocks = np.unravel_index(positions, [self.mNumBlocks[axis] for axis in permutation])
+        blocks = [None] * len(permutation)
+        for ordered_axis, axis in enumerate(permutation):
+            blocks[axis] = ordered_blocks[ordered_axis].tolist()
+        return zip(*blocks)
+
+    def get_axes(self, dimension_sequence=None):
+        if dimension_sequence is None:
+            return self.mAxes
+        return dimension_sequence.get_sequence()[::-1]
+
+    def as_image_array(self, np_data, dimension_sequence=None):
+        """
+        Returns a 5D view of np_data in the numpy axis order of this grid.
+        Missing leading (slowest) dimensions are added with size 1.
+        """
+        axes = self.get_axes(dimension_sequence)
+        if np_data.ndim > len(axes):
+            raise PW.PyImarisWriterException('Array has {} dimensions, expected at most {}'.format(np_data.ndim, len(axes)))
+        image = np_data[(np.newaxis,) * (len(axes) - np_data.ndim)]
+        if axes != self.mAxes:
+            image = image.transpose([axes.index(axis) for axis in self.mAxes])
+        if image.shape != self.mImageShape:
+            raise PW.PyImarisWriterException('Array shape {} does not match image shape {}'.format(
+                image.shape, self.mImageShape))
+        return image
+
+
+class ImageConverter(PW.ImageConverter):
+    """PW.ImageConverter that can also write whole numpy arrays"""
+
+    def __init__(self, datatype, image_size, sample_size, dimension_sequence, block_size,
+                 output_filename, options, application_name, application_version, progress_callback_class):
+        self.mProgressRecorder = None
+        if hasattr(progress_callback_class, 'RecordProgress'):
+            self.mProgressRecorder = ProgressRecorder(progress_callback_class)
+            progress_callback_class = self.mProgressRecorder
+        super().__init__(datatype, image_size, sample_size, dimension_sequence, block_size,
+                         output_filename, options, application_name, application_version, progress_callback_class)
+        self.mBlockGrid = BlockGrid(image_size, block_size, dimension_sequence)
+        self.mNpType = get_np_type(datatype)
+        self.mOutputPath = output_filename
+        self.mThreadLocal = threading.local()
+        self.mCopyLock = threading.Lock()
+        self.mLastCopyMode = None
+        self.mCopyModeCounts = {COPY_MODE_ZERO_COPY: 0, COPY_MODE_CAST: 0, COPY_MODE_GATHER: 0, COPY_MODE_CONSTANT_BUFFER: 0}
+        self.mReuseConstantBuffers = False
+        self.mConstantBuffers = {}
+        self.mMaxInFlightBytes = 256 * 1024 * 1024
+        self.mPipeline = None
+        self.mStats = None
+        self.mChannelStats = None
+        self.mColorRangeSaturation = 0.0
+        self.mJournal = None
+        self.mChecksums = None
+        self.mChecksumFilename = None
+        self.mBacklog = None
+        self.mTransform = None
+        self.mErrorCheckEvery = 1
+        self.mCopyingBlock = False
+        self.mUncheckedBlocks = 0
+        self.mNumSubmittedBlocks = 0
+        self.mBytesSubmitted = 0
+        self.mLastBlock = None
+        self.mProgressPoller = None
+        self.mNeededBlocks = None
+        self.mCopiedBlocks = np.zeros(self.mBlockGrid.mNumBlocks, dtype=bool)
+
+    def _store_options(self, options):
+        # PW.ImageConverter passes the options by position, which shifts mForceFileBlockSizeZ
+        # and the flips by one field of bpConverterTypesC_Options, so they are passed by name
+        try:
+            c_options = IW.bpConverterTypesC_Options(mThumbnailSizeXY=options.mThumbnailSizeXY,
+                                                     mFlipDimensionX=options.mFlipDimensionX,
+                                                     mFlipDimensionY=options.mFlipDimensionY,
+                                                     mFlipDimensionZ=options.mFlipDimensionZ,
+                                                     mForceFileBlockSizeZ1=options.mForceFileBlockSizeZ,
+                                                     mEnableLogProgress=options.mEnableLogProgress,
+                                                     mNumberOfThreads=options.mNumberOfThreads,
+                                                     mCompressionAlgorithmType=options.mCompressionAlgorithmType)
+        except AttributeError as error:
+            self.raise_creating_clex('Invalid options: {}'.format(error))
+        self.mOptions = IW.bpConverterTypesC_OptionsPtr(c_options)
+
+    def _get_scratch_block(self):
+        # one per producer thread
+        scratch = getattr(self.mThreadLocal, 'scratch_block', None)
+        if scratch is None:
+            scratch = np.empty(self.mBlockGrid.mBlockShape, dtype=self.mNpType)
+            self.mThreadLocal.scratch_block = scratch
+        return scratch
+
+    def _get_block_buffer(self, block_data):
+        """
+        Returns (buffer, copy mode) for block_data. The numpy data pointer is passed through when
+        dtype and layout already match, otherwise the block is cast and/or gathered in one pass
+        into a scratch block that is reused for all calls of the thread. The intensity transform,
+        if set, is applied in the same pass (counted as cast or gather). With mReuseConstantBuffers
+        set, a uniform block is handed over as a cached full block of its value instead, which
+        only saves the Python cast/gather: the native writer still copies and compresses it.
+        """
+        block_shape = self.mBlockGrid.mBlockShape
+        if block_data.ndim == 1 and block_data.size == self.mBlockGrid.mBlockNumVoxels and block_data.flags.c_contiguous:
+            block_data = block_data.reshape(block_shape)
+        elif block_data.ndim < len(block_shape):
+            block_data = block_data[(np.newaxis,) * (len(block_shape) - block_data.ndim)]
+
+        if block_data.ndim != len(block_shape) or any(n > b for n, b in zip(block_data.shape, block_shape)):
+            raise PW.PyImarisWriterException('Block data of shape {} does not fit into block of shape {}'.format(
+                block_data.shape, block_shape))
+
+        transform = self.mTransform
+        if self.mReuseConstantBuffers and transform is None and block_data.size > 0:
+            constant_buffer = self._get_constant_buffer(block_data)
+            if constant_buffer is not None:
+                return constant_buffer, COPY_MODE_CONSTANT_BUFFER
+
+        if block_data.shape == block_shape and block_data.flags.c_contiguous:
+            if block_data.dtype == self.mNpType and transform is None:
+                return block_data, COPY_MODE_ZERO_COPY
+            copy_mode = COPY_MODE_CAST
+        else:
+            # edge blocks and strided views
+            copy_mode = COPY_MODE_GATHER
+
+        scratch = self._get_scratch_block()
+        if block_data.shape != block_shape:
+            scratch.fill(0)
+        target = scratch[tuple(slice(0, n) for n in block_data.shape)]
+        if transform is None:
+            np.copyto(target, block_data, casting='unsafe')
+        else:
+            transform.apply(block_data, target)
+        return scratch, copy_mode
+
+    def _get_constant_buffer(self, block_data):
+        """
+        Returns a cached full block filled with the value of block_data if all its voxels are equal.
+        Comparing first and last voxel rejects most non uniform blocks before the full min/max check.
+        """
+        first = block_data[(0,) * block_data.ndim]
+        if block_data[(-1,) * block_data.ndim] != first or block_data.min() != block_data.max():
+            return None
+        value = np.array(first).astype(self.mNpType).item()
+        constant_buffer = self.mConstantBuffers.get(value)
+        if constant_buffer is None:
+            if len(self.mConstantBuffers) >= 4:
+                self.mConstantBuffers.clear()
+            constant_buffer = np.full(self.mBlockGrid.mBlockShape, value, dtype=self.mNpType)
+            self.mConstantBuffers[value] = constant_buffer
+        return constant_buffer
+
+    def get_copy_mode_counts(self):
+        return dict(self.mCopyModeCounts)
+
+    def enable_stats(self):
+        """Starts collecting PyImarisWriterStats.ConverterStats, returned and available as mStats"""
+        self.mStats = PWStats.ConverterStats()
+        if self.mProgressRecorder is not None:
+            self.mProgressRecorder.mStats = self.mStats
+        return self.mStats
+
+    def enable_channel_stats(self, num_bins=256, saturation=0.0):
+        """
+        Accumulates PyImarisWriterChannelStats.ChannelStatistics of the copied blocks (returned and
+        available as mChannelStats). Finish then passes copies of the ColorInfo with ranges set from
+        them instead of letting the writer adjust the color range, clipping saturation of the voxels
+        at either end.
+        """
+        self.mChannelStats = ChannelStatistics(self.mBlockGrid, self.mNpType, num_bins)
+        self.mColorRangeSaturation = saturation
+        return self.mChannelStats
+
+    def enable_journal(self, directory=None, checkpoint_interval=10.0, read_block=None):
+        """
+        Journals copied blocks in directory (default <output filename>.journal), see
+        PyImarisWriterJournal. If a journal of an interrupted conversion with the same layout
+        exists, its blocks are copied first, NeedCopyBlock and iter_blocks() then only report
+        the missing blocks. Returns the journal (mNumResumedBlocks tells how many were restored).
+        read_block(block) returns the data of a block (a tuple in numpy axis order) from the source,
+        e.g. lambda block: image[grid.get_block_slices(block)]. Then only block indices and CRC32
+        are journaled and completed blocks are read again and verified on resume. Without it every
+        block is also spooled to disk, which doubles the write I/O.
+        """
+        if directory is None:
+            directory = self.mOutputPath + '.journal'
+        grid = self.mBlockGrid
+        journal = ConversionJournal(directory, grid, self.mNpType, checkpoint_interval, spool=read_block is None)
+        if read_block is None:
+            for block, block_data in journal.iter_completed_blocks():
+                self.CopyBlock(block_data, grid.get_block_index(block))
+            self.mJournal = journal
+        else:
+            self.mJournal = journal
+            journal.mVerify = True
+            try:
+                for block in journal.get_completed_blocks():
+                    self.CopyBlock(read_block(block), grid.get_block_index(block))
+            finally:
+                journal.mVerify = False
+        self.mNeededBlocks = None
+        return journal
+
+    def enable_checksums(self, filename=None):
+        """
+        Records a CRC32 per copied block, saved by Finish to filename (default
+        <output filename>.crc32.json) for PyImarisWriterVerify.verify().
+        """
+        self.mChecksums = BlockChecksums(self.mBlockGrid, self.mNpType)
+        self.mChecksumFilename = filename or self.mOutputPath + '.crc32.json'
+        return self.mChecksums
+
+    def set_transform(self, transform=None, **kwargs):
+        """
+        Applies a PyImarisWriterTransform.IntensityTransform (or one built from kwargs: scale,
+        offset, clip, lut) to every block in CopyBlock, replacing a separate conversion of the
+        whole array. Finish records it as 'IntensityTransform' in the Image parameters section.
+        """
+        if transform is None:
+            transform = IntensityTransform(**kwargs)
+        transform.prepare(self.mNpType)
+        self.mTransform = transform
+        return transform
+
+    def set_memory_budget(self, max_mb, max_wait=None):
+        """
+        Blocks CopyBlock while the data buffered by the native writer would exceed max_mb
+        (see PyImarisWriterPipeline.WriterBacklog), also bounds copy_block_async. The native
+        writer does not report its buffers, they are estimated from the progress callback, so
+        a progress callback class is required. The cap is hard and dead locks if the writer
+        needs more than max_mb of blocks before reporting progress. With max_wait set, a block
+        waiting that many seconds without progress is let through instead, which
+        get_memory_report() lists as stalls and bypassed bytes.
+        """
+        if self.mProgressRecorder is None:
+            raise PW.PyImarisWriterException('A memory budget requires a progress callback class')
+        max_bytes = int(max_mb * 1024 * 1024)
+        image_bytes = math.prod(self.mBlockGrid.mImageShape) * np.dtype(self.mNpType).itemsize
+        self.mBacklog = WriterBacklog(image_bytes, max_bytes, max_wait)
+        self.mProgressRecorder.mBacklog = self.mBacklog
+        self.mMaxInFlightBytes = min(self.mMaxInFlightBytes, max_bytes)
+
+    def get_memory_report(self):
+        """Budget, peak of the estimated native buffer, peak of copy_block_async data in flight, stalls and bypassed bytes"""
+        report = {'budget_bytes': None, 'peak_buffered_bytes': None, 'stalls': 0, 'bypassed_bytes': 0,
+                  'peak_in_flight_bytes': self.mPipeline.mBudget.get_peak_bytes() if self.mPipeline is not None else 0}
+        if self.mBacklog is not None:
+            report['budget_bytes'] = self.mBacklog.mMaxBytes
+            report['peak_buffered_bytes'] = self.mBacklog.get_peak_bytes()
+            report['stalls'] = self.mBacklog.mNumStalls
+            report['bypassed_bytes'] = self.mBacklog.mBypassedBytes
+        return report
+
+    def set_error_check(self, check_every=64):
+        """
+        Checks the native exception only after every check_every CopyBlock calls (1 checks every
+        block, for debugging), other calls and Finish check any blocks not checked yet. A failure
+        raises PyImarisWriterException with mBlockIndex (last submitted block), mNumBlocks,
+        mFirstUncheckedBlock (blocks that passed before the failing one), mBytesSubmitted and
+        mBytesWritten (last progress report) set.
+        """
+        self.mErrorCheckEvery = max(1, check_every)
+
+    def _check_errors(self, title='CopyBlock'):
+        # called by PW.ImageConverter after each native call, under mCopyLock for CopyBlock
+        if self.mCopyingBlock:
+            self.mUncheckedBlocks += 1
+            if self.mUncheckedBlocks < self.mErrorCheckEvery:
+                return
+        num_unchecked = self.mUncheckedBlocks
+        self.mUncheckedBlocks = 0
+        if self.mErrorCheckEvery == 1:
+            super()._check_errors(title)
+            return
+        try:
+            super()._check_errors(title)
+        except PW.PyImarisWriterException as exception:
+            raise self._get_error_report(exception, num_unchecked) from exception
+
+    def _get_error_report(self, exception, num_unchecked):
+        first_unchecked = self.mNumSubmittedBlocks - num_unchecked
+        bytes_written = self.mProgressRecorder.mBytesWritten if self.mProgressRecorder is not None else None
+        report = PW.PyImarisWriterException('{} (failed at one of blocks {} to {}, last block {}, {} bytes submitted, '
+                                            '{} bytes written)'.format(exception, first_unchecked + 1,
+                                                                       self.mNumSubmittedBlocks, self.mLastBlock,
+                                                                       self.mBytesSubmitted, bytes_written))
+        report.mBlockIndex = self.mLastBlock
+        report.mNumBlocks = self.mNumSubmittedBlocks
+        report.mFirstUncheckedBlock = first_unchecked
+        report.mBytesSubmitted = self.mBytesSubmitted
+        report.mBytesWritten = bytes_written
+        return report
+
+    def _copy_native_block(self, block_buffer, block_index, block):
+        self.mNumSubmittedBlocks += 1
+        self.mBytesSubmitted += block_buffer.nbytes
+        self.mLastBlock = block
+        self.mCopyingBlock = True
+        try:
+            super().CopyBlock(block_buffer, block_index)
+        finally:
+            self.mCopyingBlock = False
+
+    def set_progress_throttle(self, min_progress_step=0.0, min_interval=0.0):
+        """Drops progress updates advancing less than min_progress_step (0-1) or closer than min_interval seconds"""
+        self.mProgressRecorder.set_throttle(min_progress_step, min_interval)
+
+    def start_progress_poller(self, interval=0.1):
+        """
+        Queues progress updates instead of calling the callback class from the native threads,
+        a Python thread forwards the latest update every interval seconds until Destroy.
+        """
+        if self.mProgressPoller is None:
+            self.mProgressPoller = ProgressPoller(self.mProgressRecorder, interval)
+
+    def NeedCopyBlock(self, block_index):
+        if self.mStats is None:
+            return super().NeedCopyBlock(block_index)
+        start = time.perf_counter()
+        need_copy_block = super().NeedCopyBlock(block_index)
+        self.mStats.record_latency(PWStats.STAGE_NEED_COPY_BLOCK, time.perf_counter() - start)
+        return need_copy_block
+
+    def CopyBlock(self, block_data, block_index):
+        """
+        Accepts numpy arrays or any object supporting the buffer protocol (e.g. ctypes arrays).
+        The block may be smaller than block size at the image border. The copy mode of the call
+        is stored in mLastCopyMode and counted in get_copy_mode_counts().
+        Thread safe for concurrent calls with different block indices. Only the preparation of the
+        blocks (cast, gather, statistics) overlaps, the native copies run one at a time under mCopyLock.
+        """
+        stats = self.mStats
+        if stats is not None:
+            start = time.perf_counter()
+
+        block_buffer, copy_mode = self._get_block_buffer(np.asarray(block_data))
+        block = self.mBlockGrid.get_block(block_index)
+        if self.mChannelStats is not None:
+            self.mChannelStats.add_block(block, block_buffer)
+        if stats is not None:
+            prepared = time.perf_counter()
+            stats.record_latency(PWStats.STAGE_PREPARE, prepared - start)
+        if self.mBacklog is not None:
+            self.mBacklog.acquire(block_buffer.nbytes)
+            if stats is not None:
+                waited = time.perf_counter()
+                stats.record_latency(PWStats.STAGE_BACKLOG_WAIT, waited - prepared)
+                prepared = waited
+
+        with self.mCopyLock:
+            self.mLastCopyMode = copy_mode
+            self.mCopyModeCounts[copy_mode] += 1
+            if stats is None:
+                self._copy_native_block(block_buffer, block_index, block)
+            else:
+                locked = time.perf_counter()
+                self._copy_native_block(block_buffer, block_index, block)
+                stats.record_latency(PWStats.STAGE_LOCK_WAIT, locked - prepared)
+                stats.record_latency(PWStats.STAGE_COPY_BLOCK, time.perf_counter() - locked)
+                # a constant buffer is not copied in Python either, the native copy is the same
+                stats.record_block(block_buffer.nbytes, copy_mode in (COPY_MODE_ZERO_COPY, COPY_MODE_CONSTANT_BUFFER))
+            self.mCopiedBlocks[block] = True
+        if self.mJournal is not None:
+            self.mJournal.record_block(block, block_buffer)
+        if self.mChecksums is not None:
+            self.mChecksums.record_block(block, block_buffer)
+
+    def get_needed_blocks(self):
+        """
+        Boolean array (shaped like mBlockGrid.mNumBlocks) of the blocks the writer needs. The native
+        library only answers per block, so NeedCopyBlock is asked once per block on the first call.
+        """
+        if self.mNeededBlocks is None:
+            grid = self.mBlockGrid
+            self.mNeededBlocks = np.zeros(grid.mNumBlocks, dtype=bool)
+            for block in grid.iter_blocks():
+                self.mNeededBlocks[block] = self.NeedCopyBlock(grid.get_block_index(block))
+        return self.mNeededBlocks
+
+    def get_pending_blocks(self):
+        """Boolean array of the needed blocks that were not copied yet"""
+        return self.get_needed_blocks() & ~self.mCopiedBlocks
+
+    def iter_blocks(self, order=None):
+        """
+        Yields the pending blocks as tuples in numpy axis order (see mBlockGrid.mAxes), in the
+        given order (see BlockGrid.iter_blocks_in_order). Blocks copied meanwhile are skipped,
+        so a new iterator continues where an interrupted one stopped.
+        """
+        copied_blocks = self.mCopiedBlocks
+        for block in self.mBlockGrid.iter_blocks_in_order(self.get_pending_blocks(), order):
+            if not copied_blocks[block]:
+                yield block
+
+    def copy_block_async(self, block_data, block_index):
+        """
+        Queues the block for CopyBlock on a writer thread and returns a concurrent.futures.Future.
+        Blocks while more than mMaxInFlightBytes are queued. block_data must not be modified until
+        the future is done. Synchronous CopyBlock calls from other threads may run meanwhile (the
+        native copies are serialized by mCopyLock), as long as they copy other block indices.
+        """
+        if self.mPipeline is None:
+            self.mPipeline = BlockPipeline(self.CopyBlock, self.mMaxInFlightBytes)
+        return self.mPipeline.submit(block_data, copy_block_index(block_index))
+
+    def flush_async(self):
+        if self.mPipeline is not None:
+            self.mPipeline.flush()
+
+    def _get_c_time_infos(self, time_infos):
+        # filled in bulk from a datetime64 array instead of one struct per time point
+        return IWL.get_c_time_infos(time_infos)
+
+    def _get_c_color_infos(self, color_infos):
+        if any(not color_info.mIsBaseColorMode or color_info.mColorTableList for color_info in color_infos):
+            # color tables need a ctypes array each, left to PW.ImageConverter
+            return super()._get_c_color_infos(color_infos)
+        ranges = [(color_info.mRangeMin, color_info.mRangeMax) for color_info in color_infos]
+        colors = [(color_info.mBaseColor.mRed, color_info.mBaseColor.mGreen, color_info.mBaseColor.mBlue,
+                   color_info.mBaseColor.mAlpha) for color_info in color_infos]
+        opacity = [color_info.mOpacity for color_info in color_infos]
+        gamma = [color_info.mGammaCorrection for color_info in color_infos]
+        return IWL.get_c_color_infos(ranges, colors, opacity, gamma)
+
+    def Finish(self, image_extents, parameters, time_infos, color_infos, adjust_color_range):
+        """
+        The color ranges of the channel statistics and the transform parameter are set on
+        copies of color_infos and parameters, the objects of the caller are left unchanged.
+        """
+        self.flush_async()
+        if self.mUncheckedBlocks > 0:
+            self._check_errors('CopyBlock (checked by Finish)')
+        if self.mChannelStats is not None and adjust_color_range:
+            color_infos = [copy.copy(color_info) for color_info in color_infos]
+            self.mChannelStats.apply_color_ranges(color_infos, self.mColorRangeSaturation)
+            adjust_color_range = False
+        if self.mTransform is not None:
+            parameters = copy.deepcopy(parameters)
+            parameters.set_value('Image', 'IntensityTransform', self.mTransform.mDescription)
+        start = time.perf_counter()
+        super().Finish(image_extents, parameters, time_infos, color_infos, adjust_color_range)
+        if self.mStats is not None:
+            self.mStats.record_latency(PWStats.STAGE_FINISH, time.perf_counter() - start)
+        if self.mJournal is not None:
+            self.mJournal.remove()
+            self.mJournal = None
+        if self.mChecksums is not None:
+            self.mChecksums.save(self.mChecksumFilename)
+        self.mChecksums = None
+        self.mChecksumFilename = None
+        self.mBacklog = None
+
+    def Destroy(self):
+        if self.mPipeline is not None:
+            self.mPipeline.shutdown()
+            self.mPipeline = None
+        if self.mJournal is not None:
+            # not finished, keep what was copied for the next attempt
+            self.mJournal.checkpoint()
+            self.mJournal = None
+        self.mChecksums = None
+        self.mChecksumFilename = None
+        self.mBacklog = None
+        super().Destroy()
+        if self.mProgressPoller is not None:
+            self.mProgressPoller.stop()
+            self.mProgressPoller = None
+
+    def write_array(self, np_data, dimension_sequence=None, num_producers=1):
+        """
+        Writes all blocks of np_data. dimension_sequence describes the memory order of np_data
+        and defaults to the dimension sequence of the converter. With num_producers > 1 the
+        blocks are submitted from that many threads.
+        """
+        grid = self.mBlockGrid
+        image = grid.as_image_array(np_data, dimension_sequence)
+
+        def copy_block(block):
+            self.CopyBlock(image[grid.get_block_slices(block)], grid.get_block_index(block))
+
+        if num_producers <= 1:
+            for block in self.iter_blocks():
+                copy_block(block)
+        else:
+            with ThreadPoolExecutor(max_workers=num_producers, thread_name_prefix='PyImarisWriterProducer') as executor:
+                # list() raises the first exception of the producers
+                list(executor.map(copy_block, list(self.iter_blocks())))
@@ -0,0 +1,105 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+Per channel statistics accumulated while blocks are copied
+
+Min and max are kept per channel and time point, histograms (integer types only) per
+channel over the full range of the data type. ImageConverter.Finish uses them to set the
+ColorInfo ranges, so the display range needs no second pass over the data.
+"""
+
+import threading
+
+import numpy as np
+
+
+class ChannelStatistics:
+
+    def __init__(self, grid, np_type, num_bins=256):
+        self.mGrid = grid
+        self.mChannelAxis = grid.mAxes.index('c')
+        self.mTimeAxis = grid.mAxes.index('t')
+        num_channels = grid.mImageShape[self.mChannelAxis]
+        num_timepoints = grid.mImageShape[self.mTimeAxis]
+        self.mMin = np.full((num_channels, num_timepoints), np.inf)
+        self.mMax = np.full((num_channels, num_timepoints), -np.inf)
+
+        self.mHistograms = None
+        self.mBinWidth = None
+        if np.issubdtype(np_type, np.integer):
+            if num_bins & (num_bins - 1):
+                raise ValueError('num_bins must be a power of two, not {}'.format(num_bins))
+            self.mShift = max(0, np.dtype(np_type).itemsize * 8 - (num_bins.bit_length() - 1))
+            self.mBinWidth = 1 << self.mShift
+            self.mHistograms = np.zeros((num_channels, min(num_bins, 1 << (np.dtype(np_type).itemsize * 8))),
+                                        dtype=np.int64)
+        self.mLock = threading.Lock()
+
+    def add_block(self, block, block_buffer):
+        """block_buffer is the full (possibly padded) block, only the part inside the image is counted"""
+        slices = self.mGrid.get_block_slices(block)
+        data = block_buffer[tuple(slice(0, s.stop - s.start) for s in slices)]
+        if data.size == 0:
+            return
+        # (t, c, voxels)
+        data = np.moveaxis(data, (self.mTimeAxis, self.mChannelAxis), (0, 1))
+        data = data.reshape(data.shape[0], data.shape[1], -1)
+        block_min = data.min(axis=2).T
+        block_max = data.max(axis=2).T
+
+        histograms = None
+        if self.mHistograms is not None:
+            num_bins = self.mHistograms.shape[1]
+            histograms = [np.bincount((data[:, c].ravel() >> self.mShift), minlength=num_bins)
+                          for c in range(data.shape[1])]
+
+        channels = slices[self.mChannelAxis]
+        timepoints = slices[self.mTimeAxis]
+        with self.mLock:
+            range_min = self.mMin[channels, timepoints]
+            np.minimum(range_min, block_min, out=range_min)
+            range_max = self.mMax[channels, timepoints]
+            np.maximum(range_max, block_max, out=range_max)
+            if histograms is not None:
+                self.mHistograms[channels] += histograms
+
+    def get_min(self, channel):
+        return float(self.mMin[channel].min())
+
+    def get_max(self, channel):
+        return float(self.mMax[channel].max())
+
+    def get_color_range(self, channel, saturation=0.0):
+        """
+        (min, max) of the channel over all time points. With saturation > 0 (integer types only)
+        that fraction of the voxels is clipped at either end, to the precision of the histogram bins.
+        """
+        range_min, range_max = self.get_min(channel), self.get_max(channel)
+        if saturation <= 0 or self.mHistograms is None or not np.isfinite(range_min):
+            return range_min, range_max
+        cumulative = np.cumsum(self.mHistograms[channel]) / self.mHistograms[channel].sum()
+        lower = int(np.searchsorted(cumulative, saturation, side='right')) * self.mBinWidth
+        upper = (int(np.searchsorted(cumulative, 1 - saturation, side='left')) + 1) * self.mBinWidth - 1
+        return max(range_min, float(lower)), min(range_max, float(upper))
+
+    def apply_color_ranges(self, color_infos, saturation=0.0):
+        """Sets mRangeMin and mRangeMax of the ColorInfo of every channel that received data"""
+        for channel, color_info in enumerate(color_infos):
+            range_min, range_max = self.get_color_range(channel, saturation)
+            if range_min <= range_max:
+                color_info.mRangeMin = range_min
+                color_info.mRangeMax = range_max
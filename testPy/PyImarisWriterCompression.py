@@ -0,0 +1,140 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+Content adaptive choice of the compression algorithm
+
+The first blocks of every channel are sampled to estimate entropy and compressibility
+(with and without byte shuffle, using zlib as a stand-in for the writer's codecs).
+Options.mCompressionAlgorithmType applies to the whole file, so the per channel
+recommendations are combined into one algorithm, weighted by the bytes they would save.
+Recommendation and measured ratio of every channel are recorded in the Parameters.
+"""
+
+import itertools
+import zlib
+
+import numpy as np
+
+from PyImarisWriter import PyImarisWriter as PW
+
+
+_compression_names = {PW.eCompressionAlgorithmNone: 'None',
+                      PW.eCompressionAlgorithmLZ4: 'LZ4',
+                      PW.eCompressionAlgorithmShuffleLZ4: 'ShuffleLZ4'}
+for _level in range(1, 10):
+    _compression_names[getattr(PW, 'eCompressionAlgorithmGzipLevel{}'.format(_level))] = 'GzipLevel{}'.format(_level)
+    _compression_names[getattr(PW, 'eCompressionAlgorithmShuffleGzipLevel{}'.format(_level))] = 'ShuffleGzipLevel{}'.format(_level)
+
+
+def get_compression_name(compression):
+    return _compression_names.get(compression, str(compression))
+
+
+class ChannelCompression:
+
+    def __init__(self, channel, compression, ratio, shuffle_ratio, entropy):
+        self.mChannel = channel
+        self.mCompression = compression
+        self.mRatio = ratio
+        self.mShuffleRatio = shuffle_ratio
+        self.mEntropy = entropy
+
+    def get_best_ratio(self):
+        return min(self.mRatio, self.mShuffleRatio)
+
+
+def get_entropy(samples):
+    """Shannon entropy of the sample values, in bits per bit of the data type (0-1)"""
+    _, counts = np.unique(samples, return_counts=True)
+    probabilities = counts / samples.size
+    return float(-(probabilities * np.log2(probabilities)).sum()) / (8 * samples.itemsize)
+
+
+def get_compression_ratios(samples):
+    """Compressed / raw size with zlib level 1, without and with byte shuffle"""
+    data = np.ascontiguousarray(samples)
+    raw = data.tobytes()
+    shuffled = data.view(np.uint8).reshape(-1, data.itemsize).T.tobytes()
+    return len(zlib.compress(raw, 1)) / len(raw), len(zlib.compress(shuffled, 1)) / len(shuffled)
+
+
+def recommend_compression(ratio, shuffle_ratio, tradeoff):
+    """
+    tradeoff 0 favours CPU time, 1 favours file size. Data that zlib shrinks by less than
+    10 % is stored with LZ4 (or uncompressed for tradeoff < 0.25).
+    """
+    shuffle = shuffle_ratio < ratio
+    if min(ratio, shuffle_ratio) > 0.9:
+        if tradeoff < 0.25:
+            return PW.eCompressionAlgorithmNone
+        return PW.eCompressionAlgorithmShuffleLZ4 if shuffle else PW.eCompressionAlgorithmLZ4
+    level = min(9, max(1, int(round(1 + tradeoff * 8))))
+    prefix = 'eCompressionAlgorithmShuffleGzipLevel' if shuffle else 'eCompressionAlgorithmGzipLevel'
+    return getattr(PW, '{}{}'.format(prefix, level))
+
+
+def iter_channel_samples(grid, image, num_blocks):
+    """Yields (channel, samples of the first num_blocks blocks of the channel)"""
+    channel_axis = grid.mAxes.index('c')
+    other_axes = [axis for axis in range(len(grid.mAxes)) if axis != channel_axis]
+    for channel in range(grid.mImageShape[channel_axis]):
+        blocks = itertools.islice(itertools.product(*(range(grid.mNumBlocks[axis]) for axis in other_axes)), num_blocks)
+        samples = []
+        for block in blocks:
+            slices = [None] * len(grid.mAxes)
+            slices[channel_axis] = slice(channel, channel + 1)
+            for axis, index in zip(other_axes, block):
+                slices[axis] = grid.mAxisSlices[axis][index]
+            samples.append(image[tuple(slices)].ravel())
+        yield channel, np.concatenate(samples)
+
+
+def select_compressions(grid, np_data, tradeoff=0.5, num_blocks=4, dimension_sequence=None, options=None):
+    """
+    Returns (compression for the file, list of ChannelCompression) and sets it in options if given.
+    The file compression is the recommendation of the compressible channels that together save the
+    most bytes, or the most common recommendation if no channel compresses.
+    """
+    image = grid.as_image_array(np_data, dimension_sequence)
+    channels = []
+    for channel, samples in iter_channel_samples(grid, image, num_blocks):
+        ratio, shuffle_ratio = get_compression_ratios(samples)
+        compression = recommend_compression(ratio, shuffle_ratio, tradeoff)
+        channels.append(ChannelCompression(channel, compression, ratio, shuffle_ratio, get_entropy(samples)))
+
+    savings = {}
+    for channel in channels:
+        if channel.get_best_ratio() <= 0.9:
+            savings[channel.mCompression] = savings.get(channel.mCompression, 0.0) + 1 - channel.get_best_ratio()
+    if savings:
+        compression = max(savings, key=savings.get)
+    else:
+        recommendations = [channel.mCompression for channel in channels]
+        compression = max(set(recommendations), key=recommendations.count)
+
+    if options is not None:
+        options.mCompressionAlgorithmType = compression
+    return compression, channels
+
+
+def add_compression_parameters(parameters, compression, channels):
+    parameters.set_value('Image', 'CompressionAlgorithm', get_compression_name(compression))
+    for channel in channels:
+        section = 'Channel {}'.format(channel.mChannel)
+        parameters.set_value(section, 'CompressionRecommendation', get_compression_name(channel.mCompression))
+        parameters.set_value(section, 'CompressionRatio', '{:.3f}'.format(channel.get_best_ratio()))
+        parameters.set_value(section, 'Entropy', '{:.3f}'.format(channel.mEntropy))
@@ -0,0 +1,153 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+Checkpoint journal of the blocks copied into an ImageConverter
+
+The native writer can not reopen a partially written .ims file, so after an interrupted
+conversion a new converter has to be given every block again. The journal checkpoints the
+bitmap of completed blocks and their CRC32 every checkpoint_interval seconds, so that a
+resumed conversion knows which blocks it can take from where, in one of two modes:
+
+  index only (spool=False): completed blocks are read again from the source on resume and
+      checked against their CRC32. Costs a few bytes per block, the default when the
+      source can be read by block (see ImageConverter.enable_journal).
+  spool (spool=True): every copied block is also written to a raw spool file, one padded
+      block after the other, and replayed from there. This doubles the write I/O and needs
+      disk space for the whole image next to the output, only worth it when the blocks can
+      not be produced again cheaply (e.g. a live acquisition or an expensive computation).
+
+In both modes the replayed blocks are copied again, so resuming costs time in proportion to
+the completed part, but no reads of the original source (spool) or no recomputation of the
+blocks. The journal is removed when Finish succeeded.
+
+    <output>.journal/state.json     image layout, data type and mode, must match to resume
+    <output>.journal/completed.npy  bitmap of the completed blocks
+    <output>.journal/checksums.npy  CRC32 of the completed blocks
+    <output>.journal/blocks.raw     block data (spool mode only)
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from PyImarisWriter import PyImarisWriter as PW
+
+from PyImarisWriterVerify import get_checksum
+
+
+class ConversionJournal:
+
+    def __init__(self, directory, grid, np_type, checkpoint_interval=10.0, spool=False):
+        self.mDirectory = directory
+        self.mGrid = grid
+        self.mNpType = np.dtype(np_type)
+        self.mCheckpointInterval = checkpoint_interval
+        self.mSpool = spool
+        self.mLock = threading.Lock()
+        self.mLastCheckpoint = time.monotonic()
+        self.mVerify = False
+
+        state = {
+            'image_shape': list(grid.mImageShape),
+            'block_shape': list(grid.mBlockShape),
+            'axes': list(grid.mAxes),
+            'dtype': self.mNpType.str,
+            'spool': spool,
+        }
+        blocks_filename = os.path.join(directory, 'blocks.raw')
+        completed_filename = os.path.join(directory, 'completed.npy')
+        checksums_filename = os.path.join(directory, 'checksums.npy')
+        resume = (self._load_state() == state and os.path.exists(completed_filename)
+                  and os.path.exists(checksums_filename) and (not spool or os.path.exists(blocks_filename)))
+        if not resume:
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+            with open(os.path.join(directory, 'state.json'), 'w') as state_file:
+                json.dump(state, state_file, indent=2)
+
+        self.mBlocks = None
+        if spool:
+            shape = (grid.get_num_blocks(),) + tuple(grid.mBlockShape)
+            self.mBlocks = np.memmap(blocks_filename, dtype=self.mNpType, mode='r+' if resume else 'w+', shape=shape)
+        if resume:
+            self.mCompleted = np.load(completed_filename)
+            self.mChecksums = np.load(checksums_filename)
+        else:
+            self.mCompleted = np.zeros(grid.mNumBlocks, dtype=bool)
+            self.mChecksums = np.zeros(grid.mNumBlocks, dtype=np.uint32)
+        self.mNumResumedBlocks = int(self.mCompleted.sum())
+
+    def _load_state(self):
+        try:
+            with open(os.path.join(self.mDirectory, 'state.json')) as state_file:
+                return json.load(state_file)
+        except (OSError, ValueError):
+            return None
+
+    def _get_position(self, block):
+        return int(np.ravel_multi_index(block, self.mGrid.mNumBlocks))
+
+    def record_block(self, block, block_buffer):
+        """
+        block_buffer is the full (padded) block as passed to the native CopyBlock. With mVerify set
+        (while replaying from the source) a completed block must match its journaled CRC32.
+        """
+        slices = self.mGrid.get_block_slices(block)
+        checksum = get_checksum(block_buffer[tuple(slice(0, s.stop - s.start) for s in slices)])
+        if self.mVerify and self.mCompleted[block] and self.mChecksums[block] != checksum:
+            raise PW.PyImarisWriterException('Block {} differs from the journaled block, the source changed since '
+                                             'the interrupted conversion'.format(block))
+        if self.mBlocks is not None:
+            self.mBlocks[self._get_position(block)] = block_buffer
+        with self.mLock:
+            self.mChecksums[block] = checksum
+            self.mCompleted[block] = True
+            if time.monotonic() - self.mLastCheckpoint >= self.mCheckpointInterval:
+                self._checkpoint()
+
+    def checkpoint(self):
+        with self.mLock:
+            self._checkpoint()
+
+    def _save(self, name, array):
+        temporary_filename = os.path.join(self.mDirectory, name + '.tmp.npy')
+        np.save(temporary_filename, array)
+        os.replace(temporary_filename, os.path.join(self.mDirectory, name + '.npy'))
+
+    def _checkpoint(self):
+        # block data and checksums first, so the bitmap never lists blocks that are not on disk
+        if self.mBlocks is not None:
+            self.mBlocks.flush()
+        self._save('checksums', self.mChecksums)
+        self._save('completed', self.mCompleted)
+        self.mLastCheckpoint = time.monotonic()
+
+    def get_completed_blocks(self):
+        return list(zip(*(axis.tolist() for axis in np.nonzero(self.mCompleted))))
+
+    def iter_completed_blocks(self):
+        """Yields (block, block data) of the journaled blocks, spool mode only"""
+        for block in self.get_completed_blocks():
+            yield block, self.mBlocks[self._get_position(block)]
+
+    def remove(self):
+        self.mBlocks = None
+        shutil.rmtree(self.mDirectory, ignore_errors=True)
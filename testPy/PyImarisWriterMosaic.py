@@ -0,0 +1,135 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+Mosaic writing of stage tiles placed at pixel offsets
+
+The tile positions are known up front, so every output block knows how many tiles cover it.
+Only blocks touched by an arrived tile are buffered, and a block is copied to the converter as
+soon as its last tile arrived. Buffered memory follows the scan front, not the mosaic size.
+Overlaps are resolved by the last arriving tile (POLICY_LAST_WINS) or averaged (POLICY_BLEND).
+"""
+
+import itertools
+
+import numpy as np
+
+from PyImarisWriter import PyImarisWriter as PW
+
+
+POLICY_LAST_WINS = 'last-wins'
+POLICY_BLEND = 'blend'
+
+
+class MosaicWriter:
+    """
+    converter is a PyImarisWriterBlocks.ImageConverter. tile_positions lists (offset, shape) per tile:
+    offset maps dimensions to pixel offsets (e.g. {'x': 900, 'y': 0}, missing dimensions are 0),
+    shape is the numpy shape of the tile in the axis order of the converter (e.g. (z, y, x)).
+    """
+
+    def __init__(self, converter, tile_positions, policy=POLICY_LAST_WINS):
+        if policy not in (POLICY_LAST_WINS, POLICY_BLEND):
+            raise PW.PyImarisWriterException('Unknown mosaic policy "{}"'.format(policy))
+        self.mConverter = converter
+        self.mGrid = converter.mBlockGrid
+        self.mPolicy = policy
+        self.mBlockShape = np.array(self.mGrid.mBlockShape)
+        self.mImageShape = np.array(self.mGrid.mImageShape)
+        self.mTiles = [self._get_tile_box(offset, shape) for offset, shape in tile_positions]
+        self.mRemainingTiles = np.zeros(self.mGrid.mNumBlocks, dtype=np.int32)
+        for start, stop in self.mTiles:
+            for block in self._iter_tile_blocks(start, stop):
+                self.mRemainingTiles[block] += 1
+        self.mArrivedTiles = np.zeros(len(self.mTiles), dtype=bool)
+        self.mBlocks = {}
+        self.mPeakBufferedBlocks = 0
+
+    def _get_tile_box(self, offset, shape):
+        shape = (1,) * (len(self.mGrid.mAxes) - len(shape)) + tuple(shape)
+        start = np.array([offset.get(axis, 0) for axis in self.mGrid.mAxes])
+        stop = start + shape
+        if (start < 0).any() or (stop > self.mImageShape).any():
+            raise PW.PyImarisWriterException('Tile at {} of shape {} exceeds image shape {}'.format(
+                offset, shape, tuple(self.mImageShape)))
+        return start, stop
+
+    def _iter_tile_blocks(self, start, stop):
+        first = start // self.mBlockShape
+        last = (stop - 1) // self.mBlockShape
+        return itertools.product(*(range(f, l + 1) for f, l in zip(first.tolist(), last.tolist())))
+
+    def _get_block_buffers(self, block):
+        buffers = self.mBlocks.get(block)
+        if buffers is None:
+            if self.mPolicy == POLICY_BLEND:
+                buffers = (np.zeros(self.mGrid.mBlockShape, dtype=np.float64),
+                           np.zeros(self.mGrid.mBlockShape, dtype=np.uint16))
+            else:
+                buffers = (np.zeros(self.mGrid.mBlockShape, dtype=self.mConverter.mNpType), None)
+            self.mBlocks[block] = buffers
+            self.mPeakBufferedBlocks = max(self.mPeakBufferedBlocks, len(self.mBlocks))
+        return buffers
+
+    def add_tile(self, tile_index, tile_data):
+        """Places the tile with the given index of tile_positions, completed blocks are copied immediately"""
+        if self.mArrivedTiles[tile_index]:
+            raise PW.PyImarisWriterException('Tile {} was already added'.format(tile_index))
+        start, stop = self.mTiles[tile_index]
+        tile = tile_data[(np.newaxis,) * (len(self.mGrid.mAxes) - tile_data.ndim)]
+        if tile.shape != tuple(stop - start):
+            raise PW.PyImarisWriterException('Tile {} has shape {}, expected {}'.format(
+                tile_index, tile_data.shape, tuple(stop - start)))
+        self.mArrivedTiles[tile_index] = True
+
+        for block in self._iter_tile_blocks(start, stop):
+            block_start = np.array(block) * self.mBlockShape
+            low = np.maximum(start, block_start)
+            high = np.minimum(stop, block_start + self.mBlockShape)
+            source = tile[tuple(slice(l, h) for l, h in zip((low - start).tolist(), (high - start).tolist()))]
+            target = tuple(slice(l, h) for l, h in zip((low - block_start).tolist(), (high - block_start).tolist()))
+
+            data, weights = self._get_block_buffers(block)
+            if weights is None:
+                data[target] = source
+            else:
+                data[target] += source
+                weights[target] += 1
+
+            self.mRemainingTiles[block] -= 1
+            if self.mRemainingTiles[block] == 0:
+                self._copy_block(block)
+
+    def _copy_block(self, block):
+        data, weights = self.mBlocks.pop(block)
+        if weights is not None:
+            data = np.divide(data, weights, out=np.zeros_like(data), where=weights > 0)
+            if np.issubdtype(self.mConverter.mNpType, np.integer):
+                np.rint(data, out=data)
+        valid = tuple(slice(0, s.stop - s.start) for s in self.mGrid.get_block_slices(block))
+        self.mConverter.CopyBlock(data[valid], self.mGrid.get_block_index(block))
+
+    def get_num_buffered_blocks(self):
+        return len(self.mBlocks)
+
+    def close(self):
+        """Copies the blocks of tiles that did not arrive and fills blocks without tiles with zeros"""
+        for block in list(self.mBlocks):
+            self._copy_block(block)
+        empty_block = np.zeros(self.mGrid.mBlockShape, dtype=self.mConverter.mNpType)
+        for block in self.mConverter.iter_blocks():
+            valid = tuple(slice(0, s.stop - s.start) for s in self.mGrid.get_block_slices(block))
+            self.mConverter.CopyBlock(empty_block[valid], self.mGrid.get_block_index(block))
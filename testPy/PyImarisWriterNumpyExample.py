@@ -19,18 +19,23 @@ Example Program that creates an ims file from numpy array using PyImarisWriter p
 """
 
 from PyImarisWriter import PyImarisWriter as PW
+import PyImarisWriterBatch as PWBatch
+import PyImarisWriterBlocks as PWB
+import PyImarisWriterTransform as PWT
 import numpy as np
 
+import sys
 from datetime import datetime
 
 class TestConfiguration:
 
-    def __init__(self, id, title, np_type, imaris_type, color_table):
+    def __init__(self, id, title, np_type, imaris_type, color_table, transform=None):
         self.mId = id
         self.mTitle = title
         self.mNp_type = np_type
         self.mImaris_type = imaris_type
         self.mColor_table = color_table
+        self.mTransform = transform
 
 def get_test_configurations():
     configurations = []
@@ -53,6 +58,14 @@ def get_test_configurations():
     configurations.append(TestConfiguration(len(configurations), 'float32 image from uint16 numpy array', np.uint16, 'float32',
                                             [PW.Color(0, 1, 1, 1), PW.Color(1, 0, 1, 1), PW.Color(1, 1, 0, 1)]))
 
+    configurations.append(TestConfiguration(len(configurations), 'uint8 image from 12 bit uint16 numpy array with window/level', np.uint16, 'uint8',
+                                            [PW.Color(0, 0, 0, 1), PW.Color(1, 1, 1, 1)],
+                                            PWT.get_window_transform(0, 300, 4096, np.uint8)))
+
+    configurations.append(TestConfiguration(len(configurations), 'uint16 image from float32 numpy array quantized', np.float32, 'uint16',
+                                            [PW.Color(0, 0, 0, 1), PW.Color(0, 1, 0, 1)],
+                                            PWT.get_quantization_transform(0.0, 200.0, np.uint16)))
+
     return configurations
 
 
@@ -68,15 +81,19 @@ class MyCallbackClass(PW.CallbackClass):
             print('User Progress {}, Bytes written: {}'.format(self.mUserDataProgress, total_bytes_written))
 
 
-def run(configuration):
-    image_size = PW.ImageSize(x=600, y=400, z=5, c=1, t=1)
+def get_image_size():
+    return PW.ImageSize(x=600, y=400, z=5, c=1, t=1)
+
+
+def run(configuration, num_threads=12):
+    image_size = get_image_size()
     dimension_sequence = PW.DimensionSequence('x', 'y', 'z', 'c', 't')
     block_size = image_size
     sample_size = PW.ImageSize(x=1, y=1, z=1, c=1, t=1)
     output_filename = f'PyImarisWriterNumpyExample{configuration.mId}.ims'
     
     options = PW.Options()
-    options.mNumberOfThreads = 12
+    options.mNumberOfThreads = num_threads
     options.mCompressionAlgorithmType = PW.eCompressionAlgorithmGzipLevel2
     options.mEnableLogProgress = True
 
@@ -91,24 +108,12 @@ def run(configuration):
     application_version = '1.0.0'
 
     callback_class = MyCallbackClass()
-    converter = PW.ImageConverter(configuration.mImaris_type, image_size, sample_size, dimension_sequence, block_size,
-                                  output_filename, options, application_name, application_version, callback_class)
-    
-    num_blocks = image_size / block_size
-
-    block_index = PW.ImageSize()
-    for c in range(num_blocks.c):
-        block_index.c = c
-        for t in range(num_blocks.t):
-            block_index.t = t
-            for z in range(num_blocks.z):
-                block_index.z = z
-                for y in range(num_blocks.y):
-                    block_index.y = y
-                    for x in range(num_blocks.x):
-                        block_index.x = x
-                        if converter.NeedCopyBlock(block_index):
-                            converter.CopyBlock(np_data, block_index)
+    converter = PWB.ImageConverter(configuration.mImaris_type, image_size, sample_size, dimension_sequence, block_size,
+                                   output_filename, options, application_name, application_version, callback_class)
+
+    if configuration.mTransform is not None:
+        converter.set_transform(configuration.mTransform)
+    converter.write_array(np_data)
 
     adjust_color_range = True
     image_extents = PW.ImageExtents(0, 0, 0, image_size.x, image_size.y, image_size.z)
@@ -127,9 +132,14 @@ def run(configuration):
 
 
 def main():
-    configurations = get_test_configurations()
-    for test_config in configurations:
-            run(test_config)
+    image_size = get_image_size()
+    num_voxels = image_size.x * image_size.y * image_size.z * image_size.c * image_size.t
+    jobs = [PWBatch.ConversionJob(test_config.mTitle, run, (test_config,), num_voxels * np.dtype(test_config.mNp_type).itemsize)
+            for test_config in get_test_configurations()]
+
+    batch_result = PWBatch.BatchConverter().run(jobs)
+    batch_result.print_report()
+    return 1 if batch_result.get_failed() else 0
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,172 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+Pipelined block submission for PyImarisWriter.ImageConverter
+
+Blocks are handed to a writer thread, so that the producer can continue while the
+native library copies and compresses. ctypes releases the GIL for the duration of
+the native call, so the producer thread keeps running in Python meanwhile.
+
+WriterBacklog bounds the data buffered inside the native writer, which has no memory option
+of its own, by blocking CopyBlock until the reported progress caught up. By default the cap
+is soft, see WriterBacklog.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class ByteBudget:
+    """Bounds the number of bytes in flight, blocking acquire() while the budget is used up"""
+
+    def __init__(self, max_bytes):
+        self.mMaxBytes = max_bytes
+        self.mBytes = 0
+        self.mPeakBytes = 0
+        self.mCondition = threading.Condition()
+
+    def acquire(self, num_bytes):
+        with self.mCondition:
+            # a request larger than the whole budget is let through once nothing else is in flight
+            while self.mBytes > 0 and self.mBytes + num_bytes > self.mMaxBytes:
+                self.mCondition.wait()
+            self.mBytes += num_bytes
+            self.mPeakBytes = max(self.mPeakBytes, self.mBytes)
+
+    def release(self, num_bytes):
+        with self.mCondition:
+            self.mBytes -= num_bytes
+            self.mCondition.notify_all()
+
+    def get_bytes(self):
+        with self.mCondition:
+            return self.mBytes
+
+    def get_peak_bytes(self):
+        with self.mCondition:
+            return self.mPeakBytes
+
+
+class WriterBacklog:
+    """
+    Estimates the bytes buffered by the native writer as bytes submitted minus progress times
+    image bytes. acquire() blocks while a block would take the estimate above max_bytes, until
+    the writer reports enough progress. The writer may need more blocks before it can make
+    progress (e.g. to complete a pyramid slab), then the hard cap dead locks. With max_wait set,
+    a producer waiting longer than max_wait seconds without any progress is let through instead:
+    the cap is exceeded, counted in mNumStalls and mBypassedBytes and visible in the peak.
+    """
+
+    def __init__(self, image_bytes, max_bytes, max_wait=None):
+        self.mImageBytes = image_bytes
+        self.mMaxBytes = max_bytes
+        self.mMaxWait = max_wait
+        self.mSubmittedBytes = 0
+        self.mProcessedBytes = 0
+        self.mPeakBytes = 0
+        self.mNumStalls = 0
+        self.mBypassedBytes = 0
+        self.mCondition = threading.Condition()
+
+    def record_progress(self, progress):
+        with self.mCondition:
+            self.mProcessedBytes = max(self.mProcessedBytes, int(progress * self.mImageBytes))
+            self.mCondition.notify_all()
+
+    def acquire(self, num_bytes):
+        with self.mCondition:
+            last_progress = time.monotonic()
+            processed = self.mProcessedBytes
+            while (self.mSubmittedBytes > self.mProcessedBytes
+                   and self.mSubmittedBytes + num_bytes - self.mProcessedBytes > self.mMaxBytes):
+                if self.mProcessedBytes != processed:
+                    processed = self.mProcessedBytes
+                    last_progress = time.monotonic()
+                if self.mMaxWait is None:
+                    self.mCondition.wait()
+                    continue
+                remaining = self.mMaxWait - (time.monotonic() - last_progress)
+                if remaining <= 0:
+                    self.mNumStalls += 1
+                    self.mBypassedBytes += num_bytes
+                    break
+                self.mCondition.wait(remaining)
+            self.mSubmittedBytes += num_bytes
+            self.mPeakBytes = max(self.mPeakBytes, self.mSubmittedBytes - self.mProcessedBytes)
+
+    def get_bytes(self):
+        with self.mCondition:
+            return max(0, self.mSubmittedBytes - self.mProcessedBytes)
+
+    def get_peak_bytes(self):
+        with self.mCondition:
+            return self.mPeakBytes
+
+
+class BlockPipeline:
+    """
+    Runs copy_block(block_data, block_index) on a single writer thread. submit() returns a
+    concurrent.futures.Future (use asyncio.wrap_future() from asyncio code) and blocks the
+    caller while more than max_in_flight_bytes of block data are queued.
+    """
+
+    def __init__(self, copy_block, max_in_flight_bytes):
+        self.mCopyBlock = copy_block
+        self.mBudget = ByteBudget(max_in_flight_bytes)
+        self.mExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='PyImarisWriterPipeline')
+        self.mPendingLock = threading.Lock()
+        self.mPending = set()
+
+    def _copy_block(self, block_data, block_index, num_bytes):
+        try:
+            self.mCopyBlock(block_data, block_index)
+        finally:
+            self.mBudget.release(num_bytes)
+
+    def _on_done(self, future):
+        # failed futures stay pending, so that flush() reports them
+        if future.exception() is None:
+            with self.mPendingLock:
+                self.mPending.discard(future)
+
+    def submit(self, block_data, block_index):
+        num_bytes = memoryview(block_data).nbytes
+        self.mBudget.acquire(num_bytes)
+        try:
+            future = self.mExecutor.submit(self._copy_block, block_data, block_index, num_bytes)
+        except BaseException:
+            self.mBudget.release(num_bytes)
+            raise
+        with self.mPendingLock:
+            self.mPending.add(future)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def flush(self):
+        """Waits for all submitted blocks and raises the first error that occurred"""
+        with self.mPendingLock:
+            pending = list(self.mPending)
+        wait(pending)
+        with self.mPendingLock:
+            self.mPending.difference_update(pending)
+        for future in pending:
+            if future.exception() is not None:
+                raise future.exception()
+
+    def shutdown(self):
+        self.mExecutor.shutdown(wait=True)
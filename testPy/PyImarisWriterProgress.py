@@ -0,0 +1,107 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+Progress callback dispatch for PyImarisWriterBlocks.ImageConverter
+
+The native writer calls RecordProgress from its worker threads, each call holds the GIL
+while it runs. ProgressRecorder keeps that time short: updates below a minimum progress
+step or time interval are dropped after two comparisons, and in queue mode the remaining
+updates are only appended to a deque that a Python thread forwards to the user callback.
+"""
+
+import collections
+import threading
+import time
+
+
+class ProgressRecorder:
+    """
+    Forwards RecordProgress to the user callback class, recording bytes written in mStats
+    and progress in mBacklog if set. mBytesWritten is the last reported total.
+    """
+
+    def __init__(self, callback_class):
+        self.mCallbackClass = callback_class
+        self.mStats = None
+        self.mBacklog = None
+        self.mBytesWritten = 0
+        self.mMinProgressStep = 0.0
+        self.mMinInterval = 0.0
+        self.mLastProgress = -1.0
+        self.mLastTime = 0.0
+        self.mQueue = None
+
+    def set_throttle(self, min_progress_step=0.0, min_interval=0.0):
+        """Only forwards updates that advance by min_progress_step (0-1) and come min_interval seconds apart"""
+        self.mMinProgressStep = min_progress_step
+        self.mMinInterval = min_interval
+
+    def RecordProgress(self, progress, total_bytes_written):
+        self.mBytesWritten = total_bytes_written
+        if self.mStats is not None:
+            self.mStats.record_bytes_written(total_bytes_written)
+        if self.mBacklog is not None:
+            self.mBacklog.record_progress(progress)
+
+        # the final update is always delivered
+        if progress < 1:
+            # tolerance for steps like 0.15 - 0.1 falling just short of 0.05
+            if progress - self.mLastProgress < self.mMinProgressStep - 1e-6:
+                return
+            if self.mMinInterval > 0:
+                now = time.monotonic()
+                if now - self.mLastTime < self.mMinInterval:
+                    return
+                self.mLastTime = now
+        self.mLastProgress = progress
+
+        queue = self.mQueue
+        if queue is not None:
+            queue.append((progress, total_bytes_written))
+        else:
+            self.mCallbackClass.RecordProgress(progress, total_bytes_written)
+
+
+class ProgressPoller:
+    """Forwards the latest queued update of a ProgressRecorder to its callback class every interval seconds"""
+
+    def __init__(self, recorder, interval=0.1, max_queued=1024):
+        self.mRecorder = recorder
+        self.mInterval = interval
+        self.mStopEvent = threading.Event()
+        recorder.mQueue = collections.deque(maxlen=max_queued)
+        self.mThread = threading.Thread(target=self._run, name='PyImarisWriterProgress', daemon=True)
+        self.mThread.start()
+
+    def poll(self):
+        updates = []
+        queue = self.mRecorder.mQueue
+        while queue:
+            updates.append(queue.popleft())
+        if updates:
+            self.mRecorder.mCallbackClass.RecordProgress(*updates[-1])
+        return updates
+
+    def _run(self):
+        while not self.mStopEvent.wait(self.mInterval):
+            self.poll()
+
+    def stop(self):
+        self.mStopEvent.set()
+        self.mThread.join()
+        self.poll()
+        self.mRecorder.mQueue = None
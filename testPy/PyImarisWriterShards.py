@@ -0,0 +1,271 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+Sharded writing of one image by several processes, merged into one .ims file
+
+The image is split into slabs of time points or channels. Every shard is converted by its own
+process into a complete .ims file (with its own ImageConverter and mNumberOfThreads), and the
+shards are then merged with h5py. Resolution pyramids and histograms are computed per time
+point and channel, so slabs along t or c are independent and the merge copies the compressed
+chunks of every resolution level as they are (HDF5 object copy, no recompression). Splitting
+along z is not supported, since the lower resolutions would mix voxels of different shards.
+
+Benchmark, writing the same synthetic image with 1, 2 and 4 shards:
+
+    python PyImarisWriterShards.py -sizex 1024 -sizey 1024 -sizez 64 -sizet 8 -shards 1,2,4 out.ims
+"""
+
+import argparse
+import functools
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from PyImarisWriter import PyImarisWriter as PW
+import PyImarisWriterBatch as PWBatch
+import PyImarisWriterBenchmark as PWBenchmark
+import PyImarisWriterBlocks as PWB
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+def get_shard_ranges(size, num_shards):
+    """Splits range(size) into up to num_shards (start, stop) ranges of nearly equal size"""
+    num_shards = max(1, min(num_shards, size))
+    bounds = [size * shard // num_shards for shard in range(num_shards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def get_shard_filename(output_filename, shard):
+    stem, extension = os.path.splitext(output_filename)
+    return '{}_shard{}{}'.format(stem, shard, extension)
+
+
+def write_shard(datatype, image_size, block_size, sequence, compression, dimension, start, stop, read_slab,
+                output_filename, image_extents, time_infos, parameters, num_threads):
+    """
+    Converts [start, stop) along dimension. Sizes are dicts of x, y, z, c, t, read_slab(dimension,
+    start, stop) returns the slab as numpy array in the axis order of the sequence (slowest first).
+    """
+    shard_size = dict(image_size)
+    shard_size[dimension] = stop - start
+    options = PW.Options()
+    options.mNumberOfThreads = num_threads
+    options.mCompressionAlgorithmType = compression
+
+    converter = PWB.ImageConverter(datatype, PW.ImageSize(**shard_size), PW.ImageSize(x=1, y=1, z=1, c=1, t=1),
+                                   PW.DimensionSequence(*sequence), PW.ImageSize(**block_size), output_filename,
+                                   options, 'PyImarisWriterShards', '1.0', PW.CallbackClass())
+    try:
+        converter.write_array(read_slab(dimension, start, stop))
+        pw_parameters = PW.Parameters()
+        for section_name, section in parameters.items():
+            for parameter_name, value in section.items():
+                pw_parameters.set_value(section_name, parameter_name, value)
+        if dimension == 't':
+            time_infos = time_infos[start:stop]
+        color_infos = [PW.ColorInfo() for _ in range(shard_size['c'])]
+        converter.Finish(PW.ImageExtents(*image_extents), pw_parameters, time_infos, color_infos, True)
+    finally:
+        converter.Destroy()
+
+
+def _get_text(group, name):
+    value = group.attrs[name]
+    if isinstance(value, np.ndarray):
+        return b''.join(value.tolist()).decode()
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def _set_text(group, name, text):
+    # Imaris stores attributes as arrays of single characters
+    group.attrs[name] = np.frombuffer(str(text).encode(), dtype='S1')
+
+
+def _get_count(shard, dimension):
+    level = shard['DataSet/ResolutionLevel 0']
+    if dimension == 't':
+        return len(level)
+    return len(level['TimePoint 0'])
+
+
+def _merge_info(shard, output, dimension, offset):
+    info = shard['DataSetInfo']
+    output_info = output['DataSetInfo']
+    if dimension == 'c':
+        for name in info:
+            if name.startswith('Channel '):
+                channel = int(name.split()[-1])
+                shard.copy(info[name], output_info, name='Channel {}'.format(channel + offset))
+        return
+
+    if 'TimeInfo' not in info or 'TimeInfo' not in output_info:
+        return
+    for name in info['TimeInfo'].attrs:
+        if name.startswith('TimePoint') and name[len('TimePoint'):].isdigit():
+            time_point = int(name[len('TimePoint'):])
+            output_info['TimeInfo'].attrs['TimePoint{}'.format(time_point + offset)] = info['TimeInfo'].attrs[name]
+    # color ranges covering all shards
+    for name in info:
+        if name.startswith('Channel ') and 'ColorRange' in info[name].attrs and name in output_info:
+            shard_range = [float(value) for value in _get_text(info[name], 'ColorRange').split()]
+            merged_range = [float(value) for value in _get_text(output_info[name], 'ColorRange').split()]
+            _set_text(output_info[name], 'ColorRange', '{:g} {:g}'.format(
+                min(shard_range[0], merged_range[0]), max(shard_range[1], merged_range[1])))
+
+
+def _set_count(output, dimension, count):
+    info = output['DataSetInfo']
+    if dimension == 'c':
+        _set_text(info['Image'], 'Noc', count)
+    elif 'TimeInfo' in info:
+        for name in ('DatasetTimePoints', 'DataSetTimePoints', 'FileTimePoints'):
+            if name in info['TimeInfo'].attrs:
+                _set_text(info['TimeInfo'], name, count)
+
+
+def merge_shards(shard_filenames, output_filename, dimension='t'):
+    """
+    Merges shard files (in order along dimension) into output_filename. Root attributes,
+    thumbnail and image information come from the first shard. Along t, the per time point
+    DataSetTimes of the first shard do not cover the merged file and are left out, the time
+    points are taken from DataSetInfo/TimeInfo.
+    """
+    if h5py is None:
+        raise PW.PyImarisWriterException('Merging shards requires the h5py package')
+    if dimension not in ('t', 'c'):
+        raise PW.PyImarisWriterException('Shards can only be merged along t or c, not "{}"'.format(dimension))
+
+    shards = [h5py.File(filename, 'r') for filename in shard_filenames]
+    try:
+        with h5py.File(output_filename, 'w') as output:
+            first = shards[0]
+            for name, value in first.attrs.items():
+                output.attrs[name] = value
+            for name in first:
+                if name != 'DataSet' and not (name == 'DataSetTimes' and dimension == 't'):
+                    first.copy(first[name], output, name=name)
+
+            offset = 0
+            for shard in shards:
+                for level_name, level in shard['DataSet'].items():
+                    output_level = output.require_group('DataSet/{}'.format(level_name))
+                    for time_name, time_group in level.items():
+                        time_point = int(time_name.split()[-1]) + (offset if dimension == 't' else 0)
+                        output_time = output_level.require_group('TimePoint {}'.format(time_point))
+                        for channel_name in time_group:
+                            channel = int(channel_name.split()[-1]) + (offset if dimension == 'c' else 0)
+                            shard.copy(time_group[channel_name], output_time, name='Channel {}'.format(channel))
+                if shard is not first:
+                    _merge_info(shard, output, dimension, offset)
+                offset += _get_count(shard, dimension)
+            _set_count(output, dimension, offset)
+    finally:
+        for shard in shards:
+            shard.close()
+
+
+def write_sharded(output_filename, datatype, image_size, block_size, read_slab, image_extents, time_infos,
+                  num_shards, dimension='t', sequence=('x', 'y', 'z', 'c', 't'),
+                  compression=PW.eCompressionAlgorithmGzipLevel2, parameters=None, total_threads=None,
+                  keep_shards=False):
+    """
+    Writes the image with num_shards processes and merges the shards into output_filename.
+    image_size and block_size are PW.ImageSize, read_slab must be picklable (see write_shard).
+    Returns (PyImarisWriterBatch.BatchResult of the shards, seconds of the merge).
+    """
+    sizes = {axis: getattr(image_size, axis) for axis in 'xyzct'}
+    blocks = {axis: getattr(block_size, axis) for axis in 'xyzct'}
+    itemsize = np.dtype(PWB.get_np_type(datatype)).itemsize
+    jobs = []
+    shard_filenames = []
+    for shard, (start, stop) in enumerate(get_shard_ranges(sizes[dimension], num_shards)):
+        shard_filename = get_shard_filename(output_filename, shard)
+        shard_filenames.append(shard_filename)
+        num_bytes = sizes['x'] * sizes['y'] * sizes['z'] * sizes['c'] * sizes['t'] // sizes[dimension] * (stop - start)
+        jobs.append(PWBatch.ConversionJob(
+            os.path.basename(shard_filename), write_shard,
+            (datatype, sizes, blocks, list(sequence), compression, dimension, start, stop, read_slab, shard_filename,
+             tuple(image_extents), list(time_infos), parameters or {}),
+            num_bytes * itemsize))
+
+    batch_result = PWBatch.BatchConverter(total_threads, max_parallel_jobs=len(jobs)).run(jobs)
+    failed = batch_result.get_failed()
+    if failed:
+        raise PW.PyImarisWriterException('Shard {} failed: {}'.format(failed[0].mName, failed[0].mError))
+
+    start = time.perf_counter()
+    merge_shards(shard_filenames, output_filename, dimension)
+    merge_seconds = time.perf_counter() - start
+    if not keep_shards:
+        for shard_filename in shard_filenames:
+            os.remove(shard_filename)
+    return batch_result, merge_seconds
+
+
+def read_noise_slab(dimension, start, stop, size_x=0, size_y=0, size_z=0, size_c=0, size_t=0, data_type='16bit'):
+    """Synthetic slab of the benchmark (shape (t, c, z, y, x)), bind the sizes with functools.partial"""
+    shape = {'t': size_t, 'c': size_c, 'z': size_z, 'y': size_y, 'x': size_x}
+    shape[dimension] = stop - start
+    shape = tuple(shape[axis] for axis in 'tczyx')
+    num_voxels = int(np.prod(shape))
+    noise = PWBenchmark.get_noise_block(data_type, (num_voxels + 1) // 2, np.random.default_rng(start))
+    return noise[:num_voxels].reshape(shape)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-sizex', type=int, default=1024)
+    parser.add_argument('-sizey', type=int, default=1024)
+    parser.add_argument('-sizez', type=int, default=64)
+    parser.add_argument('-sizec', type=int, default=1)
+    parser.add_argument('-sizet', type=int, default=8)
+    parser.add_argument('-type', default='16bit', help='DataType 8bit, 16bit or 32bit (default 16bit)')
+    parser.add_argument('-dimension', default='t', help='Shard along t or c (default t)')
+    parser.add_argument('-shards', default='1,2,4', help='Comma separated numbers of shards (default 1,2,4)')
+    parser.add_argument('-threads', type=int, default=None, help='Threads of all shards together (default: cores)')
+    parser.add_argument('-compression', type=int, default=2, help='Compression type and level (default 2)')
+    parser.add_argument('outfile', nargs='?', default='PyImarisWriterShards.ims')
+    args = parser.parse_args()
+
+    datatype = {'8bit': 'uint8', '16bit': 'uint16', '32bit': 'uint32'}[args.type]
+    image_size = PW.ImageSize(x=args.sizex, y=args.sizey, z=args.sizez, c=args.sizec, t=args.sizet)
+    block_size = PW.ImageSize(x=256, y=256, z=8, c=1, t=1)
+    read_slab = functools.partial(read_noise_slab, size_x=args.sizex, size_y=args.sizey, size_z=args.sizez,
+                                  size_c=args.sizec, size_t=args.sizet, data_type=args.type)
+    image_extents = (0, 0, 0, args.sizex, args.sizey, args.sizez)
+    time_infos = [datetime.today()] * args.sizet
+
+    for num_shards in (int(value) for value in args.shards.split(',')):
+        start = time.perf_counter()
+        batch_result, merge_seconds = write_sharded(args.outfile, datatype, image_size, block_size, read_slab,
+                                                    image_extents, time_infos, num_shards, args.dimension,
+                                                    compression=args.compression, total_threads=args.threads)
+        seconds = time.perf_counter() - start
+        mb = batch_result.get_num_bytes() / (1024 * 1024)
+        print('Shards: {}  MB: {:.0f}  write[s]: {:.2f}  merge[s]: {:.2f}  MB/s: {:.1f}'.format(
+            num_shards, mb, batch_result.mSeconds, merge_seconds, mb / seconds))
+        os.remove(args.outfile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+Streaming sources for PyImarisWriterBlocks.ImageConverter
+
+The image is read one slab at a time, a slab being all blocks that share their block
+index in every dimension except the two fastest ones (usually a z-slab of y/x blocks).
+The next slab is read on a background thread while the blocks of the current slab are
+copied, so only about two slabs are held in memory.
+"""
+
+import itertools
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from PyImarisWriter import PyImarisWriter as PW
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+def iter_slabs(grid):
+    return itertools.product(*(range(num) for num in grid.mNumBlocks[:-2]))
+
+
+def get_slab_slices(grid, slab):
+    leading = tuple(slices[i] for slices, i in zip(grid.mAxisSlices, slab))
+    return leading + (slice(0, grid.mImageShape[-2]), slice(0, grid.mImageShape[-1]))
+
+
+def iter_source_blocks(grid, read_slab):
+    """
+    Yields (block, block data) for all blocks of grid in memory order. read_slab(slices) must return
+    the image region selected by the numpy slices, it is called for the next slab ahead of time.
+    """
+    slabs = list(iter_slabs(grid))
+    if not slabs:
+        return
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='PyImarisWriterReadAhead') as executor:
+        next_slab = executor.submit(read_slab, get_slab_slices(grid, slabs[0]))
+        for i, slab in enumerate(slabs):
+            slab_data = next_slab.result()
+            if i + 1 < len(slabs):
+                next_slab = executor.submit(read_slab, get_slab_slices(grid, slabs[i + 1]))
+
+            for yx in itertools.product(range(grid.mNumBlocks[-2]), range(grid.mNumBlocks[-1])):
+                block = slab + yx
+                # the slab spans the whole y/x extent, so image slices and slab slices coincide
+                yield block, slab_data[..., grid.mAxisSlices[-2][yx[0]], grid.mAxisSlices[-1][yx[1]]]
+            del slab_data
+
+
+def write_source(converter, read_slab):
+    grid = converter.mBlockGrid
+    for block, block_data in iter_source_blocks(grid, read_slab):
+        block_index = grid.get_block_index(block)
+        if converter.NeedCopyBlock(block_index):
+            converter.CopyBlock(block_data, block_index)
+
+
+def open_raw(grid, filename, dtype, shape=None, offset=0, dimension_sequence=None):
+    """
+    Memory maps a raw file. shape defaults to the image shape of grid, dimension_sequence
+    describes the memory order of the file and defaults to the one of grid.
+    """
+    if shape is None:
+        shape = [grid.mImageShape[grid.mAxes.index(axis)] for axis in grid.get_axes(dimension_sequence)]
+    data = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=tuple(shape))
+    return grid.as_image_array(data, dimension_sequence)
+
+
+def write_raw(converter, filename, dtype, shape=None, offset=0, dimension_sequence=None):
+    image = open_raw(converter.mBlockGrid, filename, dtype, shape, offset, dimension_sequence)
+    write_source(converter, lambda slices: np.array(image[slices]))
+
+
+class TiffSequence:
+    """
+    Image stored as one 2D TIFF file per plane. filenames are ordered like the planes of the
+    image array, i.e. all dimensions but y and x in numpy order (e.g. t, c, z).
+    """
+
+    def __init__(self, grid, filenames):
+        if tifffile is None:
+            raise PW.PyImarisWriterException('Reading TIFF files requires the tifffile package')
+        if grid.mAxes[-2:] != ['y', 'x']:
+            raise PW.PyImarisWriterException('TIFF planes require x and y to be the first dimensions of the sequence')
+        num_planes = math.prod(grid.mImageShape[:-2])
+        if len(filenames) != num_planes:
+            raise PW.PyImarisWriterException('Expected {} TIFF files, got {}'.format(num_planes, len(filenames)))
+
+        self.mFilenames = list(filenames)
+        self.mPlaneIndices = np.arange(num_planes).reshape(grid.mImageShape[:-2])
+
+    def read_slab(self, slices):
+        plane_indices = self.mPlaneIndices[slices[:-2]]
+        slab = None
+        for position, plane_index in np.ndenumerate(plane_indices):
+            plane = tifffile.imread(self.mFilenames[plane_index])[slices[-2:]]
+            if slab is None:
+                slab = np.empty(plane_indices.shape + plane.shape, dtype=plane.dtype)
+            slab[position] = plane
+        return slab
+
+
+def write_tiff_sequence(converter, filenames):
+    write_source(converter, TiffSequence(converter.mBlockGrid, filenames).read_slab)
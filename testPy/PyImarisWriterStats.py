@@ -0,0 +1,139 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+Per stage statistics of PyImarisWriterBlocks.ImageConverter
+
+Stages measured from Python:
+  prepare          slicing, cast and gather of the block data in Python
+  backlog_wait     CopyBlock blocked by the memory budget (set_memory_budget)
+  lock_wait        CopyBlock waiting for the native copy of another producer thread
+  copy_block       native CopyBlock call, including ctypes marshalling
+  need_copy_block  native NeedCopyBlock call
+  finish           native Finish call
+Compression, pyramid computation and disk I/O run on the native writer threads and are
+only visible through the bytes written reported to the progress callback.
+"""
+
+import threading
+import time
+
+
+STAGE_PREPARE = 'prepare'
+STAGE_BACKLOG_WAIT = 'backlog_wait'
+STAGE_LOCK_WAIT = 'lock_wait'
+STAGE_COPY_BLOCK = 'copy_block'
+STAGE_NEED_COPY_BLOCK = 'need_copy_block'
+STAGE_FINISH = 'finish'
+
+_stages = [STAGE_PREPARE, STAGE_BACKLOG_WAIT, STAGE_LOCK_WAIT, STAGE_COPY_BLOCK, STAGE_NEED_COPY_BLOCK, STAGE_FINISH]
+
+
+class LatencyHistogram:
+    """Latencies in seconds, counted in power of two buckets from 1 us to 64 s"""
+
+    mBounds = [2.0 ** exponent * 1e-6 for exponent in range(27)]
+
+    def __init__(self):
+        self.mCounts = [0] * (len(self.mBounds) + 1)
+        self.mCount = 0
+        self.mSum = 0.0
+
+    def add(self, seconds):
+        index = 0
+        while index < len(self.mBounds) and seconds > self.mBounds[index]:
+            index += 1
+        self.mCounts[index] += 1
+        self.mCount += 1
+        self.mSum += seconds
+
+    def get_dict(self):
+        return {
+            'count': self.mCount,
+            'sum': self.mSum,
+            'buckets': {'{:g}'.format(bound): count for bound, count in zip(self.mBounds + [float('inf')], self.mCounts)},
+        }
+
+
+class ConverterStats:
+
+    def __init__(self):
+        self.mLock = threading.Lock()
+        self.mStartTime = time.perf_counter()
+        self.mBlocksSubmitted = 0
+        self.mBytesZeroCopy = 0
+        self.mBytesCopied = 0
+        self.mNeedCopyBlockCalls = 0
+        self.mBytesWritten = 0
+        self.mBytesWrittenTime = self.mStartTime
+        self.mLatencies = {stage: LatencyHistogram() for stage in _stages}
+
+    def record_latency(self, stage, seconds):
+        with self.mLock:
+            self.mLatencies[stage].add(seconds)
+            if stage == STAGE_NEED_COPY_BLOCK:
+                self.mNeedCopyBlockCalls += 1
+
+    def record_block(self, num_bytes, zero_copy):
+        with self.mLock:
+            self.mBlocksSubmitted += 1
+            if zero_copy:
+                self.mBytesZeroCopy += num_bytes
+            else:
+                self.mBytesCopied += num_bytes
+
+    def record_bytes_written(self, total_bytes_written):
+        with self.mLock:
+            self.mBytesWritten = total_bytes_written
+            self.mBytesWrittenTime = time.perf_counter()
+
+    def get_bytes_written_per_second(self):
+        seconds = self.mBytesWrittenTime - self.mStartTime
+        return self.mBytesWritten / seconds if seconds > 0 else 0.0
+
+    def get_dict(self):
+        with self.mLock:
+            return {
+                'blocks_submitted': self.mBlocksSubmitted,
+                'bytes_zero_copy': self.mBytesZeroCopy,
+                'bytes_copied': self.mBytesCopied,
+                'need_copy_block_calls': self.mNeedCopyBlockCalls,
+                'bytes_written': self.mBytesWritten,
+                'bytes_written_per_second': self.get_bytes_written_per_second(),
+                'latency_seconds': {stage: histogram.get_dict() for stage, histogram in self.mLatencies.items()},
+            }
+
+    def get_prometheus_text(self, prefix='pyimariswriter'):
+        values = self.get_dict()
+        lines = []
+        for name, metric_type in [('blocks_submitted', 'counter'), ('bytes_zero_copy', 'counter'),
+                                  ('bytes_copied', 'counter'), ('need_copy_block_calls', 'counter'),
+                                  ('bytes_written', 'counter'), ('bytes_written_per_second', 'gauge')]:
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, metric_type))
+            lines.append('{}_{} {}'.format(prefix, name, values[name]))
+
+        name = '{}_latency_seconds'.format(prefix)
+        lines.append('# TYPE {} histogram'.format(name))
+        for stage, histogram in values['latency_seconds'].items():
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                le = '+Inf' if bound == 'inf' else bound
+                lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(name, stage, le, cumulative))
+            lines.append('{}_sum{{stage="{}"}} {}'.format(name, stage, histogram['sum']))
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
@@ -0,0 +1,159 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+Open ended time lapse acquisition
+
+ImageConverter needs the number of time points up front, so appended time points are
+spooled to a raw file on disk (not kept in RAM). Once timepoints_per_file time points are
+collected, or when the writer is closed, the spooled segment is converted into its own
+.ims file with the exact number of time points on a background thread, which finalizes
+its resolution levels and histograms. append() only writes the frame to the spool file,
+so its latency does not grow with the length of the series. A spooled segment is only
+removed after its .ims file was finished, if writing fails the spool directory is kept.
+"""
+
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from PyImarisWriter import PyImarisWriter as PW
+import PyImarisWriterBlocks as PWB
+import PyImarisWriterShards as PWShards
+import PyImarisWriterSources as PWS
+
+
+class TimeLapseWriter:
+    """
+    image_size.t is ignored. 't' must be the last (slowest) dimension of dimension_sequence.
+    With timepoints_per_file None all time points go to output_filename when close() is called,
+    otherwise segment files are named <output>_T<first time point><extension>.
+    """
+
+    def __init__(self, datatype, image_size, sample_size, dimension_sequence, block_size,
+                 output_filename, options, application_name, application_version, progress_callback_class,
+                 image_extents, parameters, color_infos, adjust_color_range=True,
+                 timepoints_per_file=None, spool_directory=None):
+        if dimension_sequence.get_sequence()[-1] != 't':
+            raise PW.PyImarisWriterException('Time lapse writing requires t as last dimension of the sequence')
+
+        self.mDataType = datatype
+        self.mNpType = PWB.get_np_type(datatype)
+        self.mImageSize = image_size
+        self.mSampleSize = sample_size
+        self.mDimensionSequence = dimension_sequence
+        self.mBlockSize = block_size
+        self.mOutputFilename = output_filename
+        self.mOptions = options
+        self.mApplicationName = application_name
+        self.mApplicationVersion = application_version
+        self.mProgressCallbackClass = progress_callback_class
+        self.mImageExtents = image_extents
+        self.mParameters = parameters
+        self.mColorInfos = color_infos
+        self.mAdjustColorRange = adjust_color_range
+        self.mTimepointsPerFile = timepoints_per_file
+
+        frame_size = PW.ImageSize(x=image_size.x, y=image_size.y, z=image_size.z, c=image_size.c, t=1)
+        self.mFrameGrid = PWB.BlockGrid(frame_size, frame_size, dimension_sequence)
+
+        self.mSpoolDirectory = tempfile.mkdtemp(prefix='PyImarisWriterTimeLapse', dir=spool_directory)
+        self.mExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='PyImarisWriterTimeLapse')
+        self.mSegments = []
+        self.mNumTimepoints = 0
+        self.mSegmentFirstTimepoint = 0
+        self.mSegmentTimeInfos = []
+        self.mSpoolFile = None
+
+    def _get_segment_filename(self):
+        if self.mTimepointsPerFile is None:
+            return self.mOutputFilename
+        stem, extension = os.path.splitext(self.mOutputFilename)
+        return '{}_T{:05d}{}'.format(stem, self.mSegmentFirstTimepoint, extension)
+
+    def _check_segments(self):
+        for _, future in self.mSegments:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+
+    def append(self, np_data, time_info=None):
+        """Appends one time point, np_data has the shape of the image without t"""
+        self._check_segments()
+        frame = self.mFrameGrid.as_image_array(np_data)
+        if self.mSpoolFile is None:
+            spool_filename = os.path.join(self.mSpoolDirectory, 'T{:05d}.raw'.format(self.mSegmentFirstTimepoint))
+            self.mSpoolFile = open(spool_filename, 'wb')
+        np.ascontiguousarray(frame, dtype=self.mNpType).tofile(self.mSpoolFile)
+        self.mSegmentTimeInfos.append(time_info or datetime.today())
+        self.mNumTimepoints += 1
+
+        if self.mTimepointsPerFile is not None and len(self.mSegmentTimeInfos) >= self.mTimepointsPerFile:
+            self._convert_segment()
+
+    def _convert_segment(self):
+        if self.mSpoolFile is None:
+            return
+        spool_filename = self.mSpoolFile.name
+        self.mSpoolFile.close()
+        self.mSpoolFile = None
+
+        output_filename = self._get_segment_filename()
+        future = self.mExecutor.submit(self._write_segment, spool_filename, output_filename, self.mSegmentTimeInfos)
+        self.mSegments.append((output_filename, future))
+        self.mSegmentFirstTimepoint = self.mNumTimepoints
+        self.mSegmentTimeInfos = []
+
+    def _write_segment(self, spool_filename, output_filename, time_infos):
+        image_size = PW.ImageSize(x=self.mImageSize.x, y=self.mImageSize.y, z=self.mImageSize.z,
+                                  c=self.mImageSize.c, t=len(time_infos))
+        converter = PWB.ImageConverter(self.mDataType, image_size, self.mSampleSize, self.mDimensionSequence,
+                                       self.mBlockSize, output_filename, self.mOptions, self.mApplicationName,
+                                       self.mApplicationVersion, self.mProgressCallbackClass)
+        try:
+            PWS.write_raw(converter, spool_filename, self.mNpType)
+            converter.Finish(self.mImageExtents, self.mParameters, time_infos, self.mColorInfos, self.mAdjustColorRange)
+        finally:
+            converter.Destroy()
+        # not reached if Finish failed, the spooled time points are kept for recovery
+        os.remove(spool_filename)
+
+    def get_num_timepoints(self):
+        return self.mNumTimepoints
+
+    def close(self, merge=False):
+        """
+        Converts the remaining time points and returns the names of the written files. With merge
+        the segment files are merged into output_filename and removed (see PyImarisWriterShards.merge_shards).
+        If a segment failed, the spool directory (mSpoolDirectory) with its time points is kept.
+        """
+        self._convert_segment()
+        self.mExecutor.shutdown(wait=True)
+        failed = [(filename, future.exception()) for filename, future in self.mSegments if future.exception() is not None]
+        if failed:
+            raise PW.PyImarisWriterException('Writing {} failed: {}, the spooled time points are kept in {}'.format(
+                failed[0][0], failed[0][1], self.mSpoolDirectory))
+        os.rmdir(self.mSpoolDirectory)
+
+        filenames = [filename for filename, _ in self.mSegments]
+        if merge and self.mTimepointsPerFile is not None:
+            PWShards.merge_shards(filenames, self.mOutputFilename, 't')
+            for filename in filenames:
+                os.remove(filename)
+            filenames = [self.mOutputFilename]
+        return filenames
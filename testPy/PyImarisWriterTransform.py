@@ -0,0 +1,132 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+Intensity transforms applied by ImageConverter.CopyBlock while staging a block
+
+Instead of converting the whole array before writing, the transform writes each block
+directly into the staging buffer of the producer thread. Scale, offset, clip and rounding
+run plane by plane in a small float work buffer, a LUT is a single take into the buffer.
+Producer threads transform their blocks in parallel, NumPy releases the GIL meanwhile.
+"""
+
+import threading
+
+import numpy as np
+
+from PyImarisWriter import PyImarisWriter as PW
+
+
+class IntensityTransform:
+    """
+    out = clip(data * scale + offset, clip_min, clip_max), rounded for integer image types,
+    or out = lut[data] for integer data (values beyond the LUT use its last entry).
+    clip defaults to the range of integer image types, so the cast never wraps around.
+    """
+
+    def __init__(self, scale=1.0, offset=0.0, clip=None, lut=None, description=None):
+        if lut is not None and (scale != 1.0 or offset != 0.0 or clip is not None):
+            raise PW.PyImarisWriterException('A LUT transform can not be combined with scale, offset or clip')
+        self.mScale = scale
+        self.mOffset = offset
+        self.mClip = clip
+        self.mLut = None if lut is None else np.asarray(lut)
+        self.mDescription = description
+        self.mNpType = None
+        self.mThreadLocal = threading.local()
+
+    def __getstate__(self):
+        # the work planes are per thread, e.g. for passing the transform to a batch worker process
+        state = self.__dict__.copy()
+        del state['mThreadLocal']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.mThreadLocal = threading.local()
+
+    def prepare(self, np_type):
+        """Binds the transform to the data type of the image, called by ImageConverter.set_transform"""
+        self.mNpType = np.dtype(np_type)
+        if self.mLut is not None:
+            self.mLut = np.ascontiguousarray(self.mLut, dtype=self.mNpType)
+        elif self.mClip is None and self.mNpType.kind in 'ui':
+            info = np.iinfo(self.mNpType)
+            self.mClip = (info.min, info.max)
+        if self.mDescription is None:
+            self.mDescription = self.get_default_description()
+
+    def get_default_description(self):
+        if self.mLut is not None:
+            return 'lut of {} values to {}'.format(len(self.mLut), self.mNpType.name)
+        description = 'scale {} offset {}'.format(self.mScale, self.mOffset)
+        if self.mClip is not None:
+            description += ' clip [{}, {}]'.format(*self.mClip)
+        return description + ' to {}'.format(self.mNpType.name)
+
+    def _get_work_plane(self, shape):
+        # one per producer thread, float64 keeps uint32 exact
+        work_type = np.float64 if self.mNpType.itemsize > 2 else np.float32
+        work = getattr(self.mThreadLocal, 'work_plane', None)
+        if work is None or work.shape != shape:
+            work = np.empty(shape, dtype=work_type)
+            self.mThreadLocal.work_plane = work
+        return work
+
+    def apply(self, block_data, out):
+        """Writes the transformed block_data into out of the same shape, both at least 2D"""
+        if self.mLut is not None:
+            if block_data.dtype.kind not in 'ui':
+                raise PW.PyImarisWriterException('A LUT transform requires integer data, got {}'.format(block_data.dtype))
+            for index in np.ndindex(block_data.shape[:-2]):
+                np.take(self.mLut, block_data[index], out=out[index], mode='clip')
+            return
+
+        work = self._get_work_plane(block_data.shape[-2:])
+        round_values = self.mNpType.kind in 'ui'
+        for index in np.ndindex(block_data.shape[:-2]):
+            np.multiply(block_data[index], self.mScale, out=work, dtype=work.dtype)
+            if self.mOffset != 0:
+                np.add(work, self.mOffset, out=work)
+            if self.mClip is not None:
+                np.clip(work, self.mClip[0], self.mClip[1], out=work)
+            if round_values:
+                np.rint(work, out=work)
+            np.copyto(out[index], work, casting='unsafe')
+
+
+def get_window_transform(window_min, window_max, num_input_values, np_type):
+    """
+    LUT transform mapping [window_min, window_max] linearly onto the range of the integer np_type,
+    e.g. 12 bit data stored in uint16 (num_input_values 4096) displayed as uint8.
+    """
+    if window_max <= window_min:
+        raise PW.PyImarisWriterException('Invalid window [{}, {}]'.format(window_min, window_max))
+    type_max = np.iinfo(np_type).max
+    values = (np.arange(num_input_values, dtype=np.float64) - window_min) * (type_max / (window_max - window_min))
+    lut = np.rint(np.clip(values, 0, type_max)).astype(np_type)
+    return IntensityTransform(lut=lut, description='window [{}, {}] of {} values to {}'.format(
+        window_min, window_max, num_input_values, np.dtype(np_type).name))
+
+
+def get_quantization_transform(value_min, value_max, np_type):
+    """Transform mapping [value_min, value_max] (e.g. of float32 data) onto the range of the integer np_type, clipping outside"""
+    if value_max <= value_min:
+        raise PW.PyImarisWriterException('Invalid value range [{}, {}]'.format(value_min, value_max))
+    type_max = np.iinfo(np_type).max
+    scale = type_max / (value_max - value_min)
+    return IntensityTransform(scale=scale, offset=-value_min * scale, clip=(0, type_max),
+                              description='quantize [{}, {}] to {}'.format(value_min, value_max, np.dtype(np_type).name))
@@ -0,0 +1,161 @@
+#/***************************************************************************
+# *   Copyright (c) 2020-present Bitplane AG Zuerich                        *
+# *                                                                         *
+# *   Licensed under the Apache License, Version 2.0 (the "License");       *
+# *   you may not use this file except in compliance with the License.      *
+# *   You may obtain a copy of the License at                               *
+# *                                                                         *
+# *       http://www.apache.org/licenses/LICENSE-2.0                        *
+# *                                                                         *
+# *   Unless required by applicable law or agreed to in writing, software   *
+# *   distributed under the License is distributed on an "AS IS" BASIS,     *
+# *   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or imp   *
+# *   See the License for the specific language governing permissions and   *
+# *   limitations under the License.                                        *
+# ***************************************************************************/
+
+"""
+Per block CRC32 checksums of the copied data and read-back verification of .ims files
+
+BlockChecksums records the CRC32 of every block (the part inside the image, in the numpy
+axis order of the converter) and is saved as JSON next to the output file. verify() reads
+resolution level 0 back with h5py from a pool of processes, each checking a share of the
+blocks, and reports the blocks whose checksum differs.
+
+    python PyImarisWriterVerify.py out.ims [out.ims.crc32.json]
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from PyImarisWriter import PyImarisWriter as PW
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+def get_checksum(block_data):
+    return zlib.crc32(np.ascontiguousarray(block_data)) & 0xffffffff
+
+
+class BlockChecksums:
+
+    def __init__(self, grid, np_type):
+        self.mGrid = grid
+        self.mNpType = np.dtype(np_type)
+        self.mChecksums = {}
+        self.mLock = threading.Lock()
+
+    def record_block(self, block, block_buffer):
+        """block_buffer is the full (possibly padded) block, only the part inside the image is summed"""
+        slices = self.mGrid.get_block_slices(block)
+        checksum = get_checksum(block_buffer[tuple(slice(0, s.stop - s.start) for s in slices)])
+        with self.mLock:
+            self.mChecksums[block] = checksum
+
+    def save(self, filename):
+        with open(filename, 'w') as checksum_file:
+            json.dump({
+                'image_shape': list(self.mGrid.mImageShape),
+                'block_shape': list(self.mGrid.mBlockShape),
+                'axes': list(self.mGrid.mAxes),
+                'dtype': self.mNpType.str,
+                'blocks': [[list(block), checksum] for block, checksum in sorted(self.mChecksums.items())],
+            }, checksum_file)
+
+
+class VerifyResult:
+
+    def __init__(self, num_blocks, mismatched_blocks, missing_blocks):
+        self.mNumBlocks = num_blocks
+        self.mMismatchedBlocks = mismatched_blocks
+        self.mMissingBlocks = missing_blocks
+
+    def is_ok(self):
+        return not self.mMismatchedBlocks and not self.mMissingBlocks
+
+    def print_report(self):
+        print('Verified {} blocks: {} mismatched, {} not readable'.format(
+            self.mNumBlocks, len(self.mMismatchedBlocks), len(self.mMissingBlocks)))
+        for block in self.mMismatchedBlocks:
+            print('  mismatch {}'.format(block))
+        for block in self.mMissingBlocks:
+            print('  not readable {}'.format(block))
+
+
+def read_block(ims_file, axes, image_shape, block_shape, block):
+    """Block of resolution level 0 in the numpy axis order of the converter"""
+    ranges = {}
+    for axis, index, block_extent, image_extent in zip(axes, block, block_shape, image_shape):
+        ranges[axis] = (index * block_extent, min((index + 1) * block_extent, image_extent))
+    (t0, t1), (c0, c1) = ranges['t'], ranges['c']
+    zyx = tuple(slice(*ranges[axis]) for axis in 'zyx')
+    data = np.stack([np.stack([ims_file['DataSet/ResolutionLevel 0/TimePoint {}/Channel {}/Data'.format(t, c)][zyx]
+                               for c in range(c0, c1)]) for t in range(t0, t1)])
+    return data.transpose(['tczyx'.index(axis) for axis in axes])
+
+
+def _verify_blocks(ims_filename, axes, image_shape, block_shape, blocks):
+    mismatched = []
+    missing = []
+    with h5py.File(ims_filename, 'r') as ims_file:
+        for block, checksum in blocks:
+            try:
+                data = read_block(ims_file, axes, image_shape, block_shape, block)
+            except KeyError:
+                missing.append(tuple(block))
+                continue
+            if get_checksum(data) != checksum:
+                mismatched.append(tuple(block))
+    return mismatched, missing
+
+
+def verify(ims_filename, checksum_filename=None, num_processes=None):
+    """Returns a VerifyResult, checksum_filename defaults to <ims_filename>.crc32.json"""
+    if h5py is None:
+        raise PW.PyImarisWriterException('Verifying .ims files requires the h5py package')
+    if checksum_filename is None:
+        checksum_filename = ims_filename + '.crc32.json'
+    with open(checksum_filename) as checksum_file:
+        checksums = json.load(checksum_file)
+
+    blocks = checksums['blocks']
+    num_processes = num_processes or os.cpu_count() or 1
+    share = max(1, math.ceil(len(blocks) / (4 * num_processes)))
+    mismatched = []
+    missing = []
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        futures = [executor.submit(_verify_blocks, ims_filename, checksums['axes'], checksums['image_shape'],
+                                   checksums['block_shape'], blocks[start:start + share])
+                   for start in range(0, len(blocks), share)]
+        for future in futures:
+            share_mismatched, share_missing = future.result()
+            mismatched.extend(share_mismatched)
+            missing.extend(share_missing)
+    return VerifyResult(len(blocks), mismatched, missing)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify an .ims file against the block checksums recorded while writing')
+    parser.add_argument('ims_filename')
+    parser.add_argument('checksum_filename', nargs='?', default=None)
+    parser.add_argument('-processes', type=int, default=None, help='Number of reading processes (default: cores)')
+    args = parser.parse_args()
+
+    result = verify(args.ims_filename, args.checksum_filename, args.processes)
+    result.print_report()
+    return 0 if result.is_ok() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -16,10 +16,37 @@
  
 """ Unit Tests for PyImarisWriter classes"""
 
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+from unittest import mock
 from datetime import datetime
 
+import numpy as np
+
 from PyImarisWriter import PyImarisWriter as PW
+import ImarisWriterCtypesLibrary as IWL
+import ImarisWriterCtypesTest as IWTest
+import PyImarisWriterAutotune as PWAutotune
+import PyImarisWriterBatch as PWBatch
+import PyImarisWriterBenchmark as PWBenchmark
+import PyImarisWriterBlocks as PWB
+import PyImarisWriterChannelStats as PWChannelStats
+import PyImarisWriterCompression as PWCompression
+import PyImarisWriterMosaic as PWMosaic
+import PyImarisWriterPipeline as PWP
+import PyImarisWriterProgress as PWProgress
+import PyImarisWriterShards as PWShards
+import PyImarisWriterSources as PWS
+import PyImarisWriterStats as PWStats
+import PyImarisWriterTimeLapse as PWTimeLapse
+import PyImarisWriterTransform as PWT
+import PyImarisWriterVerify as PWVerify
 
 
 class TestImageSize(unittest.TestCase):
@@ -244,5 +271,1124 @@ class TestImageConverter(unittest.TestCase):
         self.assertEqual(c_time_info.mNanosecondsOfDay, int(nanoseconds))
 
 
+class TestCtypesLibrary(unittest.TestCase):
+
+    def test_library_filename_override(self):
+        with mock.patch.dict(os.environ, {IWL.library_environment_variable: '/opt/imaris/libwriter.so'}):
+            self.assertEqual(IWL.get_library_filename(), '/opt/imaris/libwriter.so')
+
+    def test_library_loaded_once(self):
+        with mock.patch.object(IWL, '_library', None), mock.patch.object(IWL.IW, 'CDLL') as cdll:
+            library = IWL.get_library()
+            self.assertIs(IWL.get_library(), library)
+            self.assertIs(IWL.bpImageConverterC_Finish, library.bpImageConverterC_Finish)
+            cdll.assert_called_once()
+
+            restype, argtypes = IWL._signatures['bpImageConverterC_GetLastException']
+            self.assertIs(library.bpImageConverterC_GetLastException.restype, restype)
+            self.assertEqual(library.bpImageConverterC_CopyBlockUInt16.argtypes,
+                             IWL._signatures['bpImageConverterC_CopyBlockUInt16'][1])
+
+        with self.assertRaises(AttributeError):
+            IWL.bpImageConverterC_Unknown
+
+
+class TestCtypesCallbackData(unittest.TestCase):
+
+    def test_registered_user_data(self):
+        user_data = IWTest.IW.bpCallbackData()
+        user_data.mImageIndex = 3
+        address = IWTest.IW.addressof(user_data)
+
+        # not registered: cast on every update, nothing is cached
+        self.assertEqual(IWTest.get_callback_data(address).mImageIndex, 3)
+        self.assertNotIn(address, IWTest.callback_data)
+
+        with mock.patch.dict(IWTest.callback_data, {address: user_data}):
+            self.assertIs(IWTest.get_callback_data(address), user_data)
+        self.assertNotIn(address, IWTest.callback_data)
+
+
+class TestCtypesFinishStructs(unittest.TestCase):
+
+    def test_time_infos(self):
+        c_time_infos = IWL.get_c_time_infos([datetime(2020, 2, 5, 15, 27, 4), datetime(2021, 6, 1)]).contents
+        self.assertEqual(c_time_infos.mValuesCount, 2)
+        self.assertEqual(c_time_infos.mValues[0].mJulianDay, 2458885)
+        self.assertEqual(c_time_infos.mValues[0].mNanosecondsOfDay, (4 + 60 * (27 + 60 * 15)) * 10 ** 9)
+        self.assertEqual(c_time_infos.mValues[1].mJulianDay, 2459367)
+        self.assertEqual(c_time_infos.mValues[1].mNanosecondsOfDay, 0)
+
+    def test_color_infos(self):
+        c_color_infos = IWL.get_c_color_infos([(0, 255), (10, 4000)], opacity=[0, 0.5]).contents
+        self.assertEqual(c_color_infos.mValuesCount, 2)
+        first, second = c_color_infos.mValues[0], c_color_infos.mValues[1]
+        self.assertTrue(first.mIsBaseColorMode)
+        self.assertEqual((first.mBaseColor.mRed, first.mBaseColor.mGreen, first.mBaseColor.mAlpha), (1, 0, 1))
+        self.assertEqual((second.mBaseColor.mRed, second.mBaseColor.mGreen), (0, 1))
+        self.assertEqual((second.mRangeMin, second.mRangeMax, second.mOpacity), (10, 4000, 0.5))
+        self.assertEqual(second.mGammaCorrection, 1)
+
+    def test_converter_finish_structs(self):
+        image_size = PW.ImageSize(x=4, y=4, z=1, c=2, t=1)
+        with tempfile.TemporaryDirectory() as directory:
+            converter = PWB.ImageConverter('uint16', image_size, PW.ImageSize(x=1, y=1, z=1, c=1, t=1),
+                                           PW.DimensionSequence('x', 'y', 'z', 'c', 't'), image_size,
+                                           os.path.join(directory, 'PyImarisWriterFinishTest.ims'), PW.Options(),
+                                           'UnitTestPyImarisWriter', '0', PW.CallbackClass())
+            try:
+                color_infos = [PW.ColorInfo(), PW.ColorInfo()]
+                color_infos[1].set_base_color(PW.Color(0, 0.5, 1, 1))
+                color_infos[1].mRangeMin = 100
+                color_infos[1].mRangeMax = 2000
+                c_color_infos = converter._get_c_color_infos(color_infos).contents
+                c_time_infos = converter._get_c_time_infos([datetime(2020, 2, 5)]).contents
+                color_infos[0].set_color_table([PW.Color(0, 0, 0, 1), PW.Color(1, 1, 1, 1)])
+                c_table_color_infos = converter._get_c_color_infos(color_infos).contents
+            finally:
+                converter.Destroy()
+
+        second = c_color_infos.mValues[1]
+        self.assertTrue(second.mIsBaseColorMode)
+        self.assertEqual((second.mBaseColor.mGreen, second.mBaseColor.mBlue), (0.5, 1))
+        self.assertEqual((second.mRangeMin, second.mRangeMax), (100, 2000))
+        self.assertEqual(c_time_infos.mValues[0].mJulianDay, 2458885)
+
+        # color tables are built by PW.ImageConverter
+        first = c_table_color_infos.mValues[0]
+        self.assertFalse(first.mIsBaseColorMode)
+        self.assertEqual(first.mColorTableSize, 2)
+        self.assertEqual(first.mColorTable[1].mGreen, 1)
+        self.assertEqual(c_table_color_infos.mValues[1].mRangeMax, 2000)
+
+
+class TestBlockGrid(unittest.TestCase):
+
+    def setUp(self):
+        image_size = PW.ImageSize(x=10, y=7, z=5, c=2, t=1)
+        block_size = PW.ImageSize(x=4, y=4, z=2, c=1, t=1)
+        dimension_sequence = PW.DimensionSequence('x', 'y', 'z', 'c', 't')
+        self.grid = PWB.BlockGrid(image_size, block_size, dimension_sequence)
+
+    def test_num_blocks(self):
+        self.assertEqual(self.grid.mImageShape, (1, 2, 5, 7, 10))
+        self.assertEqual(self.grid.mNumBlocks, (1, 2, 3, 2, 3))
+        self.assertEqual(self.grid.get_num_blocks(), 36)
+        self.assertEqual(len(list(self.grid.iter_blocks())), 36)
+
+    def test_edge_block_slices(self):
+        slices = self.grid.get_block_slices((0, 1, 2, 1, 2))
+        self.assertEqual(slices, (slice(0, 1), slice(1, 2), slice(4, 5), slice(4, 7), slice(8, 10)))
+
+        block_index = self.grid.get_block_index((0, 1, 2, 1, 2))
+        self.assertEqual((block_index.x, block_index.y, block_index.z, block_index.c, block_index.t), (2, 1, 2, 1, 0))
+
+    def test_iter_blocks_in_order(self):
+        mask = np.ones(self.grid.mNumBlocks, dtype=bool)
+        self.assertEqual(list(self.grid.iter_blocks_in_order(mask)), list(self.grid.iter_blocks()))
+
+        blocks = list(self.grid.iter_blocks_in_order(mask, order='zyxct'))
+        self.assertEqual(blocks[:3], [(0, 0, 0, 0, 0), (0, 0, 1, 0, 0), (0, 0, 2, 0, 0)])
+        self.assertEqual(len(blocks), 36)
+
+        mask[:] = False
+        mask[0, 1, 2, 1, 2] = True
+        self.assertEqual(list(self.grid.iter_blocks_in_order(mask, PW.DimensionSequence('t', 'c', 'z', 'y', 'x'))),
+                         [(0, 1, 2, 1, 2)])
+
+    def test_image_array(self):
+        np_data = np.zeros((5, 7, 10), dtype=np.uint8)
+        with self.assertRaises(PW.PyImarisWriterException):
+            self.grid.as_image_array(np_data)
+
+        np_data = np.zeros((2, 5, 7, 10), dtype=np.uint8)
+        image = self.grid.as_image_array(np_data)
+        self.assertEqual(image.shape, (1, 2, 5, 7, 10))
+        self.assertTrue(np.shares_memory(image, np_data))
+
+        transposed = np_data.transpose()
+        image = self.grid.as_image_array(transposed, PW.DimensionSequence('c', 'z', 'y', 'x', 't'))
+        self.assertEqual(image.shape, (1, 2, 5, 7, 10))
+
+    def test_array_layout(self):
+        # (z, y, x) array in Fortran order, i.e. z is the fastest dimension in memory
+        np_data = np.asfortranarray(np.arange(3 * 5 * 700, dtype=np.uint16).reshape(3, 5, 700))
+        image_size, dimension_sequence, block_size, axes_sequence = PWB.get_array_layout(np_data, 'zyx', 1000)
+        self.assertEqual(dimension_sequence.get_sequence(), ['z', 'y', 'x', 'c', 't'])
+        self.assertEqual((image_size.x, image_size.y, image_size.z, image_size.c), (700, 5, 3, 1))
+        self.assertEqual((block_size.x, block_size.y, block_size.z), (66, 5, 3))
+
+        grid = PWB.BlockGrid(image_size, block_size, dimension_sequence)
+        image = grid.as_image_array(np_data, axes_sequence)
+        self.assertTrue(image.flags.c_contiguous)
+        self.assertTrue(np.shares_memory(image, np_data))
+
+        permuted = np.zeros((2, 4, 6), dtype=np.uint8).transpose(2, 0, 1)
+        self.assertEqual(PWB.get_memory_sequence(permuted, 'xct').get_sequence(), ['x', 't', 'c', 'y', 'z'])
+
+        with self.assertRaises(PW.PyImarisWriterException):
+            PWB.get_memory_sequence(permuted, 'xyx')
+
+    def test_raw_source_blocks(self):
+        np_data = np.arange(2 * 5 * 7 * 10, dtype=np.uint16).reshape((2, 5, 7, 10))
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'image.raw')
+            np_data.tofile(filename)
+
+            image = PWS.open_raw(self.grid, filename, np.uint16)
+            blocks = list(PWS.iter_source_blocks(self.grid, lambda slices: np.array(image[slices])))
+            self.assertEqual(len(blocks), self.grid.get_num_blocks())
+            for block, block_data in blocks:
+                expected = self.grid.as_image_array(np_data)[self.grid.get_block_slices(block)]
+                self.assertTrue(np.array_equal(block_data, expected))
+            del image
+
+
+class TestBlockImageConverter(unittest.TestCase):
+
+    def setUp(self):
+        image_size = PW.ImageSize(x=10, y=7, z=5, c=1, t=1)
+        block_size = PW.ImageSize(x=4, y=4, z=5, c=1, t=1)
+        sample_size = PW.ImageSize(x=1, y=1, z=1, c=1, t=1)
+        dimension_sequence = PW.DimensionSequence('x', 'y', 'z', 'c', 't')
+        self.directory = tempfile.TemporaryDirectory()
+        self.output_filename = os.path.join(self.directory.name, 'PyImarisWriterBlocksTest.ims')
+        self.converter = PWB.ImageConverter('uint16', image_size, sample_size, dimension_sequence, block_size,
+                                            self.output_filename, PW.Options(), 'UnitTestPyImarisWriter', '0',
+                                            PW.CallbackClass())
+
+    def tearDown(self):
+        self.converter.Destroy()
+        self.directory.cleanup()
+
+    def test_output_path(self):
+        # the c_char_p passed to the native writer stays referenced
+        self.assertEqual(self.converter.mOutputFilename.value, self.output_filename.encode())
+        self.assertEqual(self.converter.mOutputPath, self.output_filename)
+
+    def test_copy_modes(self):
+        block_index = PW.ImageSize(x=0, y=0, z=0, c=0, t=0)
+
+        self.converter.CopyBlock(np.zeros((5, 4, 4), dtype=np.uint16), block_index)
+        self.assertEqual(self.converter.mLastCopyMode, PWB.COPY_MODE_ZERO_COPY)
+
+        self.converter.CopyBlock((PW.c_uint16 * 80)(), block_index)
+        self.assertEqual(self.converter.mLastCopyMode, PWB.COPY_MODE_ZERO_COPY)
+
+        self.converter.CopyBlock(np.zeros((5, 4, 4), dtype=np.uint8), block_index)
+        self.assertEqual(self.converter.mLastCopyMode, PWB.COPY_MODE_CAST)
+
+        self.converter.CopyBlock(np.zeros((4, 4, 5), dtype=np.uint16).transpose(), block_index)
+        self.assertEqual(self.converter.mLastCopyMode, PWB.COPY_MODE_GATHER)
+
+        edge_block_index = PW.ImageSize(x=2, y=1, z=0, c=0, t=0)
+        self.converter.CopyBlock(np.zeros((5, 3, 2), dtype=np.uint16), edge_block_index)
+        self.assertEqual(self.converter.mLastCopyMode, PWB.COPY_MODE_GATHER)
+
+        self.assertEqual(self.converter.get_copy_mode_counts(),
+                         {PWB.COPY_MODE_ZERO_COPY: 2, PWB.COPY_MODE_CAST: 1, PWB.COPY_MODE_GATHER: 2,
+                          PWB.COPY_MODE_CONSTANT_BUFFER: 0})
+
+        with self.assertRaises(PW.PyImarisWriterException):
+            self.converter.CopyBlock(np.zeros((5, 5, 4), dtype=np.uint16), block_index)
+
+    def test_constant_buffers(self):
+        self.converter.mReuseConstantBuffers = True
+        stats = self.converter.enable_stats()
+        np_data = np.full((5, 7, 10), 100, dtype=np.uint8)
+        np_data[0, 0, 0] = 0
+        self.converter.write_array(np_data)
+
+        self.assertEqual(self.converter.get_copy_mode_counts()[PWB.COPY_MODE_CONSTANT_BUFFER], 5)
+        self.assertEqual(len(self.converter.mConstantBuffers), 1)
+        # every block still goes through the native CopyBlock
+        self.assertEqual(stats.get_dict()['blocks_submitted'], 6)
+        self.assertEqual(stats.get_dict()['latency_seconds'][PWStats.STAGE_COPY_BLOCK]['count'], 6)
+
+    def test_concurrent_producers(self):
+        grid = self.converter.mBlockGrid
+        blocks = list(grid.iter_blocks())
+        num_producers = 4
+        errors = []
+
+        def produce(producer):
+            try:
+                for block in blocks[producer::num_producers]:
+                    # uint8 data is cast into the scratch block of the producer thread
+                    block_data = np.full(grid.mBlockShape, producer, dtype=np.uint8)
+                    for _ in range(50):
+                        self.converter.CopyBlock(block_data, grid.get_block_index(block))
+            except Exception as exception:
+                errors.append(exception)
+
+        threads = [threading.Thread(target=produce, args=(producer,)) for producer in range(num_producers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertTrue(self.converter.mCopiedBlocks.all())
+        self.assertEqual(sum(self.converter.get_copy_mode_counts().values()), 50 * len(blocks))
+
+    def test_write_array_producers(self):
+        np_data = np.arange(350, dtype=np.uint16).reshape(5, 7, 10)
+        self.converter.write_array(np_data, num_producers=3)
+        self.assertTrue(self.converter.mCopiedBlocks.all())
+        self.assertEqual(self.converter.get_copy_mode_counts()[PWB.COPY_MODE_GATHER], 6)
+
+
+class RecordingImageConverter(PWB.ImageConverter):
+
+    def CopyBlock(self, block_data, block_index):
+        super().CopyBlock(block_data, block_index)
+        self.mRecordedBlocks[self.mBlockGrid.get_block(block_index)] = np.array(block_data)
+
+
+class FailingNativeConverter(PW.ImageConverter):
+    """
+    Below PWB.ImageConverter in the MRO, simulates the native writer: the failure of the
+    mFailingCall-th CopyBlock is pending until _check_errors, called after every CopyBlock
+    like in PW.ImageConverter. The titles of the checks are recorded in mCheckTitles.
+    """
+
+    def CopyBlock(self, block_data, block_index):
+        self.mNumCalls += 1
+        if self.mNumCalls == self.mFailingCall:
+            self.mPendingException = 'disk full'
+        self._check_errors('CopyBlock {}'.format(block_index))
+
+    def _check_errors(self, title):
+        self.mCheckTitles.append(title)
+        if self.mPendingException is not None:
+            exception, self.mPendingException = self.mPendingException, None
+            raise PW.PyImarisWriterException('{}: {}'.format(title, exception))
+
+
+class DeferredErrorImageConverter(PWB.ImageConverter, FailingNativeConverter):
+    pass
+
+
+class TestDeferredErrorCheck(unittest.TestCase):
+
+    def setUp(self):
+        image_size = PW.ImageSize(x=32, y=4, z=1, c=1, t=1)
+        block_size = PW.ImageSize(x=4, y=4, z=1, c=1, t=1)
+        self.directory = tempfile.TemporaryDirectory()
+        self.converter = DeferredErrorImageConverter('uint8', image_size, PW.ImageSize(x=1, y=1, z=1, c=1, t=1),
+                                                     PW.DimensionSequence('x', 'y', 'z', 'c', 't'), block_size,
+                                                     os.path.join(self.directory.name, 'PyImarisWriterErrorTest.ims'),
+                                                     PW.Options(), 'UnitTestPyImarisWriter', '0', PW.CallbackClass())
+        self.converter.mNumCalls = 0
+        self.converter.mCheckTitles = []
+        self.converter.mPendingException = None
+
+    def tearDown(self):
+        self.converter.Destroy()
+        self.directory.cleanup()
+
+    def test_deferred_failure_report(self):
+        self.converter.mFailingCall = 5
+        self.converter.set_error_check(4)
+        self.converter.mProgressRecorder.RecordProgress(0.1, 1234)
+        with self.assertRaises(PW.PyImarisWriterException) as context:
+            self.converter.write_array(np.zeros((4, 32), dtype=np.uint8))
+
+        exception = context.exception
+        # checked after blocks 4 and 8, the failure of block 5 surfaces at the second check
+        self.assertEqual(len(self.converter.mCheckTitles), 2)
+        self.assertTrue(self.converter.mCheckTitles[1].startswith('CopyBlock '))
+        self.assertEqual(exception.mNumBlocks, 8)
+        self.assertEqual(exception.mFirstUncheckedBlock, 4)
+        self.assertEqual(exception.mBlockIndex, (0, 0, 0, 0, 7))
+        self.assertEqual(exception.mBytesSubmitted, 8 * 16)
+        self.assertEqual(exception.mBytesWritten, 1234)
+        self.assertIn('disk full', str(exception))
+
+    def test_finish_checks_pending_blocks(self):
+        self.converter.mFailingCall = 2
+        self.converter.set_error_check(64)
+        self.converter.write_array(np.zeros((4, 32), dtype=np.uint8))
+        self.assertEqual(self.converter.mCheckTitles, [])
+
+        with self.assertRaises(PW.PyImarisWriterException) as context:
+            self.converter.Finish(PW.ImageExtents(0, 0, 0, 32, 4, 1), PW.Parameters(), [datetime.today()],
+                                  [PW.ColorInfo()], False)
+        self.assertEqual(context.exception.mFirstUncheckedBlock, 0)
+        self.assertEqual(context.exception.mNumBlocks, 8)
+        self.assertEqual(self.converter.mCheckTitles, ['CopyBlock (checked by Finish)'])
+
+    def test_strict(self):
+        self.converter.mFailingCall = 2
+        with self.assertRaises(PW.PyImarisWriterException):
+            self.converter.write_array(np.zeros((4, 32), dtype=np.uint8))
+        self.assertEqual(len(self.converter.mCheckTitles), 2)
+
+
+class TestMosaicWriter(unittest.TestCase):
+
+    def setUp(self):
+        image_size = PW.ImageSize(x=10, y=4, z=1, c=1, t=1)
+        block_size = PW.ImageSize(x=4, y=4, z=1, c=1, t=1)
+        sample_size = PW.ImageSize(x=1, y=1, z=1, c=1, t=1)
+        dimension_sequence = PW.DimensionSequence('x', 'y', 'z', 'c', 't')
+        self.directory = tempfile.TemporaryDirectory()
+        self.converter = RecordingImageConverter('uint8', image_size, sample_size, dimension_sequence, block_size,
+                                                 os.path.join(self.directory.name, 'PyImarisWriterMosaicTest.ims'),
+                                                 PW.Options(), 'UnitTestPyImarisWriter', '0', PW.CallbackClass())
+        self.converter.mRecordedBlocks = {}
+        # tile 0 covers x 0-5, tile 1 covers x 4-9, the block at x 4-7 needs both
+        self.tile_positions = [({'x': 0}, (4, 6)), ({'x': 4}, (4, 6))]
+
+    def tearDown(self):
+        self.converter.Destroy()
+        self.directory.cleanup()
+
+    def test_last_wins(self):
+        mosaic = PWMosaic.MosaicWriter(self.converter, self.tile_positions)
+        mosaic.add_tile(0, np.full((4, 6), 10, dtype=np.uint8))
+        self.assertEqual(list(self.converter.mRecordedBlocks), [(0, 0, 0, 0, 0)])
+        self.assertEqual(mosaic.get_num_buffered_blocks(), 1)
+
+        mosaic.add_tile(1, np.full((4, 6), 20, dtype=np.uint8))
+        mosaic.close()
+        self.assertEqual(mosaic.get_num_buffered_blocks(), 0)
+        self.assertEqual(mosaic.mPeakBufferedBlocks, 1)
+        self.assertEqual(self.converter.mRecordedBlocks[(0, 0, 0, 0, 1)].ravel().tolist(), [20] * 16)
+        self.assertEqual(self.converter.mRecordedBlocks[(0, 0, 0, 0, 2)].shape, (1, 1, 1, 4, 2))
+        self.assertTrue(self.converter.mCopiedBlocks.all())
+
+    def test_blend(self):
+        mosaic = PWMosaic.MosaicWriter(self.converter, self.tile_positions, PWMosaic.POLICY_BLEND)
+        mosaic.add_tile(1, np.full((4, 6), 20, dtype=np.uint8))
+        mosaic.add_tile(0, np.full((4, 6), 10, dtype=np.uint8))
+        mosaic.close()
+        self.assertEqual(self.converter.mRecordedBlocks[(0, 0, 0, 0, 1)][0, 0, 0, 0].tolist(), [15, 15, 20, 20])
+
+    def test_blend_float(self):
+        image_size = PW.ImageSize(x=10, y=4, z=1, c=1, t=1)
+        block_size = PW.ImageSize(x=4, y=4, z=1, c=1, t=1)
+        converter = RecordingImageConverter('float32', image_size, PW.ImageSize(x=1, y=1, z=1, c=1, t=1),
+                                            PW.DimensionSequence('x', 'y', 'z', 'c', 't'), block_size,
+                                            os.path.join(self.directory.name, 'PyImarisWriterMosaicFloatTest.ims'),
+                                            PW.Options(), 'UnitTestPyImarisWriter', '0', PW.CallbackClass())
+        converter.mRecordedBlocks = {}
+        try:
+            mosaic = PWMosaic.MosaicWriter(converter, self.tile_positions, PWMosaic.POLICY_BLEND)
+            mosaic.add_tile(0, np.full((4, 6), 0.0, dtype=np.float32))
+            mosaic.add_tile(1, np.full((4, 6), 0.5, dtype=np.float32))
+            mosaic.close()
+            # overlaps are averaged, not rounded
+            self.assertEqual(converter.mRecordedBlocks[(0, 0, 0, 0, 1)][0, 0, 0, 0].tolist(), [0.25, 0.25, 0.5, 0.5])
+        finally:
+            converter.Destroy()
+
+    def test_tile_outside_image(self):
+        with self.assertRaises(PW.PyImarisWriterException):
+            PWMosaic.MosaicWriter(self.converter, [({'x': 8}, (4, 6))])
+
+
+class TestConversionJournal(unittest.TestCase):
+
+    def create_converter(self, output_filename):
+        image_size = PW.ImageSize(x=10, y=7, z=5, c=1, t=1)
+        block_size = PW.ImageSize(x=4, y=4, z=5, c=1, t=1)
+        sample_size = PW.ImageSize(x=1, y=1, z=1, c=1, t=1)
+        dimension_sequence = PW.DimensionSequence('x', 'y', 'z', 'c', 't')
+        converter = RecordingImageConverter('uint16', image_size, sample_size, dimension_sequence, block_size,
+                                            output_filename, PW.Options(), 'UnitTestPyImarisWriter', '0',
+                                            PW.CallbackClass())
+        converter.mRecordedBlocks = {}
+        return converter
+
+    def test_resume(self):
+        np_data = np.arange(350, dtype=np.uint16).reshape(5, 7, 10)
+        with tempfile.TemporaryDirectory() as directory:
+            output_filename = os.path.join(directory, 'PyImarisWriterJournalTest.ims')
+
+            # interrupted after 4 of 6 blocks
+            converter = self.create_converter(output_filename)
+            journal = converter.enable_journal(checkpoint_interval=3600)
+            grid = converter.mBlockGrid
+            image = grid.as_image_array(np_data)
+            for block in list(converter.iter_blocks())[:4]:
+                converter.CopyBlock(image[grid.get_block_slices(block)], grid.get_block_index(block))
+            self.assertEqual(journal.mNumResumedBlocks, 0)
+            converter.Destroy()
+
+            converter = self.create_converter(output_filename)
+            journal = converter.enable_journal()
+            self.assertEqual(journal.mNumResumedBlocks, 4)
+            self.assertEqual(len(list(converter.iter_blocks())), 2)
+            recorded = converter.mRecordedBlocks[(0, 0, 0, 0, 2)]
+            self.assertEqual(recorded[0, 0, :, :, :2].tolist(), image[0, 0, :, 0:4, 8:10].tolist())
+
+            converter.write_array(np_data)
+            self.assertEqual(len(converter.mRecordedBlocks), 6)
+            converter.Finish(PW.ImageExtents(0, 0, 0, 10, 7, 5), PW.Parameters(), [datetime.today()],
+                             [PW.ColorInfo()], False)
+            converter.Destroy()
+            self.assertFalse(os.path.exists(output_filename + '.journal'))
+
+    def interrupt(self, output_filename, image, read_block):
+        # interrupted after 4 of 6 blocks
+        converter = self.create_converter(output_filename)
+        converter.enable_journal(checkpoint_interval=3600, read_block=read_block)
+        grid = converter.mBlockGrid
+        for block in list(converter.iter_blocks())[:4]:
+            converter.CopyBlock(image[grid.get_block_slices(block)], grid.get_block_index(block))
+        converter.Destroy()
+
+    def test_resume_from_source(self):
+        np_data = np.arange(350, dtype=np.uint16).reshape(5, 7, 10)
+        with tempfile.TemporaryDirectory() as directory:
+            output_filename = os.path.join(directory, 'PyImarisWriterJournalTest.ims')
+            converter = self.create_converter(output_filename)
+            grid = converter.mBlockGrid
+            converter.Destroy()
+            image = grid.as_image_array(np_data)
+            read_blocks = []
+
+            def read_block(block):
+                read_blocks.append(block)
+                return image[grid.get_block_slices(block)]
+
+            self.interrupt(output_filename, image, read_block)
+            # index only: no block data next to the output
+            self.assertEqual(sorted(os.listdir(output_filename + '.journal')), ['checksums.npy', 'completed.npy', 'state.json'])
+
+            converter = self.create_converter(output_filename)
+            journal = converter.enable_journal(read_block=read_block)
+            self.assertEqual(journal.mNumResumedBlocks, 4)
+            self.assertEqual(len(read_blocks), 4)
+            self.assertEqual(len(list(converter.iter_blocks())), 2)
+            converter.write_array(np_data)
+            self.assertEqual(len(converter.mRecordedBlocks), 6)
+            converter.Destroy()
+
+    def test_resume_from_changed_source(self):
+        np_data = np.arange(350, dtype=np.uint16).reshape(5, 7, 10)
+        with tempfile.TemporaryDirectory() as directory:
+            output_filename = os.path.join(directory, 'PyImarisWriterJournalTest.ims')
+            converter = self.create_converter(output_filename)
+            grid = converter.mBlockGrid
+            converter.Destroy()
+            image = grid.as_image_array(np_data)
+            self.interrupt(output_filename, image, lambda block: image[grid.get_block_slices(block)])
+
+            changed = image + 1
+            converter = self.create_converter(output_filename)
+            try:
+                with self.assertRaises(PW.PyImarisWriterException):
+                    converter.enable_journal(read_block=lambda block: changed[grid.get_block_slices(block)])
+            finally:
+                converter.Destroy()
+
+
+class TestBlockChecksums(unittest.TestCase):
+
+    def test_checksums_match_read_back(self):
+        image_size = PW.ImageSize(x=10, y=7, z=5, c=2, t=1)
+        block_size = PW.ImageSize(x=4, y=4, z=5, c=1, t=1)
+        sample_size = PW.ImageSize(x=1, y=1, z=1, c=1, t=1)
+        dimension_sequence = PW.DimensionSequence('x', 'y', 'z', 'c', 't')
+        np_data = np.arange(700, dtype=np.uint16).reshape(2, 5, 7, 10)
+        with tempfile.TemporaryDirectory() as directory:
+            output_filename = os.path.join(directory, 'PyImarisWriterVerifyTest.ims')
+            converter = PWB.ImageConverter('uint16', image_size, sample_size, dimension_sequence, block_size,
+                                           output_filename, PW.Options(), 'UnitTestPyImarisWriter', '0',
+                                           PW.CallbackClass())
+            checksums = converter.enable_checksums()
+            converter.write_array(np_data)
+            converter.Finish(PW.ImageExtents(0, 0, 0, 10, 7, 5), PW.Parameters(), [datetime.today()],
+                             [PW.ColorInfo(), PW.ColorInfo()], False)
+            converter.Destroy()
+            self.assertTrue(os.path.exists(output_filename + '.crc32.json'))
+
+        # resolution level 0 as h5py would return it
+        ims_file = {'DataSet/ResolutionLevel 0/TimePoint 0/Channel {}/Data'.format(c): np_data[c] for c in range(2)}
+        grid = converter.mBlockGrid
+        self.assertEqual(len(checksums.mChecksums), 12)
+        for block, checksum in checksums.mChecksums.items():
+            data = PWVerify.read_block(ims_file, grid.mAxes, grid.mImageShape, grid.mBlockShape, block)
+            self.assertEqual(PWVerify.get_checksum(data), checksum)
+
+        ims_file['DataSet/ResolutionLevel 0/TimePoint 0/Channel 1/Data'] = np_data[1] + 1
+        data = PWVerify.read_block(ims_file, grid.mAxes, grid.mImageShape, grid.mBlockShape, (0, 1, 0, 0, 0))
+        self.assertNotEqual(PWVerify.get_checksum(data), checksums.mChecksums[(0, 1, 0, 0, 0)])
+
+
+class TestTimeLapseWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.finished = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def get_writer(self, timepoints_per_file=None):
+        image_size = PW.ImageSize(x=6, y=4, z=2, c=1, t=1)
+        return PWTimeLapse.TimeLapseWriter('uint16', image_size, PW.ImageSize(x=1, y=1, z=1, c=1, t=1),
+                                           PW.DimensionSequence('x', 'y', 'z', 'c', 't'), image_size,
+                                           os.path.join(self.directory.name, 'timelapse.ims'), PW.Options(),
+                                           'UnitTestPyImarisWriter', '0', PW.CallbackClass(),
+                                           PW.ImageExtents(0, 0, 0, 6, 4, 2), PW.Parameters(), [PW.ColorInfo()],
+                                           timepoints_per_file=timepoints_per_file, spool_directory=self.directory.name)
+
+    def append_timepoints(self, writer, num_timepoints):
+        original_finish = PWB.ImageConverter.Finish
+
+        def finish(converter, image_extents, parameters, time_infos, color_infos, adjust_color_range):
+            self.finished.append((converter.mBlockGrid.mImageShape[0], len(time_infos), bool(converter.mCopiedBlocks.all())))
+            original_finish(converter, image_extents, parameters, time_infos, color_infos, adjust_color_range)
+
+        with mock.patch.object(PWB.ImageConverter, 'Finish', finish):
+            for t in range(num_timepoints):
+                writer.append(np.full((2, 4, 6), t, dtype=np.uint16))
+            return writer.close()
+
+    def test_single_file(self):
+        writer = self.get_writer()
+        filenames = self.append_timepoints(writer, 3)
+        self.assertEqual(filenames, [os.path.join(self.directory.name, 'timelapse.ims')])
+        self.assertEqual(self.finished, [(3, 3, True)])
+        self.assertEqual(writer.get_num_timepoints(), 3)
+        self.assertFalse(os.path.exists(writer.mSpoolDirectory))
+
+    def test_segments(self):
+        writer = self.get_writer(timepoints_per_file=2)
+        filenames = self.append_timepoints(writer, 5)
+        self.assertEqual([os.path.basename(filename) for filename in filenames],
+                         ['timelapse_T00000.ims', 'timelapse_T00002.ims', 'timelapse_T00004.ims'])
+        self.assertEqual(self.finished, [(2, 2, True), (2, 2, True), (1, 1, True)])
+        self.assertFalse(os.path.exists(writer.mSpoolDirectory))
+
+    def test_failed_finish_keeps_spool(self):
+        writer = self.get_writer()
+        with mock.patch.object(PWB.ImageConverter, 'Finish', side_effect=PW.PyImarisWriterException('disk full')):
+            for t in range(3):
+                writer.append(np.full((2, 4, 6), t, dtype=np.uint16))
+            with self.assertRaises(PW.PyImarisWriterException):
+                writer.close()
+        spooled = np.fromfile(os.path.join(writer.mSpoolDirectory, 'T00000.raw'), dtype=np.uint16)
+        self.assertEqual(spooled.reshape(3, -1)[:, 0].tolist(), [0, 1, 2])
+
+
+class TestShards(unittest.TestCase):
+
+    def test_shard_ranges(self):
+        self.assertEqual(PWShards.get_shard_ranges(10, 3), [(0, 3), (3, 6), (6, 10)])
+        self.assertEqual(PWShards.get_shard_ranges(2, 4), [(0, 1), (1, 2)])
+
+    def create_shard(self, filename, time_points, value):
+        with PWShards.h5py.File(filename, 'w') as shard:
+            for level in range(2):
+                for t in range(time_points):
+                    shard.create_dataset('DataSet/ResolutionLevel {}/TimePoint {}/Channel 0/Data'.format(level, t),
+                                         data=np.full((2, 4, 4), value + t, dtype=np.uint8), chunks=(1, 4, 4),
+                                         compression='gzip')
+            PWShards._set_text(shard.require_group('DataSetInfo/Image'), 'Noc', 1)
+            PWShards._set_text(shard.require_group('DataSetInfo/Channel 0'), 'ColorRange', '{} {}'.format(value, value + 1))
+            time_info = shard.require_group('DataSetInfo/TimeInfo')
+            PWShards._set_text(time_info, 'FileTimePoints', time_points)
+            for t in range(time_points):
+                PWShards._set_text(time_info, 'TimePoint{}'.format(t + 1), '2020-02-05 15:27:0{}.000'.format(value + t))
+
+    @unittest.skipIf(PWShards.h5py is None, 'requires h5py')
+    def test_merge_time_points(self):
+        with tempfile.TemporaryDirectory() as directory:
+            shard_filenames = [os.path.join(directory, 'shard{}.ims'.format(shard)) for shard in range(2)]
+            self.create_shard(shard_filenames[0], 2, 0)
+            self.create_shard(shard_filenames[1], 1, 5)
+            output_filename = os.path.join(directory, 'merged.ims')
+            PWShards.merge_shards(shard_filenames, output_filename, 't')
+
+            with PWShards.h5py.File(output_filename, 'r') as merged:
+                self.assertEqual(len(merged['DataSet/ResolutionLevel 1']), 3)
+                self.assertEqual(merged['DataSet/ResolutionLevel 0/TimePoint 2/Channel 0/Data'][0, 0, 0], 5)
+                time_info = merged['DataSetInfo/TimeInfo']
+                self.assertEqual(PWShards._get_text(time_info, 'FileTimePoints'), '3')
+                self.assertEqual(PWShards._get_text(time_info, 'TimePoint3'), '2020-02-05 15:27:05.000')
+                self.assertEqual(PWShards._get_text(merged['DataSetInfo/Channel 0'], 'ColorRange'), '0 6')
+
+
+class TestByteBudget(unittest.TestCase):
+
+    def test_acquire_blocks_when_full(self):
+        budget = PWP.ByteBudget(100)
+        budget.acquire(60)
+
+        acquired = threading.Event()
+        thread = threading.Thread(target=lambda: (budget.acquire(60), acquired.set()))
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+
+        budget.release(60)
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        self.assertEqual(budget.get_bytes(), 60)
+
+    def test_oversized_request_passes_when_empty(self):
+        budget = PWP.ByteBudget(100)
+        budget.acquire(500)
+        self.assertEqual(budget.get_bytes(), 500)
+
+    def test_writer_backlog(self):
+        backlog = PWP.WriterBacklog(image_bytes=1000, max_bytes=300)
+        backlog.acquire(200)
+        acquired = threading.Event()
+
+        def produce():
+            backlog.acquire(200)
+            acquired.set()
+
+        thread = threading.Thread(target=produce)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        backlog.record_progress(0.2)
+        thread.join()
+        self.assertEqual(backlog.get_bytes(), 200)
+        self.assertEqual(backlog.get_peak_bytes(), 200)
+
+        # soft cap: without any progress the block is let through after max_wait
+        backlog.mMaxWait = 0.05
+        backlog.acquire(200)
+        self.assertEqual(backlog.mNumStalls, 1)
+        self.assertEqual(backlog.get_peak_bytes(), 400)
+
+    def test_writer_backlog_hard_cap(self):
+        backlog = PWP.WriterBacklog(image_bytes=1000, max_bytes=300)
+        self.assertIsNone(backlog.mMaxWait)
+        backlog.acquire(200)
+        acquired = threading.Event()
+        thread = threading.Thread(target=lambda: (backlog.acquire(200), acquired.set()))
+        thread.start()
+        self.assertFalse(acquired.wait(0.2))
+        backlog.record_progress(0.2)
+        thread.join()
+        self.assertEqual(backlog.mNumStalls, 0)
+        self.assertEqual(backlog.mBypassedBytes, 0)
+
+
+class SimulatedProgressImageConverter(PWB.ImageConverter):
+    """Ignores the progress of the native writer, TestMemoryBudget reports the progress of a simulated writer"""
+
+    def _progress_callback(self, progress, total_bytes_written):
+        pass
+
+
+class TestMemoryBudget(unittest.TestCase):
+
+    def setUp(self):
+        image_size = PW.ImageSize(x=16, y=4, z=5, c=1, t=1)
+        block_size = PW.ImageSize(x=4, y=4, z=5, c=1, t=1)
+        self.directory = tempfile.TemporaryDirectory()
+        self.converter = SimulatedProgressImageConverter('uint16', image_size, PW.ImageSize(x=1, y=1, z=1, c=1, t=1),
+                                                         PW.DimensionSequence('x', 'y', 'z', 'c', 't'), block_size,
+                                                         os.path.join(self.directory.name, 'PyImarisWriterMemoryTest.ims'),
+                                                         PW.Options(), 'UnitTestPyImarisWriter', '0', PW.CallbackClass())
+        self.block_bytes = 4 * 4 * 5 * 2
+        self.image_bytes = 4 * self.block_bytes
+
+    def tearDown(self):
+        self.converter.Destroy()
+        self.directory.cleanup()
+
+    def write_with_lagging_writer(self, delay, lag_blocks):
+        """Writes all blocks while a simulated writer reports progress lag_blocks behind the submitted data every delay seconds"""
+        backlog = self.converter.mBacklog
+        done = threading.Event()
+
+        def writer():
+            while not done.wait(delay):
+                processed = max(0, backlog.mSubmittedBytes - lag_blocks * self.block_bytes)
+                self.converter.mProgressRecorder.RecordProgress(processed / self.image_bytes, processed)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            self.converter.write_array(np.zeros((5, 4, 16), dtype=np.uint16))
+        finally:
+            done.set()
+            thread.join()
+
+    def test_high_water_mark(self):
+        self.converter.set_memory_budget(2 * self.block_bytes / (1024 * 1024))
+        self.write_with_lagging_writer(0.01, 1)
+
+        report = self.converter.get_memory_report()
+        self.assertEqual(report['budget_bytes'], 2 * self.block_bytes)
+        self.assertLessEqual(report['peak_buffered_bytes'], report['budget_bytes'])
+        self.assertEqual(report['stalls'], 0)
+        self.assertEqual(report['bypassed_bytes'], 0)
+
+    def test_backlog_wait_stage(self):
+        stats = self.converter.enable_stats()
+        self.converter.set_memory_budget(self.block_bytes / (1024 * 1024))
+        self.write_with_lagging_writer(0.05, 0)
+        self.assertEqual(self.converter.get_memory_report()['stalls'], 0)
+
+        latencies = stats.get_dict()['latency_seconds']
+        self.assertEqual(latencies[PWStats.STAGE_BACKLOG_WAIT]['count'], 4)
+        self.assertGreater(latencies[PWStats.STAGE_BACKLOG_WAIT]['sum'], 0.1)
+        self.assertLess(latencies[PWStats.STAGE_PREPARE]['sum'], 0.1)
+        self.assertEqual(latencies[PWStats.STAGE_LOCK_WAIT]['count'], 4)
+
+    @unittest.skipIf(PWBenchmark.resource is None, 'peak RSS not available')
+    def test_peak_rss_under_budget(self):
+        # 256 MB volume, PYIMARISWRITER_MEMORY_TEST=1 writes 2048x2048x500 (4 GB) instead
+        if os.environ.get('PYIMARISWRITER_MEMORY_TEST'):
+            size_z, budget_mb = 500, 512
+        else:
+            size_z, budget_mb = 32, 32
+        # separate process, so that the peak RSS only covers this conversion
+        json_filename = os.path.join(self.directory.name, 'memory.json')
+        subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'PyImarisWriterBenchmark.py'),
+                        '-sizex', '2048', '-sizey', '2048', '-sizez', str(size_z), '-type', '16bit', '-memory', str(budget_mb),
+                        '-json', json_filename, '-outputpath', self.directory.name, 'memory.ims'],
+                       check=True, stdout=subprocess.DEVNULL)
+        with open(json_filename) as json_file:
+            result = json.load(json_file)[0]
+        self.assertLessEqual(result['peak_buffered_MB'], budget_mb)
+        # the budget bounds the buffered blocks, interpreter, NumPy and writer threads come on top
+        self.assertLess(result['peak_rss_MB'], budget_mb + 256)
+
+
+class TestConverterStats(unittest.TestCase):
+
+    def test_latency_histogram(self):
+        histogram = PWStats.LatencyHistogram()
+        histogram.add(0.5e-6)
+        histogram.add(3e-6)
+        histogram.add(1000)
+        buckets = histogram.get_dict()['buckets']
+        self.assertEqual(buckets['1e-06'], 1)
+        self.assertEqual(buckets['4e-06'], 1)
+        self.assertEqual(buckets['inf'], 1)
+        self.assertEqual(histogram.mCount, 3)
+
+    def test_prometheus_text(self):
+        stats = PWStats.ConverterStats()
+        stats.record_block(1024, zero_copy=True)
+        stats.record_block(512, zero_copy=False)
+        stats.record_latency(PWStats.STAGE_COPY_BLOCK, 0.001)
+
+        text = stats.get_prometheus_text()
+        self.assertIn('pyimariswriter_blocks_submitted 2\n', text)
+        self.assertIn('pyimariswriter_bytes_zero_copy 1024\n', text)
+        self.assertIn('pyimariswriter_latency_seconds_bucket{stage="copy_block",le="+Inf"} 1\n', text)
+        self.assertIn('pyimariswriter_latency_seconds_count{stage="copy_block"} 1\n', text)
+
+
+class TestChannelStatistics(unittest.TestCase):
+
+    def test_min_max_histogram(self):
+        image_size = PW.ImageSize(x=6, y=4, z=1, c=2, t=2)
+        block_size = PW.ImageSize(x=4, y=4, z=1, c=1, t=1)
+        grid = PWB.BlockGrid(image_size, block_size, PW.DimensionSequence('x', 'y', 'z', 'c', 't'))
+        stats = PWChannelStats.ChannelStatistics(grid, np.uint8, num_bins=256)
+
+        image = np.zeros(grid.mImageShape, dtype=np.uint8)
+        image[:, 1] = np.arange(24, dtype=np.uint8).reshape(1, 4, 6) + 100
+        image[1, 0] = 7
+        for block in grid.iter_blocks():
+            # edge blocks are passed padded with 255, which must not be counted
+            block_buffer = np.full(grid.mBlockShape, 255, dtype=np.uint8)
+            block_data = image[grid.get_block_slices(block)]
+            block_buffer[tuple(slice(0, n) for n in block_data.shape)] = block_data
+            stats.add_block(block, block_buffer)
+
+        self.assertEqual(stats.mMin.tolist(), [[0, 7], [100, 100]])
+        self.assertEqual(stats.mMax.tolist(), [[0, 7], [123, 123]])
+        self.assertEqual(stats.mHistograms.sum(), 96)
+        self.assertEqual(stats.mHistograms[0, 0], 24)
+        self.assertEqual(stats.get_color_range(1), (100.0, 123.0))
+        self.assertEqual(stats.get_color_range(1, saturation=0.1), (102.0, 121.0))
+
+        color_infos = [PW.ColorInfo(), PW.ColorInfo()]
+        stats.apply_color_ranges(color_infos)
+        self.assertEqual((color_infos[0].mRangeMin, color_infos[0].mRangeMax), (0.0, 7.0))
+
+
+class StagedBlockRecorder(PW.ImageConverter):
+    """
+    Below PWB.ImageConverter in the MRO, records the staged blocks passed to the native CopyBlock
+    and the parameters and color infos passed to the native Finish
+    """
+
+    def CopyBlock(self, block_data, block_index):
+        self.mStagedBlocks[self.mBlockGrid.get_block(block_index)] = np.array(block_data)
+        super().CopyBlock(block_data, block_index)
+
+    def Finish(self, image_extents, parameters, time_infos, color_infos, adjust_color_range):
+        self.mFinishArguments = (parameters, color_infos, adjust_color_range)
+        super().Finish(image_extents, parameters, time_infos, color_infos, adjust_color_range)
+
+
+class StagedBlockImageConverter(PWB.ImageConverter, StagedBlockRecorder):
+    pass
+
+
+class TestIntensityTransform(unittest.TestCase):
+
+    def setUp(self):
+        image_size = PW.ImageSize(x=10, y=7, z=2, c=1, t=1)
+        block_size = PW.ImageSize(x=4, y=4, z=2, c=1, t=1)
+        sample_size = PW.ImageSize(x=1, y=1, z=1, c=1, t=1)
+        dimension_sequence = PW.DimensionSequence('x', 'y', 'z', 'c', 't')
+        self.directory = tempfile.TemporaryDirectory()
+        self.converter = StagedBlockImageConverter('uint16', image_size, sample_size, dimension_sequence, block_size,
+                                                   os.path.join(self.directory.name, 'PyImarisWriterTransformTest.ims'),
+                                                   PW.Options(), 'UnitTestPyImarisWriter', '0', PW.CallbackClass())
+        self.converter.mStagedBlocks = {}
+
+    def tearDown(self):
+        self.converter.Destroy()
+        self.directory.cleanup()
+
+    def get_written_image(self):
+        grid = self.converter.mBlockGrid
+        image = np.zeros(grid.mImageShape, dtype=self.converter.mNpType)
+        for block in grid.iter_blocks():
+            block_data = self.converter.mStagedBlocks[block]
+            slices = grid.get_block_slices(block)
+            image[slices] = block_data[tuple(slice(0, s.stop - s.start) for s in slices)]
+        return image[0, 0]
+
+    def test_quantization(self):
+        np_data = np.linspace(-10.0, 110.0, 140, dtype=np.float32).reshape(2, 7, 10)
+        transform = self.converter.set_transform(PWT.get_quantization_transform(0.0, 100.0, np.uint16))
+        self.converter.enable_channel_stats()
+        self.converter.write_array(np_data)
+
+        expected = np.rint(np.clip(np_data.astype(np.float64) * 655.35, 0, 65535)).astype(np.uint16)
+        self.assertTrue(np.array_equal(self.get_written_image(), expected))
+        self.assertEqual(transform.mDescription, 'quantize [0.0, 100.0] to uint16')
+
+        parameters = PW.Parameters()
+        parameters.set_value('Image', 'Name', 'quantized')
+        color_infos = [PW.ColorInfo()]
+        self.converter.Finish(PW.ImageExtents(0, 0, 0, 10, 7, 2), parameters, [datetime.today()],
+                              color_infos, True)
+        native_parameters, native_color_infos, adjust_color_range = self.converter.mFinishArguments
+        self.assertEqual(native_parameters.mSections['Image'],
+                         {'Name': 'quantized', 'IntensityTransform': 'quantize [0.0, 100.0] to uint16'})
+        self.assertEqual((native_color_infos[0].mRangeMin, native_color_infos[0].mRangeMax), (0, 65535))
+        self.assertFalse(adjust_color_range)
+
+        # the arguments of the caller are left unchanged
+        self.assertEqual(parameters.mSections['Image'], {'Name': 'quantized'})
+        self.assertEqual((color_infos[0].mRangeMin, color_infos[0].mRangeMax), (0, 255))
+
+    def test_default_clip(self):
+        np_data = np.full((2, 7, 10), 70000.0, dtype=np.float32)
+        np_data[0] = -5
+        self.converter.set_transform(scale=1.0)
+        self.converter.write_array(np_data)
+        image = self.get_written_image()
+        self.assertTrue((image[0] == 0).all())
+        self.assertTrue((image[1] == 65535).all())
+
+    def test_window_lut(self):
+        transform = PWT.get_window_transform(100, 1100, 4096, np.uint8)
+        transform.prepare(np.uint8)
+        np_data = np.array([[0, 100, 600, 1100, 4095, 65535]], dtype=np.uint16)
+        out = np.empty(np_data.shape, dtype=np.uint8)
+        transform.apply(np_data, out)
+        self.assertEqual(out.tolist(), [[0, 0, 128, 255, 255, 255]])
+
+        with self.assertRaises(PW.PyImarisWriterException):
+            transform.apply(np_data.astype(np.float32), out)
+        with self.assertRaises(PW.PyImarisWriterException):
+            PWT.IntensityTransform(scale=2.0, lut=transform.mLut)
+
+    def test_pickle(self):
+        # configured transforms are passed to PyImarisWriterBatch worker processes
+        transform = PWT.get_quantization_transform(0.0, 100.0, np.uint16)
+        transform.prepare(np.uint16)
+        transform.apply(np.zeros((2, 2), dtype=np.float32), np.empty((2, 2), dtype=np.uint16))
+        copy = pickle.loads(pickle.dumps(transform))
+
+        np_data = np.array([[-1.0, 25.0], [100.0, 200.0]], dtype=np.float32)
+        out = np.empty(np_data.shape, dtype=np.uint16)
+        copy.apply(np_data, out)
+        self.assertEqual(out.tolist(), [[0, 16384], [65535, 65535]])
+        self.assertEqual(copy.mDescription, transform.mDescription)
+
+
+class TestProgressRecorder(unittest.TestCase):
+
+    class RecordingCallbackClass:
+        def __init__(self):
+            self.mUpdates = []
+
+        def RecordProgress(self, progress, total_bytes_written):
+            self.mUpdates.append(progress)
+
+    def test_throttle(self):
+        callback_class = self.RecordingCallbackClass()
+        recorder = PWProgress.ProgressRecorder(callback_class)
+        recorder.set_throttle(min_progress_step=0.05)
+        for i in range(101):
+            recorder.RecordProgress(i / 100, i)
+        self.assertEqual(len(callback_class.mUpdates), 21)
+        self.assertEqual(callback_class.mUpdates[-1], 1.0)
+
+    def test_poller(self):
+        callback_class = self.RecordingCallbackClass()
+        recorder = PWProgress.ProgressRecorder(callback_class)
+        poller = PWProgress.ProgressPoller(recorder, interval=60)
+        for i in range(11):
+            recorder.RecordProgress(i / 10, i)
+        self.assertEqual(callback_class.mUpdates, [])
+
+        poller.stop()
+        self.assertEqual(callback_class.mUpdates, [1.0])
+
+
+class TestAutotune(unittest.TestCase):
+
+    def test_select(self):
+        fast = PWAutotune.TuneResult((512, 512, 1), 8, PW.eCompressionAlgorithmNone, 900, 1.0)
+        medium = PWAutotune.TuneResult((256, 256, 8), 8, PW.eCompressionAlgorithmLZ4, 600, 0.6)
+        small = PWAutotune.TuneResult((256, 256, 8), 8, PW.eCompressionAlgorithmGzipLevel2, 200, 0.4)
+        results = [fast, medium, small]
+
+        self.assertIs(PWAutotune.select(results), fast)
+        self.assertIs(PWAutotune.select(results, min_mb_per_second=500), medium)
+        self.assertIs(PWAutotune.select(results, max_size_ratio=0.7), medium)
+        self.assertIs(PWAutotune.select(results, min_mb_per_second=1000), fast)
+
+    def test_trial_shape(self):
+        image_size = PW.ImageSize(x=2048, y=2048, z=500, c=4, t=1)
+        self.assertEqual(PWAutotune.get_trial_shape(image_size, 64 * 1024 * 1024, 2), (32, 1024, 1024))
+
+    def test_synthetic_sample_range(self):
+        for imaris_type in ('uint8', 'uint16', 'uint32', 'float32'):
+            sample = PWAutotune.get_synthetic_sample(imaris_type, (4, 64, 64))
+            self.assertEqual(sample.dtype, PWB.get_np_type(imaris_type))
+            self.assertGreaterEqual(sample.min(), 0)
+        # noise around 100, clipped instead of wrapping around
+        sample = PWAutotune.get_synthetic_sample('uint8', (4, 64, 64), seed=3)
+        self.assertLess(abs(float(sample.mean()) - PWAutotune.get_synthetic_sample('uint16', (4, 64, 64), seed=3).mean()), 1)
+
+    def test_cache_key_data(self):
+        image_size = PW.ImageSize(x=64, y=64, z=4, c=1, t=1)
+        trials = ([(64, 64, 4)], [1], [PW.eCompressionAlgorithmNone])
+
+        def get_key(sample, synthetic=False):
+            return PWAutotune._get_cache_key(image_size, 'uint16', None, None, *trials, sample, synthetic)
+
+        dark = np.full((4, 64, 64), 10, dtype=np.uint16)
+        self.assertEqual(get_key(dark), get_key(dark.copy()))
+        self.assertNotEqual(get_key(dark), get_key(dark + 1000))
+        self.assertNotEqual(get_key(dark), get_key(dark.astype(np.uint8)))
+        self.assertNotEqual(get_key(dark), get_key(dark, synthetic=True))
+
+
+def batch_job(num_bytes, num_threads):
+    # module level, PyImarisWriterBatch pickles the job function for the worker processes
+    return num_bytes * num_threads
+
+
+def failing_batch_job(num_threads):
+    raise PW.PyImarisWriterException('failing job')
+
+
+class TestBatchConverter(unittest.TestCase):
+
+    def test_failing_job(self):
+        jobs = [PWBatch.ConversionJob('first', batch_job, (1024 * 1024,), 1024 * 1024),
+                PWBatch.ConversionJob('failing', failing_batch_job, (), 4 * 1024 * 1024),
+                PWBatch.ConversionJob('last', batch_job, (2 * 1024 * 1024,), 2 * 1024 * 1024)]
+        batch_result = PWBatch.BatchConverter(total_threads=2, max_parallel_jobs=2).run(jobs)
+
+        # results in job order, the failing job neither stops the others nor counts its bytes
+        self.assertEqual([result.mName for result in batch_result.mJobResults], ['first', 'failing', 'last'])
+        failed = batch_result.get_failed()
+        self.assertEqual([result.mName for result in failed], ['failing'])
+        self.assertIn('failing job', str(failed[0].mError))
+        self.assertEqual(batch_result.get_num_bytes(), 3 * 1024 * 1024)
+        self.assertTrue(all(result.mSeconds > 0 for result in batch_result.mJobResults if result.mError is None))
+
+    def test_threads_and_memory(self):
+        converter = PWBatch.BatchConverter(total_threads=8, max_parallel_jobs=3, max_memory_bytes=100)
+        self.assertEqual(converter.mThreadsPerJob, 2)
+        job = PWBatch.ConversionJob('job', batch_job, (1,), 1, memory_bytes=60)
+        self.assertTrue(converter._fits(job, 0, 0))
+        self.assertTrue(converter._fits(job, 40, 1))
+        self.assertFalse(converter._fits(job, 50, 1))
+        self.assertFalse(converter._fits(job, 0, 3))
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_noise_block(self):
+        noise = PWBenchmark.get_noise_block('16bit', 1000, np.random.default_rng(33))
+        self.assertEqual(noise.dtype, np.uint16)
+        self.assertEqual(noise.size, 2000)
+        self.assertTrue(np.array_equal(noise, PWBenchmark.get_noise_block('16bit', 1000, np.random.default_rng(33))))
+        # 0.3 * N(100, 40) + 0.7 * the first sample, truncated to integers
+        first = np.random.default_rng(33).normal(100.0, 40.0)
+        self.assertLess(abs(noise.mean() + 0.5 - (30 + 0.7 * first)), 1)
+        self.assertLess(abs(noise.std() - 12), 1)
+
+        noise = PWBenchmark.get_noise_block('32bit', 1000, np.random.default_rng(33))
+        self.assertEqual(noise.dtype, np.uint32)
+        self.assertLessEqual(noise.max(), 4096)
+
+    def test_compression_algorithm(self):
+        self.assertEqual(PWBenchmark.get_compression_algorithm(2), PW.eCompressionAlgorithmGzipLevel2)
+        self.assertEqual(PWBenchmark.get_compression_algorithm(31), PW.eCompressionAlgorithmShuffleLZ4)
+        self.assertEqual(PWBenchmark.get_compression_algorithm(10), PW.eCompressionAlgorithmNone)
+        self.assertEqual(PWBenchmark.get_compression_algorithm(99), PW.eCompressionAlgorithmNone)
+
+    def test_parse_block_size(self):
+        block_size = PWBenchmark.parse_block_size('256x128X8')
+        self.assertEqual((block_size.x, block_size.y, block_size.z, block_size.c, block_size.t), (256, 128, 8, 1, 1))
+
+    def test_z1_options(self):
+        image_size = PW.ImageSize(x=4, y=4, z=2, c=1, t=1)
+        options = PW.Options()
+        options.mForceFileBlockSizeZ = True
+        options.mFlipDimensionY = True
+        with tempfile.TemporaryDirectory() as directory:
+            converter = PWB.ImageConverter('uint8', image_size, PW.ImageSize(x=1, y=1, z=1, c=1, t=1),
+                                           PW.DimensionSequence('x', 'y', 'z', 'c', 't'), image_size,
+                                           os.path.join(directory, 'PyImarisWriterOptionsTest.ims'), options,
+                                           'UnitTestPyImarisWriter', '0', PW.CallbackClass())
+            c_options = converter.mOptions.contents
+            converter.Destroy()
+
+        self.assertTrue(c_options.mForceFileBlockSizeZ1)
+        self.assertEqual((c_options.mFlipDimensionX, c_options.mFlipDimensionY, c_options.mFlipDimensionZ),
+                         (False, True, False))
+        self.assertEqual(c_options.mThumbnailSizeXY, 256)
+
+
+class TestCompressionSelection(unittest.TestCase):
+
+    def test_recommend_compression(self):
+        self.assertEqual(PWCompression.recommend_compression(0.95, 0.97, 0.1), PW.eCompressionAlgorithmNone)
+        self.assertEqual(PWCompression.recommend_compression(0.95, 0.97, 0.5), PW.eCompressionAlgorithmLZ4)
+        self.assertEqual(PWCompression.recommend_compression(0.5, 0.3, 0.0), PW.eCompressionAlgorithmShuffleGzipLevel1)
+        self.assertEqual(PWCompression.recommend_compression(0.3, 0.5, 1.0), PW.eCompressionAlgorithmGzipLevel9)
+
+    def test_select_compressions(self):
+        image_size = PW.ImageSize(x=128, y=128, z=4, c=2, t=1)
+        block_size = PW.ImageSize(x=64, y=64, z=4, c=1, t=1)
+        grid = PWB.BlockGrid(image_size, block_size, PW.DimensionSequence('x', 'y', 'z', 'c', 't'))
+
+        np_data = np.zeros((2, 4, 128, 128), dtype=np.uint16)
+        np_data[1] = np.random.default_rng(0).integers(0, 65536, (4, 128, 128))
+        options = PW.Options()
+        compression, channels = PWCompression.select_compressions(grid, np_data, tradeoff=0.5, options=options)
+
+        self.assertEqual(channels[1].mCompression, PW.eCompressionAlgorithmLZ4)
+        self.assertEqual(compression, channels[0].mCompression)
+        self.assertEqual(options.mCompressionAlgorithmType, compression)
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file